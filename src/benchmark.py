@@ -0,0 +1,1657 @@
+"""Benchmarks for the tracker's hot paths, run off Windows against synthetic or captured memory snapshots.
+
+Usage: python benchmark.py <benchmark> [options], see python benchmark.py --help.
+Captured snapshots come from running main.py --capture-snapshot <path> on Windows with NCM playing a song.
+"""
+import argparse
+import asyncio
+import bisect
+import gc
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import socket
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Iterator, List, Tuple
+
+import orjson
+import psutil
+import requests
+
+import main
+
+V2_VERSION = '2.10.13.6067'
+V3_VERSION = '3.0.0.0'
+V2_MODULE_BASE = 0x10000000
+V3_MODULE_BASE = 0x7FF800000000
+HEAP_BASE = 0x20000000
+soak_max_growth = {'blocks': 5000, 'rss': 2 * 2 ** 20}  # per simulated day after the first, above this the soak benchmark reports a leak
+
+
+def pattern_bytes(pattern: str, fill: int = 0x90) -> bytearray:
+    return bytearray(fill if byte == '??' else int(byte, 16) for byte in pattern.split())
+
+
+def pe_header(sections: list, size: int = 0x1000) -> bytearray:
+    """Minimal PE headers for sections given as (virtual address, virtual size, characteristics)."""
+    header = bytearray(size)
+    header[:2] = b'MZ'
+    struct.pack_into('<I', header, 0x3C, 0x80)
+    header[0x80:0x84] = b'PE\0\0'
+    struct.pack_into('<HH12xH', header, 0x84, 0x8664, len(sections), 0xF0)
+    for i, (virtual_address, virtual_size, characteristics) in enumerate(sections):
+        section = 0x80 + 24 + 0xF0 + 40 * i
+        struct.pack_into('<II', header, section + 8, virtual_size, virtual_address)
+        struct.pack_into('<I', header, section + 36, characteristics)
+    return header
+
+
+def make_v2_snapshot(path: str, song_id: str = '1234567890', current: float = 42.5, version: str = V2_VERSION):
+    offsets = main.offsets[version]
+    module_size = offsets['song_array'] + 0x1000
+    module = bytearray(module_size)
+    struct.pack_into('<d', module, offsets['current'], current)
+    struct.pack_into('<I', module, offsets['song_array'], HEAP_BASE)
+    heap = f'{song_id}_0'.encode('utf-16-le').ljust(0x40, b'\0')
+    main.write_snapshot(path, [(V2_MODULE_BASE, bytes(module)), (HEAP_BASE, heap)],
+                        {'cloudmusic.dll': {'base': V2_MODULE_BASE, 'size': module_size}}, version)
+
+
+def make_v3_snapshot(path: str, song_id: str = '1234567890', current: float = 42.5, module_size: int = 0x200000, version: str = V3_VERSION):
+    """V3 layout: both AOB patterns in the code, the schedule double and player pointer in the data, the play info on the heap.
+    Song IDs of 15 bytes or less (with the "_0" suffix) are stored inline (SSO), longer ones behind a heap pointer."""
+    module = bytearray(b'\xCC' * module_size)
+    module[:0x1000] = pe_header([(0x1000, module_size // 2 + 0x1000, main.IMAGE_SCN_MEM_EXECUTE), (module_size - 0x2000, 0x2000, 0)])
+    schedule_offset, player_offset = module_size - 0x2000, module_size - 0x1000
+    schedule_match, player_match = module_size // 2, module_size // 2 + 0x100
+    schedule = pattern_bytes(main.V3_AUDIO_SCHEDULE_PATTERN)
+    struct.pack_into('<i', schedule, 4, schedule_offset - (schedule_match + 4) - 4)
+    module[schedule_match:schedule_match + len(schedule)] = schedule
+    player = pattern_bytes(main.V3_AUDIO_PLAYER_PATTERN)
+    struct.pack_into('<i', player, 3, player_offset - (player_match + 3) - 4)
+    module[player_match:player_match + len(player)] = player
+    struct.pack_into('<d', module, schedule_offset, current)
+    struct.pack_into('<q', module, player_offset + 0x50, HEAP_BASE)
+
+    song_str = f'{song_id}_0'.encode()
+    heap = bytearray(0x100)
+    struct.pack_into('<q', heap, 0x20, len(song_str))
+    if len(song_str) <= 15:
+        heap[0x10:0x10 + len(song_str)] = song_str
+    else:
+        struct.pack_into('<q', heap, 0x10, HEAP_BASE + 0x80)
+        heap[0x80:0x80 + len(song_str)] = song_str
+    main.write_snapshot(path, [(V3_MODULE_BASE, bytes(module)), (HEAP_BASE, bytes(heap))],
+                        {'cloudmusic.dll': {'base': V3_MODULE_BASE, 'size': module_size}}, version)
+
+
+def timeit(fn: Callable[[], object], number: int) -> float:
+    """Average seconds per call."""
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+class CountingSnapshotReader(main.SnapshotReader):
+    """Counts reads, each of which is one ReadProcessMemory call on the live process."""
+    reads = 0
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        self.reads += 1
+        return super().r_bytes(address, size)
+
+
+def open_snapshot(path: str, reader_class: type = main.SnapshotReader) -> main.SnapshotReader:
+    reader = reader_class(path)
+    reader.open(reader.snapshot_pid)
+    return reader
+
+
+def bench_decode(args):
+    """Version detection, offset resolution and song ID decoding, i.e. everything update() reads from memory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.snapshot or []
+        if not paths:
+            for name, make, song_id in (('v2', make_v2_snapshot, '1234567890'), ('v3-sso', make_v3_snapshot, '123456789'), ('v3-heap', make_v3_snapshot, '12345678901234')):
+                paths.append(os.path.join(tmp, f'{name}.snap'))
+                make(paths[-1], song_id=song_id)
+        for path in paths:
+            reader = open_snapshot(path)
+            if reader.version.startswith('3.'):
+                scan = timeit(lambda: main.scan_for_v3_offsets(reader), max(args.number // 1000, 1))
+                schedule_ptr, audio_player_ptr = main.scan_for_v3_offsets(reader)
+                read = lambda: (reader.r_float64(schedule_ptr), main.read_v3_song_id(reader, audio_player_ptr))
+            elif reader.version in main.offsets:
+                scan = 0.0
+                base = reader.module('cloudmusic.dll')['base']
+                current_ptr, song_array_ptr = base + main.offsets[reader.version]['current'], base + main.offsets[reader.version]['song_array']
+                read = lambda: (reader.r_float64(current_ptr), main.read_v2_song_id(reader, song_array_ptr))
+            else:
+                print(f'{os.path.basename(path)}: unsupported version {reader.version}')
+                continue
+            current, song_id = read()
+            print(f'{os.path.basename(path)} ({reader.version}): song {song_id} at {main.sec_to_str(current)}, '
+                  f'offset scan {scan * 1e3:.2f} ms, per-tick read {timeit(read, args.number) * 1e6:.2f} us')
+            reader.close_snapshot()
+
+
+def bench_aob_scan(args):
+    """V3 offset discovery over a synthetic cloudmusic.dll-sized module, with the patterns near the end of its code section.
+    Compared against how it was scanned before: the whole module read and regex-scanned for all matches, once per pattern."""
+    rng = random.Random(0)
+    patterns = [main.V3_AUDIO_SCHEDULE_PATTERN, main.V3_AUDIO_PLAYER_PATTERN]
+    code_size = args.size // 2
+    module = bytearray(args.size)
+    module[:0x1000] = pe_header([(0x1000, code_size, main.IMAGE_SCN_MEM_EXECUTE), (0x1000 + code_size, args.size - code_size - 0x1000, 0)])
+    # Random code plus frequent partial matches of the anchors, like the many ucomisd instructions in real code
+    module[0x1000:0x1000 + code_size] = rng.randbytes(code_size)
+    decoy = bytes.fromhex('66 0F 2E 0D')
+    for offset in range(0x1000, code_size - 0x1000, 0x800):
+        module[offset:offset + len(decoy)] = decoy
+    for i, pattern in enumerate(patterns):
+        offset = code_size - 0x1000 + 0x100 * i
+        module[offset:offset + len(pattern.split())] = pattern_bytes(pattern)
+
+    def scan_before() -> dict:
+        found = {}
+        for pattern in patterns:
+            regex = re.compile(b''.join(b'.' if byte == '??' else re.escape(bytes.fromhex(byte)) for byte in pattern.split()), re.DOTALL)
+            found[pattern] = [V3_MODULE_BASE + match.start() for match in regex.finditer(reader.r_bytes(V3_MODULE_BASE, args.size))][0]
+        return found
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'aob.snap')
+        main.write_snapshot(path, [(V3_MODULE_BASE, bytes(module))], {'cloudmusic.dll': {'base': V3_MODULE_BASE, 'size': args.size}}, V3_VERSION)
+        reader = open_snapshot(path)
+        number = max(args.number // 1000, 1)
+        main.compile_aob_pattern.cache_clear()
+        cold = timeit(lambda: reader.scan_module('cloudmusic.dll', patterns), 1)
+        assert reader.scan_module('cloudmusic.dll', patterns) == scan_before()
+        print(f'{args.size / 2 ** 20:.0f} MB module: single-pass anchored scan {timeit(lambda: reader.scan_module("cloudmusic.dll", patterns), number) * 1e3:.2f} ms '
+              f'(first run incl. pattern compile {cold * 1e3:.2f} ms), '
+              f'full regex scan per pattern {timeit(scan_before, number) * 1e3:.2f} ms')
+        reader.close_snapshot()
+
+
+def bench_read_plan(args):
+    """Per-tick memory reads with field-by-field reads, as before, and with a coalesced ReadPlan (V3) or the direct reads that replace it (V2)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make, song_id in (('v2', make_v2_snapshot, '1234567890'), ('v3-sso', make_v3_snapshot, '123456789'), ('v3-heap', make_v3_snapshot, '12345678901234')):
+            path = os.path.join(tmp, f'{name}.snap')
+            make(path, song_id=song_id)
+            reader = open_snapshot(path, CountingSnapshotReader)
+            is_v3 = reader.version.startswith('3.')
+            if is_v3:
+                schedule_ptr, audio_player_ptr = main.scan_for_v3_offsets(reader)
+                plan = main.v3_read_plan(schedule_ptr, audio_player_ptr)
+                before = lambda: (reader.r_float64(schedule_ptr), main.read_v3_song_id(reader, audio_player_ptr))
+                after = lambda: main.read_v3_song_state(reader, plan)
+            else:  # V2 reads its fields directly, they are too far apart to coalesce
+                base = reader.module('cloudmusic.dll')['base']
+                current_ptr, song_array_ptr = base + main.offsets[reader.version]['current'], base + main.offsets[reader.version]['song_array']
+                before = lambda: (reader.r_float64(current_ptr), main.read_v2_song_id(reader, song_array_ptr))
+                after = lambda: main.read_v2_song_state(reader, base, main.offsets[reader.version])
+            assert before() == after()
+            results = []
+            for read in (before, after):
+                reader.reads = 0
+                seconds = timeit(read, args.number)
+                results.append(f'{reader.reads / args.number:.0f} reads, {seconds * 1e6:.2f} us')
+            print(f'{name}: per tick before {results[0]}, {"with read plan" if is_v3 else "now"} {results[1]} (update() also skips get_process_name while the handle is open)')
+            reader.close_snapshot()
+
+
+class V2Process(main.MemoryReader):
+    """A running 2.x NCM whose cloudmusic.dll is not in `offsets`: a writable data section of random bytes holding the playback position
+    and the song_array pointer, plus what discovery has to tell them apart from. Another clock advances with time too,
+    a pointer elsewhere shows a copy of the first song's ID and goes stale on song changes, and some counters change on every tick."""
+    version = '2.99.0.0'
+    data_section = 0x200000  # module offset of the data section
+    current, uptime, song_array, song_array_copy, stale_copy = 0x200100, 0x240000, 0x280004, 0x2C0008, 0x2E000C  # module offsets
+
+    def __init__(self, rng: random.Random, clock: 'SoakClock', data_size: int = 0x100000):
+        self.rng = rng
+        self.clock = clock
+        self.size = self.data_section + data_size
+        self.module_memory = bytearray(self.size)
+        self.module_memory[:0x1000] = pe_header([(0x1000, self.data_section - 0x1000, main.IMAGE_SCN_MEM_EXECUTE),
+                                                 (self.data_section, data_size, main.IMAGE_SCN_MEM_WRITE)])
+        self.module_memory[self.data_section:] = rng.randbytes(data_size)
+        self.heap = bytearray(0x10000)
+        self.counters = [self.data_section + offset for offset in rng.sample(range(0, data_size, 8), 200)]
+        self.started = clock.now
+        self.songs = 0
+        self.song_started = clock.now
+        self.paused = False  # the playback position stands still, the other clock and the counters don't
+        self.play('1234567890')
+        struct.pack_into('<I', self.module_memory, self.stale_copy, HEAP_BASE + 0x8000)
+        self.heap[0x8000:0x8000 + 0x18] = '1234567890_0'.encode('utf-16-le').ljust(0x18, b'\0')
+        self.tick()
+
+    def play(self, song_id: str):
+        """Switches to the next song, whose ID string NCM allocates anew."""
+        address = 0x100 * self.songs
+        self.heap[address:address + 0x18] = f'{song_id}_0'.encode('utf-16-le').ljust(0x18, b'\0')
+        for offset in (self.song_array, self.song_array_copy):
+            struct.pack_into('<I', self.module_memory, offset, HEAP_BASE + address)
+        self.songs += 1
+        self.song_started = self.clock.now
+
+    def tick(self):
+        """Writes what NCM updates while playing."""
+        if self.paused:
+            self.song_started = self.clock.now - struct.unpack_from('<d', self.module_memory, self.current)[0]
+        struct.pack_into('<d', self.module_memory, self.current, self.clock.now - self.song_started)
+        struct.pack_into('<d', self.module_memory, self.uptime, 3600 + self.clock.now - self.started)
+        for address in self.counters:
+            struct.pack_into('<I', self.module_memory, address, self.rng.getrandbits(32))
+
+    def module(self, name: str) -> dict:
+        return {'base': V2_MODULE_BASE, 'size': self.size}
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        for base, memory in ((V2_MODULE_BASE, self.module_memory), (HEAP_BASE, self.heap)):
+            if base <= address and address + size <= base + len(memory):
+                return bytes(memory[address - base:address - base + size])
+        raise RuntimeError(f'Could not read {size} bytes at {hex(address)}')
+
+
+def bench_v2_discovery(args):
+    """V2 offset discovery of an unknown 2.x build against a simulated NCM with decoys, see V2Process. Discovery must wait while another clock
+    advances along with the playback position, finish with the right offsets after a song change, neither time out nor rescan while NCM
+    stays paused, and cached offsets that no longer read sanely must be discarded when they are loaded."""
+    clock = SoakClock(1.7e9)
+    real_time, main.time = main.time, clock
+    try:
+        process = V2Process(random.Random(0), clock)
+        discovery = main.V2OffsetDiscovery(process, process.module('cloudmusic.dll'))
+        expected = {'current': process.current, 'song_array': process.song_array}
+        steps, step_seconds, found = 0, [], None
+        while found is None and steps < 30:
+            if steps == 10:
+                process.play('2345678901')
+            clock.now += 1
+            process.tick()
+            start = time.perf_counter()
+            found = discovery.step()
+            step_seconds.append(time.perf_counter() - start)
+            steps += 1
+            if steps <= 10 and found is not None:
+                raise AssertionError(f'Discovery settled on {found} before the song change could tell the candidates apart')
+        if found != expected:
+            raise AssertionError(f'Discovered {found}, expected {expected}')
+        print(f'{(process.size - process.data_section) / 2 ** 20:.0f} MB data section: offsets found {steps - 10} steps after the song change, '
+              f'candidate search {step_seconds[1] * 1e3:.0f} ms, then {statistics.median(step_seconds[2:]) * 1e3:.1f} ms per step')
+
+        paused = V2Process(random.Random(1), clock)
+        paused.paused = True
+        discovery = main.V2OffsetDiscovery(paused, paused.module('cloudmusic.dll'))
+        step_seconds = []
+        for _ in range(main.v2_discovery_timeout * 2):
+            clock.now += 1
+            paused.tick()
+            start = time.perf_counter()
+            if discovery.step() is not None:
+                raise AssertionError('Discovery settled while paused')
+            step_seconds.append(time.perf_counter() - start)
+        if discovery.played:
+            raise AssertionError(f'{discovery.played:.0f} s of pause counted towards the discovery timeout')
+        print(f'Paused for {len(step_seconds)} s: none of it counted towards the {main.v2_discovery_timeout} s timeout, '
+              f'{max(step_seconds[2:]) * 1e3:.1f} ms per step at most after the candidate search')
+
+        real_cache, main.offset_cache = main.offset_cache, main.OffsetCache(':memory:')
+        try:
+            build_hash = main.module_hash(process, V2_MODULE_BASE)
+            image_base = 0x80 + 24 + 24  # OptionalHeader.ImageBase in pe_header()
+            process.module_memory[image_base:image_base + 8] = struct.pack('<Q', 0x7FF800000000)  # relocated by ASLR
+            if main.module_hash(process, V2_MODULE_BASE) != build_hash:
+                raise AssertionError('A relocated module hashed as another build')
+            process.module_memory[0x80 + 8:0x80 + 12] = struct.pack('<I', 0x5F000000)  # FileHeader.TimeDateStamp of another build
+            if main.module_hash(process, V2_MODULE_BASE) == build_hash:
+                raise AssertionError('Another build hashed as the same one')
+            process.module_memory[0x80 + 8:0x80 + 12] = bytes(4)
+            main.offset_cache.put('v2', process.version, build_hash, expected)
+            assert main.resolve_cached_v2_offsets(process, process.version, V2_MODULE_BASE) == expected
+            for name, stale in (('song_array', {**expected, 'song_array': process.song_array + 4}), ('current', {**expected, 'current': process.current + 0x10000})):
+                main.offset_cache.put('v2', process.version, build_hash, stale)
+                if main.resolve_cached_v2_offsets(process, process.version, V2_MODULE_BASE) is not None or main.offset_cache.get('v2', process.version, build_hash) is not None:
+                    raise AssertionError(f'Cached offsets with a stale {name} offset were used')
+            print('Cached offsets: kept across relocation, valid ones used, stale song_array and current offsets discarded')
+        finally:
+            main.offset_cache.close()
+            main.offset_cache = real_cache
+    finally:
+        main.time = real_time
+
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+sys.argv = ['main.py'] + sys.argv[1:]
+import main
+if not main.headless:
+    main.build_ui()
+import psutil
+print(time.perf_counter() - start, psutil.Process().memory_info().rss, sum(name.split('.')[0] in ('tkinter', 'PIL', 'pystray') for name in sys.modules))
+"""
+
+
+def bench_startup(args):
+    """Cold start of main.py up to the first tick, with the window and tray icon and with --headless, each in a fresh interpreter."""
+    number = max(args.number // 1000, 1)
+    for name, argv in (('ui (--min)', ['--min']), ('headless', ['--headless'])):
+        runs = [subprocess.run([sys.executable, '-c', STARTUP_SCRIPT] + argv, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, check=True).stdout.split() for _ in range(number)]
+        seconds = statistics.median(float(run[0]) for run in runs)
+        rss = statistics.median(int(run[1]) for run in runs)
+        print(f'{name}: startup {seconds * 1e3:.0f} ms, RSS {rss / 2 ** 20:.1f} MB, {runs[0][2]} UI modules loaded (median of {number} runs)')
+
+
+PROFILE_STARTUP_SCRIPT = """
+import sys
+src, snapshot, report = sys.argv[1:4]
+sys.path.insert(0, src)
+sys.argv = ['main.py', '--headless', '--profile-startup', report]
+import main
+
+# Stand-ins for what only exists on Windows: the NCM process and its memory (pyMeow), its file version (win32api) and Discord
+reader = main.SnapshotReader(snapshot)
+main.supervisor.reader_factory = lambda: reader
+
+
+class Process:
+    info = {'name': 'cloudmusic.exe', 'pid': reader.snapshot_pid, 'create_time': 0.0}
+
+    def cmdline(self):
+        return [snapshot]
+
+    def exe(self):
+        return snapshot
+
+
+class Discord:
+    client_id = main.client_id
+
+    async def connect(self):
+        pass
+
+    async def update(self, **kwargs):
+        pass
+
+    async def clear(self):
+        pass
+
+    def send_data(self, op, payload):
+        pass
+
+    class sock_writer:
+        close = staticmethod(lambda: None)
+
+
+main.process_watcher.process_iter = lambda attrs=None: [Process()]
+main.process_watcher.version_reader = lambda exe_path: reader.version
+main.RPC = main.publisher.presence = Discord()
+netease = lambda song_id: main.SongInfo(None, 'Album', 240.0, 'Artist', 'Title')
+main.resolver.sources = [(name, netease if name == 'netease' else lookup) for name, lookup in main.resolver.sources]
+main.run_headless()
+"""
+
+
+def bench_profile_startup(args):
+    """main.py --headless --profile-startup against a V3 snapshot, with the Windows-only parts stood in for so it runs anywhere.
+    Each run uses a fresh cache directory, so the AOB scan is not skipped by cached offsets."""
+    src = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = args.snapshot[0] if args.snapshot else os.path.join(tmp, 'v3.snap')
+        if not args.snapshot:
+            make_v3_snapshot(snapshot)
+        reports = []
+        for i in range(max(args.number // 1000, 1)):
+            data_dir = os.path.join(tmp, f'run{i}')
+            os.mkdir(data_dir)
+            report_path = args.report if args.report and i == 0 else os.path.join(data_dir, 'report.json')
+            subprocess.run([sys.executable, '-c', PROFILE_STARTUP_SCRIPT, src, snapshot, report_path], cwd=data_dir,
+                           env={**os.environ, 'LOCALAPPDATA': data_dir}, capture_output=True, check=True, timeout=60)
+            with open(report_path, encoding='utf-8') as f:
+                reports.append(json.load(f))
+    for name in reports[0]['phases']:
+        ends = [report['phases'][name]['end'] for report in reports if name in report['phases']]
+        durations = [report['phases'][name]['duration'] for report in reports if name in report['phases']]
+        print(f'{name:<20} took {statistics.median(durations):8.2f} ms, done at {statistics.median(ends):8.2f} ms')
+    print('Slowest imports (self time, first run):')
+    for entry in sorted(reports[0]['imports'], key=lambda entry: entry['self'], reverse=True)[:10]:
+        print(f"  {entry['module']:<40} {entry['self']:8.2f} ms (cumulative {entry['cumulative']:.2f} ms)")
+    if args.report:
+        print(f'Full report of the first run written to {args.report}')
+
+
+class Session:
+    """A synthetic listening session: what NCM shows over time and the events that presence should follow.
+    Events are at least 8 seconds apart, so each one can be checked on its own."""
+    max_latency = 6.0  # longest a change may take to show up in presence: two samples apart at the slowest tick while NCM runs, plus jitter
+
+    def __init__(self, rng: random.Random, duration: float):
+        self.segments = []  # (start time, song ID or None while NCM is not running, progress at start, playing)
+        self.events = []  # (time, kind, expected song ID, expected progress at that time)
+        song, progress, playing, t = self.new_song(rng), 0.0, True, 0.0
+        self.add(t, 'start', song, progress, playing)
+        while t < duration:
+            gap = rng.uniform(8, 240)
+            if song is not None and playing:
+                progress += gap
+            t += gap
+            if song is None:
+                song, progress, playing = self.new_song(rng), 0.0, True
+                self.add(t, 'start', song, progress, playing)
+                continue
+            kind = rng.choices(['skip', 'seek', 'pause', 'exit'], [0.35, 0.2, 0.35, 0.1])[0] if playing else rng.choices(['resume', 'skip', 'exit'], [0.7, 0.2, 0.1])[0]
+            if kind == 'skip':
+                song, progress, playing = self.new_song(rng), 0.0, True
+            elif kind == 'seek':
+                progress = (progress + rng.uniform(10, 120)) if rng.random() < 0.5 else max(progress - rng.uniform(10, 120), 0.0)
+            elif kind in ('pause', 'resume'):
+                playing = not playing
+            elif kind == 'exit':
+                song = None
+            self.add(t, kind, song, progress, playing)
+            if kind == 'pause' and rng.random() < 0.15:  # paused past pause_timeout
+                self.events.append((t + main.pause_timeout, 'idle', None, progress))
+                t += main.pause_timeout + rng.uniform(30, 600)
+        self.end = t + 2 * self.max_latency
+        self.starts = [segment[0] for segment in self.segments]
+
+    @staticmethod
+    def new_song(rng: random.Random) -> str:
+        return str(rng.randrange(10 ** 5, 10 ** 10))
+
+    def add(self, t: float, kind: str, song: str | None, progress: float, playing: bool):
+        self.segments.append((t, song, progress, playing))
+        self.events.append((t, kind, song, progress))
+
+    def at(self, t: float) -> Tuple[str | None, float]:
+        start, song, progress, playing = self.segments[bisect.bisect_right(self.starts, t) - 1]
+        return song, progress + (t - start if playing else 0.0)
+
+    def samples(self, state: main.PlaybackState, rng: random.Random) -> Iterator[main.TraceSample]:
+        """Samples at the tick times update() would use given what `state` detected so far, with a little scheduling jitter."""
+        t = 0.0
+        while t < self.end:
+            song, progress = self.at(t)
+            yield main.TraceSample(t, song, progress)
+            t += (main.idle_interval if song is None else state.next_interval(t)) + rng.uniform(0, 0.02)
+
+    @staticmethod
+    def shows(payload: dict | None, t: float, kind: str, song: str | None, progress: float) -> bool:
+        if kind in ('idle', 'exit'):
+            return payload is None
+        if payload is None or payload['details'].strip() != song:
+            return False
+        if kind == 'pause':
+            return payload['small_image'] == 'pause'
+        return payload['small_image'] == 'play' and abs(payload['start'] - (t - progress)) <= 2
+
+    def check(self, sent: List[Tuple[float, dict | None]]) -> Tuple[Counter, int]:
+        """Events after which presence did not show the right thing within max_latency, by kind, and the number of sends no event accounts for."""
+        times = [t for t, _ in sent]
+        missed, matched = Counter(), 0
+        for i, (t, kind, song, progress) in enumerate(self.events):
+            deadline = min(t + self.max_latency, self.events[i + 1][0] if i + 1 < len(self.events) else float('inf'))
+            first, last = bisect.bisect_left(times, t), bisect.bisect_left(times, deadline)
+            shown = sent[last - 1][1] if last else None  # presence in effect at the deadline, nothing shown before the first send
+            if not self.shows(shown, t, kind, song, progress):
+                missed[kind] += 1
+            elif any(self.shows(payload, t, kind, song, progress) for _, payload in sent[first:last]):
+                matched += 1
+        return missed, len(sent) - matched
+
+
+def history_entry(rng: random.Random, song_id: int, artist_count: int = 2000, album_count: int = 5000) -> dict:
+    """An entry of NCM's webdata/file/history with the fields the real file has, most of which SongInfo doesn't need.
+    Artists and albums are drawn from pools of `artist_count` and `album_count`, so tracks share them like in a real history."""
+    album_id = rng.randrange(album_count)
+    artists = [{'name': f'Artist {artist_id}', 'id': artist_id, 'picId': 0, 'img1v1Id': 0, 'briefDesc': '', 'picUrl': '',
+                'img1v1Url': 'https://p1.music.126.net/6y-UleORITEDbvrOLV0Q8A==/5639395138885805.jpg', 'albumSize': 0, 'alias': [], 'trans': '', 'musicSize': 0}
+               for artist_id in sorted({rng.randrange(artist_count) for _ in range(rng.randint(1, 3))})]
+    album = {'name': f'Album {album_id}', 'id': album_id, 'type': 'Album', 'size': rng.randint(1, 20), 'picId': rng.randrange(10 ** 16),
+             'blurPicUrl': f'https://p2.music.126.net/{rng.randbytes(16).hex()}/{rng.randrange(10 ** 16)}.jpg', 'companyId': 0, 'pic': rng.randrange(10 ** 16),
+             'picUrl': f'https://p2.music.126.net/{album_id:032x}/{album_id * 7919}.jpg', 'publishTime': rng.randrange(10 ** 12),
+             'description': '', 'tags': '', 'company': '', 'briefDesc': '', 'artist': artists[0], 'songs': [], 'alias': [], 'status': 0, 'copyrightId': 0,
+             'commentThreadId': f'R_AL_3_{rng.randrange(10 ** 8)}', 'artists': artists, 'subType': '录音室版'}
+    track = {'name': f'Song {song_id}', 'id': song_id, 'position': 0, 'alias': [], 'status': 0, 'fee': 8, 'copyrightId': 0, 'disc': '01', 'no': 1,
+             'artists': artists, 'album': album, 'starred': False, 'popularity': 100.0, 'score': 100, 'starredNum': 0, 'duration': rng.randrange(120000, 360000),
+             'playedNum': 0, 'dayPlays': 0, 'hearTime': 0, 'ringtone': '', 'crbt': None, 'audition': None, 'copyFrom': '', 'commentThreadId': f'R_SO_4_{song_id}',
+             'rtUrl': None, 'ftype': 0, 'rtUrls': [], 'copyright': 1, 'mvid': 0, 'rtype': 0, 'rurl': None, 'mp3Url': None}
+    return {'track': track, 'playtime': rng.randrange(10 ** 12), 'source': {'type': 'list', 'id': rng.randrange(10 ** 9), 'name': 'Playlist'}}
+
+
+def peak_memory(fn: Callable[[], object]) -> int:
+    """Peak bytes allocated by Python while `fn` runs, on top of what was allocated before."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_history(args):
+    """Song lookups and index builds over a synthetic history file with --entries entries, streamed with iter_json_array
+    and as before, with the whole document loaded by orjson.loads(f.read())."""
+    rng = random.Random(0)
+    song_ids = [rng.randrange(10 ** 9, 2 * 10 ** 9) for _ in range(args.entries)]
+
+    def song_info(track: dict) -> main.SongInfo:
+        return main.SongInfo.create(track['album']['picUrl'], track['album']['name'], track['duration'] / 1000, '/'.join([x['name'] for x in track['artists']]), track['name'])
+
+    def lookup_before(path: str, song_id: str) -> main.SongInfo | None:
+        with open(path, 'rb') as f:
+            entries = orjson.loads(f.read())
+        for entry in entries:
+            if str(entry['track']['id']) == song_id:
+                return song_info(entry['track'])
+        return None
+
+    def build_before(path: str) -> dict:
+        with open(path, 'rb') as f:
+            entries = orjson.loads(f.read())
+        return {str(entry['track']['id']): song_info(entry['track']) for entry in entries}
+
+    def build_streaming(path: str) -> dict:
+        index = main.TrackFileIndex(path, main.parse_history)
+        index.refresh()
+        return index.tracks
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'history')
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps([history_entry(rng, song_id) for song_id in song_ids]))
+        print(f'{args.entries} entries, {os.path.getsize(path) / 2 ** 20:.1f} MB')
+        index = main.TrackFileIndex(path, main.parse_history)
+        number = max(args.number // 10000, 1)
+        for name, song_id in (('newest entry', str(song_ids[0])), ('middle entry', str(song_ids[len(song_ids) // 2])), ('missing', '1')):
+            assert index.find(song_id) == lookup_before(path, song_id)
+            print(f'lookup of the {name}: streaming {timeit(lambda: index.find(song_id), number) * 1e3:.2f} ms, peak {peak_memory(lambda: index.find(song_id)) / 2 ** 20:.2f} MB; '
+                  f'orjson.loads(f.read()) {timeit(lambda: lookup_before(path, song_id), number) * 1e3:.2f} ms, peak {peak_memory(lambda: lookup_before(path, song_id)) / 2 ** 20:.2f} MB')
+        print(f'index build: streaming {timeit(lambda: build_streaming(path), number) * 1e3:.2f} ms, peak {peak_memory(lambda: build_streaming(path)) / 2 ** 20:.2f} MB; '
+              f'orjson.loads(f.read()) {timeit(lambda: build_before(path), number) * 1e3:.2f} ms, peak {peak_memory(lambda: build_before(path)) / 2 ** 20:.2f} MB')
+
+
+def bench_song_info(args):
+    """Memory per SongInfo held in the caches, built from --entries parsed history entries as before (a dict with five keys) and as the
+    interned SongInfo tuple. Each entry is parsed on its own, like the streaming loaders do, so equal strings aren't shared by the parser."""
+    rng = random.Random(0)
+    raw_entries = [orjson.dumps(history_entry(rng, rng.randrange(10 ** 9, 2 * 10 ** 9))) for _ in range(args.entries)]
+
+    def before(track: dict) -> dict:
+        return {'cover': track['album']['picUrl'], 'album': track['album']['name'], 'duration': track['duration'] / 1000,
+                'artist': '/'.join([x['name'] for x in track['artists']]), 'title': track['name']}
+
+    def after(track: dict) -> main.SongInfo:
+        return main.SongInfo.create(track['album']['picUrl'], track['album']['name'], track['duration'] / 1000, '/'.join([x['name'] for x in track['artists']]), track['name'])
+
+    results = {}
+    for name, build in (('dict', before), ('SongInfo', after)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        song_infos = [build(orjson.loads(raw)['track']) for raw in raw_entries]
+        seconds = time.perf_counter() - start
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        stored = sum(len(orjson.dumps(song_info if isinstance(song_info, dict) else tuple(song_info))) for song_info in song_infos)
+        results[name] = retained
+        print(f'{name}: {retained / len(song_infos):.0f} bytes per entry in memory, {stored / len(song_infos):.0f} bytes per cache row, '
+              f'{seconds / len(song_infos) * 1e6:.2f} us to build')
+        del song_infos
+    print(f"{args.entries} entries: SongInfo takes {results['SongInfo'] / results['dict']:.0%} of the memory of dicts")
+
+
+def bench_song_cache(args):
+    """SongInfoCache in front of an in-memory database with a cap of 100 entries and 16 in memory. Least recently used entries have to be
+    evicted on flush, NetEase entries have to expire while file entries don't, a startup-sized put_many() must not evict played songs
+    and a lookup has to count as a miss instead of waiting while the database is busy. Then the cost of lookups and of a flush."""
+    rng = random.Random(0)
+    song_ids = [str(song_id) for song_id in rng.sample(range(10 ** 9, 2 * 10 ** 9), 700)]
+    played, history = song_ids[:120], song_ids[120:]
+    song_info = main.SongInfo.create(None, 'Album', 240.0, 'Artist', 'Title')
+    cache = main.SongInfoCache(':memory:', max_entries=100, memory_entries=16, netease_ttl=60)
+
+    def rows() -> dict:
+        return {song_id: (source, accessed_at) for song_id, source, accessed_at in cache.db.execute('SELECT id, source, accessed_at FROM song_info')}
+
+    try:
+        for song_id in played[:100]:
+            cache.put(song_id, song_info, 'history')
+        cache.flush()
+        for song_id in played[:10]:  # played again, more recently used than the rest
+            cache.get(song_id)
+        cache.flush()
+        for song_id in played[100:]:
+            cache.put(song_id, song_info, 'netease')
+        cache.flush()
+        cached = rows()
+        evicted = set(played) - set(cached)
+        if len(cached) != cache.max_entries or len(evicted) != 20 or not evicted <= set(played[10:100]):
+            raise AssertionError(f'{len(cached)} entries cached after evicting {len(evicted)}, expected {cache.max_entries} with 20 of the least recently used ones evicted')
+        if len(cache.memory) > cache.memory_entries or list(cache.memory)[-1] != played[-1]:
+            raise AssertionError(f'{len(cache.memory)} entries in memory ending with {list(cache.memory)[-1:]}, expected at most {cache.memory_entries} ending with the last put')
+
+        expired = time.time() - 2 * cache.netease_ttl
+        with cache.db:
+            cache.db.execute('UPDATE song_info SET fetched_at = ?', (expired,))
+        cache.memory.clear()
+        if cache.get(played[-1]) is not None or cache.get(played[0]) is None:
+            raise AssertionError('A NetEase entry past its TTL was returned or a history entry expired')
+        cache.memory[played[-2]] = (song_info, 'netease', expired)
+        if cache.get(played[-2]) is not None:
+            raise AssertionError('A NetEase entry past its TTL was returned from memory')
+
+        cache.flush()
+        before = rows()
+        refreshed = main.SongInfo.create(None, 'Album', 240.0, 'Artist', 'Title (Remastered)')
+        cache.put_many([(played[0], refreshed)] + [(song_id, song_info) for song_id in history], 'history')
+        after = rows()
+        if set(after) != set(before) or after[played[0]][1] != before[played[0]][1] or cache.get(played[0]) != refreshed:
+            raise AssertionError(f'put_many() changed the cached songs from {len(before)} to {len(after)}, or refreshed a played song without keeping its access time')
+
+        cache.flush()
+        busy = next(song_id for song_id in after if song_id not in cache.memory and song_id not in played[100:])
+        with cache.db_lock:
+            start = time.perf_counter()
+            if cache.get(busy) is not None:
+                raise AssertionError('A lookup waited for a busy database')
+            waited = time.perf_counter() - start
+        if cache.get(busy) is None:
+            raise AssertionError('A cached song was missed once the database was free again')
+
+        in_memory = timeit(lambda: cache.get(played[0]), args.number)
+        from_db = timeit(lambda: (cache.memory.pop(busy, None), cache.get(busy)), args.number)
+        flush = timeit(lambda: (cache.get(busy), cache.flush()), args.number // 10 or 1)
+        print(f'{in_memory * 1e6:.2f} us per lookup from memory, {from_db * 1e6:.2f} us from the database, '
+              f'{waited * 1e6:.2f} us for a miss while the database is busy, {flush * 1e6:.2f} us per lookup and flush')
+    finally:
+        cache.close()
+
+
+def bench_file_watcher(args):
+    """FileWatcher.poll() over a history file in a temporary directory, with the clock passed in. A change must only be read once the file
+    has stopped changing for the debounce time, a rewrite with the same content pushes nothing, and pushed tracks have to be in the
+    cache's memory and written to its database. Then the cost of polling an unchanged file and of pushing --entries tracks on startup."""
+    rng = random.Random(0)
+    history = [history_entry(rng, song_id) for song_id in rng.sample(range(10 ** 9, 2 * 10 ** 9), max(args.entries, 100))]
+    song_ids = [str(entry['track']['id']) for entry in history]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'history')
+        mtime = time.time_ns()
+
+        def write(entries: List[dict]):
+            nonlocal mtime
+            with open(path, 'wb') as f:
+                f.write(orjson.dumps(entries))
+            mtime += 10 ** 9  # a new stamp per write however coarse the file system's timestamps are
+            os.utime(path, ns=(mtime, mtime))
+
+        cache = main.SongInfoCache(':memory:')
+        watcher = main.FileWatcher([('history', main.TrackFileIndex(path, main.parse_history))], cache, debounce=0.5)
+        try:
+            write(history[:50])
+            pushed = [watcher.poll(0.0), watcher.poll(0.4)]
+            write(history[:60])  # NCM is still writing the file
+            pushed += [watcher.poll(0.6), watcher.poll(1.0)]
+            if any(pushed):
+                raise AssertionError(f'Pushed {pushed} tracks before the file stopped changing for {watcher.debounce} s')
+            pushed = watcher.poll(1.1)
+            if pushed != 60:
+                raise AssertionError(f'Pushed {pushed} tracks once the file settled, expected 60')
+            missing = [song_id for song_id in song_ids[:60] if cache.memory.get(song_id, (None, None))[1] != 'history']
+            if missing:
+                raise AssertionError(f'{len(missing)} pushed tracks not in the cache\'s memory, e.g. {missing[:3]}')
+            written = {song_id for song_id, in cache.db.execute('SELECT id FROM song_info')}
+            if written != set(song_ids[:60]):
+                raise AssertionError(f'{len(written)} tracks written to the database, expected the 60 pushed ones')
+            with cache.db_lock:  # the first lookup of a pushed track doesn't need the database
+                if cache.get(song_ids[0]) is None:
+                    raise AssertionError('A pushed track was missed while the database was busy')
+
+            write(history[:60])  # NCM rewrites the file unchanged
+            pushed = [watcher.poll(2.0), watcher.poll(2.5)]
+            if any(pushed) or watcher.changes:
+                raise AssertionError(f'Pushed {pushed} tracks from an unchanged rewrite, {len(watcher.changes)} changes left pending')
+            write(history[60:65] + history[:60])  # five songs played
+            pushed = [watcher.poll(3.0), watcher.poll(3.5)]
+            if pushed != [0, 5]:
+                raise AssertionError(f'Pushed {pushed} tracks after five songs were played, expected [0, 5]')
+
+            idle = timeit(lambda: watcher.poll(4.0), args.number)
+            write(history)
+            watcher.poll(5.0)
+            start = time.perf_counter()
+            pushed = watcher.poll(5.5)
+            seconds = time.perf_counter() - start
+            print(f'{idle * 1e6:.2f} us per poll of an unchanged file, {seconds * 1e3:.1f} ms to push {pushed} new tracks of a {len(history)} entry history')
+        finally:
+            cache.close()
+
+
+def bench_logging(args):
+    """update() latency against a V2 snapshot with debug logging off, on through the queued pipeline (console and rotating debug.log
+    written by the listener thread) and on as before, with the console and a FileHandler written on the ticking thread.
+    Measured for steady playback, where nothing is logged, and for ticks that each start from a fresh PlaybackState,
+    so each one detects a song change and logs it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'v2.snap')
+        make_v2_snapshot(path)
+        reader = open_snapshot(path)
+
+        class Process:
+            info = {'name': 'cloudmusic.exe', 'pid': reader.snapshot_pid, 'create_time': 0.0}
+            cmdline = exe = lambda self: path
+
+        main.supervisor.reader_factory = lambda: reader
+        main.process_watcher.process_iter = lambda attrs=None: [Process()]
+        main.process_watcher.version_reader = lambda exe_path: reader.version
+        main.song_info_cache = main.resolver.cache = main.SongInfoCache(':memory:')
+        main.song_info_cache.put('1234567890', main.SongInfo.create(None, 'Album', 240.0, 'Artist', 'Title'), 'history')
+        main.update(lambda: None)  # finds the process and resolves its offsets
+        console = open(os.devnull, 'w', encoding='utf-8')
+        log_path = os.path.join(tmp, 'debug.log')
+
+        def queued(level: int, *handlers: logging.Handler) -> Tuple[int, List[logging.Handler], main.BatchingQueueListener]:
+            log_queue = queue.SimpleQueue()
+            return level, [main.LocalQueueHandler(log_queue)], main.BatchingQueueListener(log_queue, *handlers)
+
+        modes = {
+            'off': lambda: queued(logging.INFO, logging.StreamHandler(console)),
+            'queued': lambda: queued(logging.DEBUG, logging.StreamHandler(console), main.RotatingFileHandler(log_path, maxBytes=5 * 2 ** 20, backupCount=2, encoding='utf-8')),
+            'synchronous (before)': lambda: (logging.DEBUG, [logging.StreamHandler(console), logging.FileHandler(log_path, encoding='utf-8')], None),
+        }
+        original = main.logger.level, main.logger.handlers[:]
+        ticks = {(scenario, name): [] for scenario in ('steady', 'song change') for name in modes}
+        for _ in range(10):  # modes take turns, so that drift of the machine doesn't favour one of them
+            for (scenario, name), scenario_ticks in ticks.items():
+                level, handlers, listener = modes[name]()
+                for handler in handlers + (list(listener.handlers) if listener else []):
+                    handler.setFormatter(main.formatter)
+                main.logger.setLevel(level)
+                main.logger.handlers[:] = handlers
+                if listener:
+                    listener.start()
+                for _ in range(max(args.number // 10, 1)):
+                    if scenario == 'song change':
+                        for tracker in main.supervisor.trackers.values():
+                            tracker.playback = main.PlaybackState()
+                    start = time.perf_counter()
+                    main.update(lambda: None)
+                    scenario_ticks.append(time.perf_counter() - start)
+                    time.sleep(0.002)  # ticks are at least fast_interval apart in the app, the listener writes in between
+                if listener:
+                    listener.stop()  # writes what is still queued, outside of the measured ticks
+                for handler in handlers + (list(listener.handlers) if listener else []):
+                    handler.close()
+        medians = {}
+        for (scenario, name), scenario_ticks in ticks.items():
+            scenario_ticks.sort()
+            medians[scenario, name] = statistics.median(scenario_ticks)
+            print(f'{scenario}, {name}: tick median {medians[scenario, name] * 1e6:.1f} us, p99 {scenario_ticks[len(scenario_ticks) * 99 // 100] * 1e6:.1f} us, '
+                  f'max {scenario_ticks[-1] * 1e3:.2f} ms')
+        main.logger.setLevel(original[0])
+        main.logger.handlers[:] = original[1]
+        console.close()
+        main.supervisor.close()
+        for scenario in ('steady', 'song change'):
+            print(f"{scenario}: debug logging through the queue takes {medians[scenario, 'queued'] / medians[scenario, 'off']:.0%} of the tick time without it, "
+                  f"synchronous logging {medians[scenario, 'synchronous (before)'] / medians[scenario, 'off']:.0%}")
+
+
+class NeteaseStubHandler(BaseHTTPRequestHandler):
+    """Song detail API stand-in that counts requests and connections. It takes a JSON list of IDs and knows all but IDs
+    starting with 9 (like cloud drive uploads). A batch with an ID starting with 8 is answered after 2 s, longer than the timeouts,
+    one with an ID starting with 7 is rate limited."""
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+    counts = Counter()
+
+    def setup(self):
+        super().setup()
+        self.counts['connections'] += 1
+
+    def do_POST(self):
+        self.counts['requests'] += 1
+        song_ids = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if any(song_id.startswith('8') for song_id in song_ids):
+            time.sleep(2)
+        if any(song_id.startswith('7') for song_id in song_ids):
+            body = json.dumps({'code': -460, 'message': 'Cheating'}).encode()
+        else:
+            body = json.dumps({'songs': [{'id': int(song_id), 'name': f'Song {song_id}', 'al': {'name': 'Album', 'picUrl': None}, 'ar': [{'name': 'Artist'}], 'dt': 240000}
+                                         for song_id in song_ids if not song_id.startswith('9')], 'code': 200}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_netease(args):
+    """NetEase lookups against a local stub server, with songs it knows and IDs it doesn't coming back into rotation 10 times,
+    through a session pooled like pyncm's. Compared with retrying every lookup, as before the negative cache."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NeteaseStubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/song/detail'
+    session = requests.Session()
+    main.pool_netease_session(session, timeout=(0.5, 0.5))
+
+    class TrackApi:
+        @staticmethod
+        def GetTrackDetail(song_ids: List[str]) -> dict:
+            return session.post(url, json=song_ids).json()
+
+    original = main.apis.track, main.netease_misses
+    main.apis.track = TrackApi
+    rotation = [str(10 ** 9 + i) for i in range(20)] + [str(9 * 10 ** 9 + i) for i in range(5)]
+    for name, misses in (('negative cache', main.NegativeCache()), ('retrying every lookup (before)', main.NegativeCache(0, 0, 0, 0))):
+        main.netease_misses = misses
+        NeteaseStubHandler.counts.clear()
+        start = time.perf_counter()
+        found = sum(main.lookup_netease(song_id) is not None for _ in range(10) for song_id in rotation)
+        seconds = time.perf_counter() - start
+        print(f'{name}: {10 * len(rotation)} lookups, {found} found, {NeteaseStubHandler.counts["requests"]} requests '
+              f'over {NeteaseStubHandler.counts["connections"]} new connections, {seconds / (10 * len(rotation)) * 1e3:.2f} ms per lookup')
+    main.netease_misses = main.NegativeCache()
+    start = time.perf_counter()
+    slow = [main.lookup_netease('8000000000') for _ in range(3)]
+    print(f'Unresponsive server: 3 lookups returned {slow} in {time.perf_counter() - start:.2f} s, the first one timed out and the others were backed off')
+    for song_id, backoff, answer in (('7000000000', main.netease_misses.error_backoff, 'rate limited'), ('9000000000', main.netease_misses.not_found_backoff, 'not found')):
+        if main.lookup_netease(song_id) is not None or not main.netease_misses.entries[song_id][0] - time.time() <= backoff:
+            raise AssertionError(f'A {answer} lookup was not backed off by {backoff} s')
+    print(f'Rate limited lookups are backed off {main.netease_misses.error_backoff:.0f} s like failed requests, songs NetEase does not know '
+          f'{main.netease_misses.not_found_backoff:.0f} s')
+    main.apis.track, main.netease_misses = original
+    session.close()
+    server.shutdown()
+
+
+class CountingTrackApi:
+    """pyncm's apis.track, knowing every song and keeping the IDs of each request."""
+
+    def __init__(self):
+        self.requests: List[List[str]] = []
+
+    def GetTrackDetail(self, song_ids: List[str]) -> dict:
+        self.requests.append(list(song_ids))
+        return {'songs': [{'id': int(song_id), 'name': f'Song {song_id}', 'al': {'name': 'Album', 'picUrl': None}, 'ar': [{'name': 'Artist'}], 'dt': 240000}
+                          for song_id in song_ids], 'code': 200}
+
+
+def bench_prefetch(args):
+    """Prefetcher over playingList and history files in a temporary directory, with apis.track stubbed. The upcoming tracks have to end up
+    in the cache, taken from the files where they have song info and fetched from NetEase in batches otherwise, and nothing is fetched twice.
+    Then the lookups of the prefetched songs, as the update tick does them on a song change."""
+    rng = random.Random(0)
+    queue_ids = [str(rng.randrange(10 ** 9, 2 * 10 ** 9)) for _ in range(1000)]
+    # A third of the queue has no song info in playingList, half of those are in the history
+    playing_list = {'list': [{'id': int(song_id), **({} if i % 3 == 0 else {'track': {**history_entry(rng, int(song_id))['track'], 'album': {'name': 'Album', 'cover': None}}})}
+                             for i, song_id in enumerate(queue_ids)]}
+    history = [history_entry(rng, int(song_id)) for i, song_id in enumerate(queue_ids) if i % 6 == 0]
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {name: os.path.join(tmp, name) for name in ('playingList', 'history')}
+        for name, document in (('playingList', playing_list), ('history', history)):
+            with open(paths[name], 'wb') as f:
+                f.write(orjson.dumps(document))
+        playing_list_index, history_index = main.TrackFileIndex(paths['playingList'], main.parse_playing_list), main.TrackFileIndex(paths['history'], main.parse_history)
+        playing_list_index.refresh()  # as FileWatcher keeps them
+        history_index.refresh()
+        original = main.netease_misses
+        main.netease_misses = main.NegativeCache()
+        try:
+            for count, start, batch_size in ((10, 0, main.netease_batch_size), (200, 950, 10)):  # the second one wraps around the end of the queue, both fit in the cache's memory
+                cache, track_api = main.SongInfoCache(':memory:'), CountingTrackApi()
+                prefetcher = main.Prefetcher(playing_list_index, [('history', history_index), ('playing_list', playing_list_index)], cache, track_api, count=count, batch_size=batch_size)
+                upcoming = [queue_ids[(start + i) % len(queue_ids)] for i in range(1, count + 1)]
+                expected = {song_id: {0: 'history', 3: 'netease'}.get(queue_ids.index(song_id) % 6, 'playing_list') for song_id in upcoming}
+                missing = [song_id for song_id in upcoming if expected[song_id] == 'netease']
+                seconds = timeit(lambda: prefetcher.prefetch(queue_ids[start]), 1)
+                if [song_id for request in track_api.requests for song_id in request] != missing or any(len(request) > prefetcher.batch_size for request in track_api.requests):
+                    raise AssertionError(f'Fetched {track_api.requests} from NetEase, expected {missing} in batches of at most {prefetcher.batch_size}')
+                sources = {song_id: cache.memory[song_id][1] if song_id in cache.memory else None for song_id in upcoming}
+                wrong = {song_id: source for song_id, source in sources.items() if source != expected[song_id]}
+                if wrong:
+                    raise AssertionError(f'{len(wrong)} songs cached from the wrong source, e.g. {list(wrong.items())[:3]}')
+                requests = len(track_api.requests)
+                if prefetcher.prefetch(queue_ids[start]) or len(track_api.requests) != requests:
+                    raise AssertionError('Prefetching the same songs again asked NetEase again')
+                hits = timeit(lambda: [cache.get(song_id) for song_id in upcoming], args.number // 100 or 1)
+                print(f'{count} upcoming: {count - len(missing)} from the files, {len(missing)} from NetEase in {len(track_api.requests)} requests, '
+                      f'{seconds * 1e3:.1f} ms; then {hits / count * 1e6:.2f} us per cache hit on a song change')
+                cache.close()
+        finally:
+            main.netease_misses = original
+
+
+class CountingSource:
+    """Lookup source of SongInfoResolver taking `delay` seconds per lookup and finding the songs in `songs`, keeping the IDs it was asked for."""
+
+    def __init__(self, songs: Tuple[str, ...] = (), delay: float = 0.0):
+        self.songs = songs
+        self.delay = delay
+        self.calls: List[str] = []
+        self.lock = Lock()
+
+    def __call__(self, song_id: str) -> main.SongInfo | None:
+        with self.lock:
+            self.calls.append(song_id)
+        time.sleep(self.delay)
+        return main.SongInfo.create(None, 'Album', 240.0, 'Artist', f'Song {song_id}') if song_id in self.songs else None
+
+
+def bench_resolver(args):
+    """SongInfoResolver over stub sources. Concurrent lookups of a song have to share one, the first source to find it wins and is cached,
+    a hanging source is given up on after its timeout and songs no source found are not looked up again until forgotten.
+    Then the cost of a resolve that is answered from the cache, as the update tick does it."""
+
+    async def run():
+        fast, slow, hanging = CountingSource(('1',), 0.01), CountingSource(('1', '2'), 0.2), CountingSource(('1', '2', '3'), 2.0)
+        resolver = main.SongInfoResolver([('fast', fast), ('slow', slow), ('hanging', hanging)], main.SongInfoCache(':memory:'), asyncio.get_running_loop(),
+                                         timeouts={'fast': 1.0, 'slow': 1.0, 'hanging': 0.3})
+        try:
+            futures = [resolver.resolve('1') for _ in range(10)]
+            if any(future is not futures[0] for future in futures):
+                raise AssertionError('Concurrent resolves of the same song started separate lookups')
+            song_info = await futures[0]
+            if song_info is None or song_info.title != 'Song 1' or (fast.calls, slow.calls, hanging.calls) != (['1'], ['1'], ['1']):
+                raise AssertionError(f'Resolved {song_info}, sources asked for {fast.calls}, {slow.calls}, {hanging.calls}, expected each asked once')
+            if resolver.cache.memory.get('1', (None, None))[1] != 'fast':
+                raise AssertionError(f'Cached {resolver.cache.memory.get("1")}, expected the song info of the fast source')
+            cached = resolver.resolve('1')
+            if not cached.done() or cached.result() is not song_info or len(fast.calls) != 1:
+                raise AssertionError('A cached song was looked up again')
+
+            start = time.perf_counter()
+            song_info = await resolver.resolve('3')  # only the hanging source knows it
+            waited = time.perf_counter() - start
+            if song_info is not None or not 0.3 <= waited < hanging.delay:
+                raise AssertionError(f'Resolved {song_info} after {waited:.2f} s, expected a miss after the 0.3 s timeout of the hanging source')
+            missed = resolver.resolve('3')
+            if not missed.done() or missed.result() is not None or fast.calls.count('3') != 1:
+                raise AssertionError('A missed song was looked up again before being forgotten')
+            resolver.forget('3')
+            if resolver.resolve('3').done():
+                raise AssertionError('A forgotten miss was not looked up again')
+            await resolver.resolve('3')
+
+            song_info = await resolver.resolve('2')  # the slow source wins when the fast one doesn't know the song
+            if song_info is None or resolver.cache.memory['2'][1] != 'slow':
+                raise AssertionError(f'Resolved {song_info}, expected the song info of the slow source')
+            print(f'{waited * 1e3:.0f} ms to give up on a hanging source with a timeout of {resolver.timeouts["hanging"] * 1e3:.0f} ms')
+            hits = timeit(lambda: resolver.resolve('1'), args.number)
+            print(f'{hits * 1e6:.2f} us per resolve answered from the cache')
+        finally:
+            resolver.pool.shutdown(wait=False)
+            resolver.cache.close()
+
+    asyncio.run(run())
+
+
+class FakeDiscordHandler(socketserver.StreamRequestHandler):
+    """One client connection of FakeDiscord, speaking Discord's IPC framing: little-endian op code and length, then JSON."""
+
+    def handle(self):
+        self.server.opened(self.request)
+        clients = 0  # pypresence also connects without a handshake to probe for the socket
+        try:
+            while True:
+                header = self.rfile.read(8)
+                if len(header) < 8:
+                    break
+                op, length = struct.unpack('<II', header)
+                payload = json.loads(self.rfile.read(length))
+                if op == 0:
+                    clients += 1
+                    self.server.record('handshake')
+                    self.reply({'cmd': 'DISPATCH', 'evt': 'READY', 'data': {'v': 1}})
+                elif op == 1:
+                    activity = payload['args'].get('activity')
+                    self.server.record('clear' if activity is None else 'update', activity)
+                    self.reply({'cmd': payload['cmd'], 'evt': None, 'data': activity, 'nonce': payload['nonce']})
+                elif op == 2:
+                    self.server.record('close')
+        except OSError:  # dropped by FakeDiscord.drop()
+            pass
+        finally:
+            self.server.closed(self.request, clients)
+
+    def reply(self, payload: dict):
+        body = json.dumps(payload).encode()
+        self.wfile.write(struct.pack('<II', 1, len(body)) + body)
+
+
+class FakeDiscord(socketserver.ThreadingUnixStreamServer):
+    """Discord's IPC socket, listening where pypresence looks for it. Records what clients send and when they hang up."""
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, FakeDiscordHandler)
+        self.condition = threading.Condition()
+        self.events = Counter()
+        self.activities = []
+        self.connections = set()
+
+    def record(self, event: str, activity: dict | None = None):
+        with self.condition:
+            self.events[event] += 1
+            if event == 'update':
+                self.activities.append(activity)
+            self.condition.notify_all()
+
+    def opened(self, connection):
+        with self.condition:
+            self.connections.add(connection)
+
+    def closed(self, connection, clients: int):
+        with self.condition:
+            self.connections.discard(connection)
+        if clients:
+            self.record('hangup')
+
+    def wait(self, event: str, count: int, timeout: float = 5):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.events[event] >= count, timeout):
+                raise AssertionError(f'Discord saw {self.events[event]} {event} events, expected {count}: {dict(self.events)}')
+
+    def drop(self):
+        """Discord quits, the pipes of all clients break."""
+        with self.condition:
+            for connection in self.connections:
+                connection.shutdown(socket.SHUT_RDWR)
+
+
+def bench_discord_ipc(args):
+    """PresencePublisher with a real AioPresence against a fake Discord IPC socket (FakeDiscord), through sends, disconnects
+    with close_presence, reconnects and Discord dropping the pipe. Checks that every disconnect hangs up the pipe and leaves
+    the shared event loop running, and that --number connect/disconnect cycles leave no open file descriptors behind."""
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Needs Unix domain sockets, pypresence talks to Discord through a named pipe on Windows')
+        sys.exit(1)
+    cycles = max(args.number // 100, 10)
+    with tempfile.TemporaryDirectory() as tmp:
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = tmp  # where pypresence looks for discord-ipc-*
+        discord = FakeDiscord(os.path.join(tmp, 'discord-ipc-0'))
+        Thread(target=discord.serve_forever, daemon=True).start()
+        presence = main.AioPresence(main.client_id, loop=main.core.loop)
+        publisher = main.PresencePublisher(presence, main.core, rate=10 ** 6, period=1)  # no rate limit, Discord is not the one measured
+        payload = lambda i: main.presence_payload(0, str(10 ** 9 + i), main.SongInfo(None, 'Album', 240.0, 'Artist', f'Song {i}'), main.Status.playing, 10.0, time.time())
+        try:
+            publisher.start()
+            start = time.perf_counter()
+            for i in range(cycles):
+                publisher.publish(payload(i))
+                discord.wait('update', i + 1)
+            send_seconds = (time.perf_counter() - start) / cycles
+            if discord.events['handshake'] != 1:
+                raise AssertionError(f"{discord.events['handshake']} handshakes for one connection")
+
+            discord.drop()
+            publisher.publish(payload(cycles))  # finds the pipe broken and reconnects
+            discord.wait('update', cycles + 1)
+            handshakes = discord.events['handshake']
+
+            fds = psutil.Process().num_fds()
+            start = time.perf_counter()
+            for i in range(cycles):
+                publisher.disconnect()
+                discord.wait('close', i + 1)
+                discord.wait('hangup', i + 2)  # plus the dropped connection
+                publisher.publish(payload(cycles + 1 + i))
+                discord.wait('update', cycles + 2 + i)
+            cycle_seconds = (time.perf_counter() - start) / cycles
+            if discord.events['handshake'] != handshakes + cycles:
+                raise AssertionError(f"{discord.events['handshake'] - handshakes} handshakes for {cycles} reconnects")
+            main.core.run(asyncio.sleep(0.1))  # closed transports release their sockets on the loop, which must still be running
+            if psutil.Process().num_fds() > fds:
+                raise AssertionError(f'{psutil.Process().num_fds() - fds} file descriptors leaked over {cycles} disconnects')
+            print(f'{cycles} presence sends: {send_seconds * 1e3:.2f} ms from publish() to Discord; reconnected after Discord dropped the pipe; '
+                  f'{cycles} disconnect/reconnect cycles: {cycle_seconds * 1e3:.2f} ms each, every pipe hung up, no file descriptors left open')
+        finally:
+            publisher.disconnect()
+            publisher.stop()
+            discord.shutdown()
+            discord.server_close()
+            if runtime_dir is None:
+                del os.environ['XDG_RUNTIME_DIR']
+            else:
+                os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+
+
+class SoakClock:
+    """Stands in for the time module in main: time() and monotonic() follow the simulated clock, the rest is real."""
+    perf_counter = staticmethod(time.perf_counter)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, start: float):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class SoakNcm:
+    """The simulated NCM: whether its process runs and which song of an endless queue it plays, derived from the clock when read."""
+
+    def __init__(self, rng: random.Random, clock: SoakClock, songs: List[str]):
+        self.rng = rng
+        self.clock = clock
+        self.songs = songs
+        self.lock = Lock()
+        self.pid = 0  # 0 while NCM is not running
+        self.next_pid = 1000
+        self.song = ''
+        self.duration = 0.0
+        self.started = 0.0  # clock time at which the song would have been at 0:00 had it never been paused
+        self.paused_at: float | None = None  # progress the song is paused at
+
+    def next_song(self, started: float):
+        self.song = self.rng.choice(self.songs)
+        self.duration = self.rng.uniform(120, 360)
+        self.started = started
+        self.paused_at = None
+
+    def launch(self):
+        with self.lock:
+            self.pid, self.next_pid = self.next_pid, self.next_pid + 4  # a new PID on every start, like Windows hands out
+            self.next_song(self.clock.now)
+
+    def exit(self):
+        self.pid = 0
+
+    def skip(self):
+        with self.lock:
+            self.next_song(self.clock.now)
+
+    def pause(self):
+        with self.lock:
+            self.paused_at = self.state()[1]
+
+    def resume(self):
+        with self.lock:
+            self.started = self.clock.now - self.paused_at
+            self.paused_at = None
+
+    def state(self) -> Tuple[str, float]:
+        """(song ID, progress) right now, having moved on to the next song in the queue when one ended."""
+        if self.paused_at is not None:
+            return self.song, self.paused_at
+        while self.clock.now - self.started >= self.duration:
+            self.next_song(self.started + self.duration)
+        return self.song, self.clock.now - self.started
+
+
+class SoakReader(main.SnapshotReader):
+    """Memory of the simulated NCM: a V3 snapshot with the song playing and its progress written into it on every read.
+    All readers share one copy of the snapshot, opened and closed process handles are counted in `handles`."""
+    handles = Counter()
+
+    def __init__(self, ncm: SoakNcm, image: main.SnapshotReader, memory: bytearray, current_offset: int, song_offset: int):
+        self.ncm = ncm
+        self.data = memory
+        self.data_offset = image.data_offset
+        self.snapshot_pid = image.snapshot_pid
+        self.name = image.name
+        self.version = image.version
+        self.modules = image.modules
+        self.regions = image.regions
+        self.region_starts = image.region_starts
+        self.current_offset = current_offset  # where the schedule double and the song ID string are in `memory`
+        self.song_offset = song_offset
+
+    def pid_exists(self, pid: int) -> bool:
+        return pid == self.ncm.pid
+
+    def process_name(self, pid: int) -> str:
+        return 'cloudmusic.exe' if pid == self.ncm.pid else ''
+
+    def open(self, pid: int):
+        if pid != self.ncm.pid:
+            raise RuntimeError(f'Process {pid} does not exist')
+        self.handles['opened'] += 1
+        self.pid = pid
+
+    def close(self):
+        if self.pid:
+            self.handles['closed'] += 1
+        self.pid = 0
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        if self.pid != self.ncm.pid:
+            raise RuntimeError(f'Could not read {size} bytes at {hex(address)}')  # the process exited
+        with self.ncm.lock:
+            song_id, progress = self.ncm.state()
+        song = f'{song_id}_0'.encode()
+        struct.pack_into('<d', self.data, self.current_offset, progress)
+        struct.pack_into('<16sq', self.data, self.song_offset, song, len(song))  # inline SSO buffer and length
+        return bytes(super().r_bytes(address, size))
+
+
+class SoakDiscord:
+    """Stands in for AioPresence, with a Discord client that runs while `up`."""
+    client_id = main.client_id
+
+    def __init__(self):
+        self.up = True
+        self.connected = False
+        self.sends = 0
+        self.sock_writer = self
+
+    async def connect(self):
+        if not self.up:
+            raise main.DiscordNotFound
+        self.connected = True
+
+    async def update(self, **kwargs):
+        self.send()
+
+    async def clear(self):
+        self.send()
+
+    def send(self):
+        if not self.connected:
+            raise main.PipeClosed
+        self.sends += 1
+
+    def send_data(self, op: int, payload: dict):
+        pass
+
+    def close(self):
+        self.connected = False
+
+    def stop(self):
+        """Discord quits, the pipe breaks."""
+        self.up = self.connected = False
+
+
+class SoakTrackApi:
+    """pyncm's apis.track, knowing all songs but those with an ID divisible by 50 (like cloud drive uploads)."""
+
+    @staticmethod
+    def GetTrackDetail(song_ids: List[str]) -> dict:
+        return {'songs': [{'id': int(song_id), 'name': f'Song {song_id}', 'al': {'name': f'Album {int(song_id) % 997}', 'picUrl': None},
+                           'ar': [{'name': f'Artist {int(song_id) % 499}'}], 'dt': 240000} for song_id in song_ids if int(song_id) % 50], 'code': 200}
+
+
+class SoakVar:
+    """Tk's BooleanVar and StringVar."""
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class SoakRoot:
+    """Tk's root window: callbacks posted with after() run when the harness thread, standing in for Tk's mainloop, drains them.
+    `posted` counts them, each one is a cross-thread wakeup of the real Tk mainloop."""
+
+    def __init__(self):
+        self.callbacks = queue.SimpleQueue()
+        self.posted = 0
+        self.shown = True
+
+    def after(self, ms: int, callback: Callable, *args):
+        self.posted += 1
+        self.callbacks.put((callback, args))
+
+    def drain(self):
+        while True:
+            try:
+                callback, args = self.callbacks.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args)
+
+    def withdraw(self):
+        self.shown = False
+
+    def deiconify(self):
+        self.shown = True
+
+    def destroy(self):
+        pass
+
+
+class SoakTrayIcon:
+    """pystray's Icon, whose run() blocks its thread until stop() like the real one."""
+
+    def __init__(self, name: str, image, title: str, menu=None):
+        self.menu = menu
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class SoakMessagebox:
+    showerror = showinfo = staticmethod(lambda *args: None)
+
+
+def soak_footprint() -> dict:
+    """RSS, Python heap blocks, threads and open handles (file descriptors off Windows) of this process,
+    once the queued log records are written and after a full collection."""
+    while not main.log_queue.empty():  # the simulated hours pass faster than the log listener's batching interval
+        time.sleep(0.01)
+    gc.collect()
+    process = psutil.Process()
+    return {'rss': process.memory_info().rss, 'blocks': sys.getallocatedblocks(), 'threads': threading.active_count(),
+            'handles': process.num_handles() if os.name == 'nt' else process.num_fds(),
+            'ncm_handles': SoakReader.handles['opened'] - SoakReader.handles['closed']}
+
+
+def run_soak(snapshot: str, days: float, seed: int = 0):
+    """The soak test itself, run by bench_soak in a fresh interpreter with its own cache directory.
+    The app runs as shipped, with its event loop, timer, publisher and threads, against a simulated NCM, Discord, Tk and tray icon.
+    Time is simulated: each tick jumps the clock ahead by the interval it would have waited, so days pass in minutes.
+    This thread plays the Tk thread and the user, acting at random times on NCM (skips, pauses, restarts, quitting for hours),
+    Discord (quitting for a while), the enable toggle and the window (minimizing to tray and restoring).
+    Every simulated hour it prints the process footprint as a line of JSON."""
+    rng = random.Random(seed)
+    clock = SoakClock(1.7e9)
+    main.time = clock
+    image = main.SnapshotReader(snapshot)
+    schedule_ptr, audio_player_ptr = main.scan_for_v3_offsets(image)
+    offset_of = lambda address: next(image.data_offset + offset + address - start for start, size, offset in image.regions if start <= address < start + size)
+    current_offset, song_offset = offset_of(schedule_ptr), offset_of(image.r_int64(audio_player_ptr + 0x50) + 0x10)
+    memory = bytearray(image.data)
+    image.close_snapshot()
+
+    ncm = SoakNcm(rng, clock, [str(rng.randrange(10 ** 5, 10 ** 10)) for _ in range(20000)])
+    discord = SoakDiscord()
+    root = SoakRoot()
+    main.supervisor.reader_factory = lambda: SoakReader(ncm, image, memory, current_offset, song_offset)
+
+    class Process:
+        def __init__(self, pid: int, renderer: bool):
+            self.info = {'name': 'cloudmusic.exe', 'pid': pid, 'create_time': float(pid)}
+            self.renderer = renderer
+
+        def cmdline(self) -> List[str]:
+            return [snapshot, '--type=renderer'] if self.renderer else [snapshot]
+
+        def exe(self) -> str:
+            return snapshot
+
+    main.process_watcher.process_iter = lambda attrs=None: [Process(ncm.pid, False), Process(ncm.pid + 1, True)] if ncm.pid else []
+    main.process_watcher.version_reader = lambda exe_path: image.version
+    main.RPC = main.publisher.presence = discord
+    main.apis.track = SoakTrackApi
+    main.root, main.messagebox = root, SoakMessagebox
+    main.TrayIcon, main.TrayMenu = SoakTrayIcon, lambda *items: items
+    main.org_menu, main.enable_item, main.disable_item, main.icon_image = ['show', 'quit'], 'enable', 'disable', None
+    main.icon = SoakTrayIcon('Netease Cloud Music Discord RPC', None, 'Netease Cloud Music Discord RPC', main.org_menu)
+    main.toggle_var, main.song_title_text, main.song_artist_text = SoakVar(False), SoakVar('N/A'), SoakVar('')
+
+    events = []  # heap of (clock time, sequence number, action)
+    sequence = itertools.count()
+    actions = Counter()
+    due = threading.Event()
+    next_at = [0.0]  # the ticks don't run the clock past the next event, set by this thread
+
+    def schedule(after: float, action: str):
+        heapq.heappush(events, (clock.now + after, next(sequence), action))
+
+    def next_interval() -> float:
+        if clock.now >= next_at[0]:  # wait for this thread to act
+            due.set()
+            return 0.05
+        clock.now += main.supervisor.next_interval(clock.now)
+        return 0
+
+    def connect(action: Callable[[], None]):
+        """startup() and enabling with toggle() connect to Discord on the event loop and hand the result back through root.after()."""
+        posted = root.posted
+        action()
+        waited = time.perf_counter()
+        while root.posted == posted:
+            if time.perf_counter() - waited > 30:
+                raise RuntimeError('Connecting to Discord never finished')
+            time.sleep(0.001)
+        root.drain()
+
+    def stop(action: Callable[[], None], stopped: Callable[[], bool]):
+        """Disabling with toggle() and quit_app() stop tracking on the event loop too, and finish on the Tk thread through root.after()."""
+        action()
+        waited = time.perf_counter()
+        while not stopped():
+            if time.perf_counter() - waited > 30:
+                raise RuntimeError('Stopping never finished')
+            root.drain()
+            time.sleep(0.001)
+
+    main.next_interval = next_interval
+    end = clock.now + days * 86400
+    for hour in range(1, int(days * 24) + 1):
+        schedule(hour * 3600, 'checkpoint')
+    schedule(rng.expovariate(1 / 1200), 'user')
+    next_at[0] = events[0][0]
+    ncm.launch()
+    connect(main.startup)
+    print(json.dumps({'day': 0.0, **soak_footprint()}), flush=True)
+    while events and events[0][0] <= end:
+        at, _, action = events[0]
+        if clock.now < at:
+            if not main.toggle_var.get():
+                clock.now = at  # nothing ticks while disabled
+            else:
+                waited = time.perf_counter()
+                while clock.now < at and not due.wait(0.05):
+                    root.drain()
+                    if time.perf_counter() - waited > 30:
+                        raise RuntimeError('The update tick stopped running')
+                due.clear()
+                continue
+        heapq.heappop(events)
+        if action == 'user':
+            action = rng.choices(['skip', 'pause', 'restart', 'quit', 'discord', 'toggle', 'minimize'], [25, 15, 10, 10, 10, 10, 20])[0]
+            schedule(rng.expovariate(1 / 1200), 'user')
+        actions[action] += 1
+        if action == 'checkpoint':
+            print(json.dumps({'day': actions['checkpoint'] / 24, **soak_footprint(), 'actions': actions, 'sends': discord.sends, 'ui_events': root.posted}), flush=True)
+        elif action == 'skip' and ncm.pid and ncm.paused_at is None:
+            ncm.skip()
+        elif action == 'pause' and ncm.pid and ncm.paused_at is None:
+            ncm.pause()
+            schedule(rng.uniform(60, 45 * 60), 'resume')  # some pauses outlast pause_timeout
+        elif action == 'resume' and ncm.pid and ncm.paused_at is not None:
+            ncm.resume()
+        elif action in ('restart', 'quit') and ncm.pid:
+            ncm.exit()
+            schedule(rng.uniform(2, 30) if action == 'restart' else rng.uniform(600, 3 * 3600), 'launch')
+        elif action == 'launch' and not ncm.pid:
+            ncm.launch()
+        elif action == 'discord' and discord.up:
+            discord.stop()
+            schedule(rng.uniform(30, 1200), 'discord_up')
+        elif action == 'discord_up':
+            discord.up = True
+        elif action == 'toggle' and main.toggle_var.get():
+            stop(main.toggle, lambda: not main.toggle_var.get())
+            schedule(rng.uniform(10, 1800), 'enable')
+        elif action == 'enable' and not main.toggle_var.get():
+            connect(main.toggle)
+            if not main.toggle_var.get():  # Discord is not running, try again later
+                schedule(60, 'enable')
+        elif action == 'minimize' and root.shown:
+            main.hide_window()
+            schedule(rng.uniform(60, 2 * 3600), 'restore')
+        elif action == 'restore' and not root.shown:
+            main.show_window(main.icon, None)
+        root.drain()
+        next_at[0] = events[0][0] if events else end
+        if main.toggle_var.get():
+            main.timer.wake()
+    stop(main.quit_app, lambda: not main.core.thread.is_alive())
+
+
+SOAK_SCRIPT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+snapshot, days = sys.argv[2], float(sys.argv[3])
+sys.argv = ['main.py']
+import benchmark
+benchmark.run_soak(snapshot, days)
+"""
+
+
+def bench_soak(args):
+    """Leak check of the app running for --days simulated days through NCM restarts, Discord disconnects, toggling and minimizing to tray,
+    see run_soak. Fails if threads or open handles grow after the second day, if an NCM process handle outlives its process,
+    or if the Python heap or RSS keep growing by more than soak_max_growth per day."""
+    if args.days < 3:
+        print('Run for at least 3 days to tell leaks from warming up')
+        sys.exit(1)
+    src = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'v3.snap')
+        make_v3_snapshot(snapshot)
+        start = time.perf_counter()
+        run = subprocess.run([sys.executable, '-c', SOAK_SCRIPT, src, snapshot, str(args.days)], cwd=tmp,
+                             env={**os.environ, 'LOCALAPPDATA': tmp}, capture_output=True, text=True)
+        seconds = time.perf_counter() - start
+    if run.returncode:
+        print(run.stderr[-4000:])
+        sys.exit(1)
+    checkpoints = [json.loads(line) for line in run.stdout.splitlines()]
+    for checkpoint in checkpoints:
+        if checkpoint['day'] == int(checkpoint['day']):
+            print(f"day {checkpoint['day']:.0f}: RSS {checkpoint['rss'] / 2 ** 20:.1f} MB, {checkpoint['blocks']:,} heap blocks, {checkpoint['threads']} threads, "
+                  f"{checkpoint['handles']} handles, {checkpoint['ncm_handles']} NCM handles")
+    actions = checkpoints[-1]['actions']
+    print(f"{args.days:g} simulated days in {seconds:.0f} s: {actions['restart'] + actions['quit']} NCM restarts, {actions['discord']} Discord disconnects, "
+          f"{actions['toggle']} disables, {actions['minimize']} minimizes, {actions['skip']} skips, {checkpoints[-1]['sends']} presence sends, {checkpoints[-1]['ui_events']} Tk events")
+    warm = [checkpoint for checkpoint in checkpoints if checkpoint['day'] >= 1]  # caches and thread pools fill up during the first day
+    second_day, last_day = [checkpoint for checkpoint in warm if checkpoint['day'] <= 2], [checkpoint for checkpoint in warm if checkpoint['day'] >= args.days - 1]
+    leaks = []
+    for name in ('threads', 'handles'):  # the tray icon, file watcher and transient handles come and go, what stays open is the least seen
+        if min(checkpoint[name] for checkpoint in last_day) > max(checkpoint[name] for checkpoint in second_day):
+            leaks.append(f'{name} grew from at most {max(checkpoint[name] for checkpoint in second_day)} on the second day '
+                         f'to at least {min(checkpoint[name] for checkpoint in last_day)} on the last')
+    if max(checkpoint['ncm_handles'] for checkpoint in checkpoints) > 1:
+        leaks.append(f"{max(checkpoint['ncm_handles'] for checkpoint in checkpoints)} NCM process handles open, only one NCM process runs at a time")
+    for name, unit, scale in (('blocks', 'heap blocks', 1), ('rss', 'MB RSS', 2 ** 20)):
+        slope = statistics.linear_regression([checkpoint['day'] for checkpoint in warm], [checkpoint[name] for checkpoint in warm]).slope
+        print(f'{name} growth after the first day: {slope / scale:,.2f} {unit} per day')
+        if slope > soak_max_growth[name]:
+            leaks.append(f'{name} grew by {slope / scale:,.2f} {unit} per day')
+    if leaks:
+        print('Leaks: ' + '; '.join(leaks))
+        sys.exit(1)
+    print('No leaks')
+
+
+def replay_song_info(song_id: str) -> main.SongInfo:
+    return main.SongInfo(None, 'Album', 0.0, 'Artist', song_id)
+
+
+def bench_replay(args):
+    """Status detection over recorded traces (--trace) or thousands of synthetic sessions with skips, seeks, pauses
+    past pause_timeout and NCM restarts. Reports throughput, presence sends and events presence failed to follow."""
+    if args.trace:
+        for path in args.trace:
+            samples = list(main.read_trace(path))
+            if not samples:
+                print(f'{os.path.basename(path)}: empty trace')
+                continue
+            start = time.perf_counter()
+            sent = main.replay_trace(samples, replay_song_info)
+            seconds = time.perf_counter() - start
+            hours = (samples[-1].time - samples[0].time) / 3600 if samples else 0
+            print(f'{os.path.basename(path)}: {len(samples)} samples over {hours:.1f} h, {len(sent)} presence sends, '
+                  f'{len(samples) / seconds:,.0f} samples/s')
+        return
+    rng = random.Random(0)
+    total_samples, total_sent, total_extra, total_hours, missed, seconds = 0, 0, 0, 0.0, Counter(), 0.0
+    for _ in range(args.sessions):
+        session = Session(rng, rng.uniform(600, 3 * 3600))
+        # Tick times depend on what was detected so far, so a first pass samples the session while replaying it
+        samples = []
+        state = main.PlaybackState()
+        main.replay_trace((samples.append(sample) or sample for sample in session.samples(state, rng)), replay_song_info, state)
+        start = time.perf_counter()
+        sent = main.replay_trace(samples, replay_song_info)
+        seconds += time.perf_counter() - start
+        session_missed, extra = session.check(sent)
+        missed += session_missed
+        total_samples += len(samples)
+        total_sent += len(sent)
+        total_extra += extra
+        total_hours += session.end / 3600
+    print(f'{args.sessions} sessions, {total_hours:.0f} h, {total_samples} samples: {total_samples / seconds:,.0f} samples/s, '
+          f'{total_sent} presence sends ({total_sent / total_hours:.1f}/h), {total_extra} not accounted for by an event')
+    if missed:
+        print(f'Presence did not follow {sum(missed.values())} events: {dict(missed)}')
+        sys.exit(1)
+    print('Presence followed every event')
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'aob-scan': bench_aob_scan,
+    'read-plan': bench_read_plan,
+    'v2-discovery': bench_v2_discovery,
+    'startup': bench_startup,
+    'profile-startup': bench_profile_startup,
+    'replay': bench_replay,
+    'history': bench_history,
+    'song-info': bench_song_info,
+    'song-cache': bench_song_cache,
+    'file-watcher': bench_file_watcher,
+    'logging': bench_logging,
+    'netease': bench_netease,
+    'prefetch': bench_prefetch,
+    'resolver': bench_resolver,
+    'discord-ipc': bench_discord_ipc,
+    'soak': bench_soak,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    parser.add_argument('-n', '--number', type=int, default=10000, help='iterations per measurement')
+    parser.add_argument('--size', type=int, default=32 * 2 ** 20, help='buffer size of the aob-scan benchmark')
+    parser.add_argument('--snapshot', action='append', help='captured snapshot to run against instead of synthetic ones, can be repeated')
+    parser.add_argument('--report', help='where profile-startup keeps the JSON report of its first run')
+    parser.add_argument('--trace', action='append', help='trace recorded with main.py --record-trace to replay instead of synthetic sessions, can be repeated')
+    parser.add_argument('--sessions', type=int, default=1000, help='synthetic sessions of the replay benchmark')
+    parser.add_argument('--days', type=float, default=7, help='simulated days of the soak benchmark')
+    parser.add_argument('--entries', type=int, default=50000, help='entries of the synthetic history file of the history, song-info and file-watcher benchmarks')
+    args = parser.parse_args()
+    main.logger.setLevel(logging.WARNING)  # keep per-call debug logging out of the measurements
+    BENCHMARKS[args.benchmark](args)
@@ -1,39 +1,156 @@
+import sys
+
+if '--profile-startup' in sys.argv:  # before all other imports so that their cost is recorded
+    from startup_profile import StartupProfile
+    startup_profile = StartupProfile(sys.argv[sys.argv.index('--profile-startup') + 1])
+else:
+    startup_profile = None
+
+import asyncio
+import atexit
+import codecs
 import ctypes
+import hashlib
+import json
 import locale
 import logging
+import math
+import mmap
 import os
+import queue
 import re
-import sys
+import sqlite3
+import struct
+import threading
 import time
 import webbrowser
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntFlag, auto
-from threading import Event as ThreadingEvent, Thread
-from tkinter import *
-from tkinter import BooleanVar, messagebox
-from tkinter.ttk import *
-from typing import Callable, Dict, Tuple, TypedDict
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from threading import Event as ThreadingEvent, Lock, Thread
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 
 import orjson
 import psutil
-from PIL import Image
-from pyMeow import aob_scan_module, close_process, get_module, get_process_name, open_process, pid_exists, r_bytes, r_float64, r_int, r_int64, r_uint
+import pyncm
 from pyncm import apis
-from pypresence import DiscordNotFound, PipeClosed, Presence
-from pystray import Icon as TrayIcon, Menu as TrayMenu, MenuItem as TrayItem
-from win32api import GetFileVersionInfo, HIWORD, LOWORD
+from pypresence import AioPresence, DiscordNotFound, PipeClosed
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+if startup_profile is not None:
+    startup_profile.phase('imports', startup_profile.start)
 
 __version__ = '0.4.0'
 
+
+class LocalQueueHandler(QueueHandler):
+    """Queues records as they are. QueueHandler.prepare() would format them first, on the thread that logs."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class BatchingQueueListener(QueueListener):
+    """Blocks on the queue while nothing is logged, then waits `interval` seconds for the rest of the burst before handling it all,
+    instead of waking up for each record, so logging doesn't switch threads on the tick. A burst is formatted once and written with one
+    write and flush per handler, Handler.emit() flushes each record and RotatingFileHandler seeks for each, and every syscall hands the GIL
+    to the tick thread and back."""
+
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: logging.StreamHandler, interval: float = 0.2):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.interval = interval
+        self.batch: List[logging.LogRecord] = []
+
+    def prepare(self, record: logging.LogRecord | Tuple[float, str, tuple]) -> logging.LogRecord:
+        if isinstance(record, tuple):  # queued by tick_debug()
+            created, msg, args = record
+            record = logger.makeRecord(logger.name, logging.DEBUG, '(unknown file)', 0, msg, args, None)
+            record.created, record.msecs = created, int((created - int(created)) * 1000) + 0.0
+        return record
+
+    def handle(self, record: logging.LogRecord | Tuple[float, str, tuple]):
+        self.batch.append(self.prepare(record))
+
+    def write_batch(self):
+        batch, self.batch = self.batch, []
+        texts = {}  # the handlers share the formatter
+        for handler in self.handlers:
+            records = [record for record in batch if record.levelno >= handler.level and handler.filter(record)]
+            if not records:
+                continue
+            key = handler.formatter, handler.level, handler.terminator
+            if key not in texts:
+                texts[key] = ''.join(self.format(handler, record) for record in records)
+            try:
+                with handler.lock:
+                    if isinstance(handler, RotatingFileHandler) and handler.shouldRollover(records[-1]):
+                        handler.doRollover()
+                    if handler.stream is None:  # a FileHandler opened with delay=True
+                        handler.stream = handler._open()
+                    handler.stream.write(texts[key])
+                    handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+
+    @staticmethod
+    def format(handler: logging.StreamHandler, record: logging.LogRecord) -> str:
+        """One record that can't be formatted is reported and dropped, like Handler.emit() does, not the rest of the batch."""
+        try:
+            return handler.format(record) + handler.terminator
+        except Exception:
+            handler.handleError(record)
+            return ''
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        try:
+            record = self.queue.get_nowait()
+        except queue.Empty:
+            if not block:
+                raise
+            self.write_batch()
+            record = self.queue.get()
+            if record is not self._sentinel:
+                time.sleep(self.interval)
+        if record is self._sentinel:  # stop() writes what is still queued
+            self.write_batch()
+        return record
+
+
+def tick_debug(msg: str, *args):
+    """logger.debug for the update tick. Only the time, message and arguments are queued and the LogRecord is made on the listener's thread,
+    making one costs more than the rest of a song change tick. Falls back to logger.debug unless the logger only queues its records."""
+    if logger.isEnabledFor(logging.DEBUG):
+        handlers = logger.handlers
+        if len(handlers) == 1 and isinstance(handlers[0], LocalQueueHandler):
+            handlers[0].queue.put_nowait((time.time(), msg, args))
+        else:
+            logger.debug(msg, *args)
+
+
+debug_mode = os.path.isfile('debug.log')
+# The format only has the time, level and message, don't collect the caller, thread, process and task of every record (see the logging HOWTO)
+logging._srcfile = None
+logging.logThreads = logging.logProcesses = logging.logMultiprocessing = logging.logAsyncioTasks = False
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
-if os.path.isfile('debug.log'):
-    file_handler = logging.FileHandler('debug.log', encoding='utf-8')
+log_handlers: List[logging.Handler] = [stream_handler]
+if debug_mode:
+    file_handler = RotatingFileHandler('debug.log', maxBytes=5 * 2 ** 20, backupCount=2, encoding='utf-8')  # debug.log plus two older 5 MB files
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    log_handlers.append(file_handler)
+# Records are formatted and written on the listener's thread, so logging never blocks the tick on the console or the disk
+log_queue = queue.SimpleQueue()
+logger.addHandler(LocalQueueHandler(log_queue))
+log_listener = BatchingQueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)  # flushes what is still queued
 
 offsets = {
     '2.7.1.1669': {'current': 0x8C8AF8, 'song_array': 0x8E9044},
@@ -53,20 +170,77 @@ offsets = {
 V3_AUDIO_PLAYER_PATTERN = "48 8D 0D ?? ?? ?? ?? E8 ?? ?? ?? ?? 48 8D 0D ?? ?? ?? ?? E8 ?? ?? ?? ?? 90 48 8D 0D ?? ?? ?? ?? E8 ?? ?? ?? ?? 48 8D 05 ?? ?? ?? ?? 48 8D A5 ?? ?? ?? ?? 5F 5D C3 CC CC CC CC CC 48 89 4C 24 ?? 55 57 48 81 EC ?? ?? ?? ?? 48 8D 6C 24 ?? 48 8D 7C 24"
 V3_AUDIO_SCHEDULE_PATTERN = "66 0F 2E 0D ?? ?? ?? ?? 7A ?? 75 ?? 66 0F 2E 15"
 
-# Cached V3 pointers (resolved per process launch via AOB scan)
-v3_schedule_ptr = 0
-v3_audio_player_ptr = 0
-
 frozen = getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS')
-interval = 1
-windll = ctypes.windll.kernel32
-is_CN = locale.windows_locale[windll.GetUserDefaultUILanguage()].startswith('zh_')
+interval = 1  # seconds between ticks during steady playback, also the shortest gap between two progress samples that are compared
+fast_interval = 0.25  # right after a song change or seek, so song changes and resolved song info show up quickly
+fast_period = 3  # seconds of fast polling after a change
+paused_interval = 3
+idle_interval = 5  # NCM not running
+pause_timeout = 30 * 60  # presence is cleared after being paused for this long
+progress_tolerance = 0.2  # seconds progress may differ from the elapsed time between two samples while playing
+process_scan_max_backoff = 30  # longest wait between process list scans while NCM is not running
+process_rescan_interval = 30  # seconds between process list scans for further NCM instances while some are tracked
+presence_rate_limit = 5  # Discord accepts about 5 presence updates per 20 seconds and silently drops the rest
+presence_rate_period = 20
+discord_reconnect_min_backoff = 5
+discord_reconnect_max_backoff = 120
+ui_refresh_interval = 0.1  # seconds, the window and tray tooltip are updated at most this often
+is_CN = sys.platform == 'win32' and locale.windows_locale[ctypes.windll.kernel32.GetUserDefaultUILanguage()].startswith('zh_')
 user_startup_folder = os.path.join(os.path.expandvars('%APPDATA%'), r'Microsoft\Windows\Start Menu\Programs\Startup')
 startup_file_path = os.path.join(user_startup_folder, 'Netease Cloud Music Discord RPC.bat')
 start_minimized = '--min' in sys.argv
+headless = '--headless' in sys.argv  # no window or tray icon, tkinter, PIL and pystray are never imported
 re_song_id = re.compile(r'(\d+)')
+local_app_data = os.environ.get('LOCALAPPDATA', os.path.expanduser('~/.cache'))  # ~/.cache off Windows, e.g. for the benchmarks
+data_dir = os.path.join(local_app_data, 'Netease Cloud Music Discord RPC')
+cache_db_path = os.path.join(data_dir, 'cache.db')
+headless_stop_path = os.path.join(data_dir, 'stop')  # created by --stop, a running --headless instance quits once it sees it
+song_cache_max_entries = 5000  # LRU cap of the persistent song info cache
+song_cache_memory_entries = 256  # hot entries kept in memory in front of the database
+history_file_path = os.path.join(local_app_data, 'Netease/CloudMusic/webdata/file/history')
+playing_list_file_path = os.path.join(local_app_data, 'Netease/CloudMusic/WebData/file/playingList')
+json_chunk_size = 0x10000  # bytes read at a time while streaming NCM's webdata files
+file_watch_interval = 0.5  # seconds between stat() polls of NCM's webdata files
+file_watch_debounce = 0.5  # a changed file is only read once it has stopped changing for this long, NCM rewrites it in bursts
+prefetch_count = 10  # number of upcoming playingList tracks resolved ahead of time
+netease_batch_size = 50  # song IDs per GetTrackDetail request
+netease_http_timeout = (3.05, 8)  # connect and read timeouts of NetEase requests, below the resolver's timeout for NetEase
+netease_pool_size = 4  # keep-alive connections to NetEase
+netease_not_found_backoff = 60 * 60  # an ID NetEase doesn't know (cloud drive uploads) is retried after this, doubling per further miss
+netease_not_found_max_backoff = 7 * 24 * 60 * 60
+netease_error_backoff = 5  # after a network error or timeout, doubling per further error
+netease_error_max_backoff = 5 * 60
+netease_misses_max_entries = 1000
+read_plan_max_gap = 0x1000  # reading this many unused bytes between two fields is cheaper than another ReadProcessMemory call
+v2_discovery_confirmations = 3  # consecutive ticks discovered V2 offsets must hold up for
+v2_discovery_reset_steps = 2  # ticks after a song change within which the real playback position has to start over
+v2_discovery_timeout = 5 * 60  # seconds of playback during discovery before an unknown 2.x version is reported as unsupported
+v2_discovery_rescan_interval = 10  # seconds between scans for song_array candidates while none are left, a scan takes a few hundred ms on the loop
+resolver_timeouts = {'history': 2, 'playing_list': 2, 'netease': 10}  # seconds each lookup source may take before it is given up on
+resolver_misses_max_entries = 1000  # song IDs no source could find, not looked up again until they are played anew
+song_cache_netease_ttl = 7 * 24 * 60 * 60  # remote metadata can change (e.g. album cover), local file entries are refreshed by NCM itself
+trace_path = sys.argv[sys.argv.index('--record-trace') + 1] if '--record-trace' in sys.argv else None  # JSON lines of [time, song ID, progress]
+metrics_port = int(sys.argv[sys.argv.index('--metrics-port') + 1]) if '--metrics-port' in sys.argv else 0  # serve metrics on 127.0.0.1, off by default
+metric_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+metric_help = {
+    'ncm_tick_seconds': 'Duration of update() ticks',
+    'ncm_process_check_seconds': 'Checking that NCM is still running, including process scans when it is not',
+    'ncm_offset_resolve_seconds': 'Resolving memory offsets after NCM was found',
+    'ncm_memory_read_seconds': 'Reading playback progress and song ID from NCM',
+    'ncm_song_info_lookup_seconds': 'Song info lookups per source, until found, not found, failed or given up on',
+    'ncm_song_info_lookups_total': 'Song info lookups per source and result',
+    'ncm_discord_send_seconds': 'Sending presence to Discord',
+    'ncm_discord_sends_total': 'Presence sends to Discord per result',
+    'ncm_presence_publishes_total': 'Presences handed to the publisher per outcome',
+}
+
+logger.info(f"Netease Cloud Music Discord RPC v{__version__}\nRunning on Python {sys.version}\nSupporting NCM version: {', '.join(offsets.keys())}, other 2.x (automatic offset discovery), 3.x (dynamic scan)")
+
 
-logger.info(f"Netease Cloud Music Discord RPC v{__version__}\nRunning on Python {sys.version}\nSupporting NCM version: {', '.join(offsets.keys())}, 3.x (dynamic scan)")
+def profile_phase(name: str, start: float, **details):
+    """Records a startup phase that began at `start` (time.perf_counter()) and ends now, with --profile-startup."""
+    if startup_profile is not None:
+        startup_profile.phase(name, start, **details)
 
 
 def get_res_path(relative_path: str) -> str:
@@ -79,41 +253,1317 @@ def get_res_path(relative_path: str) -> str:
         raise FileNotFoundError(f'{os.path.join(base_path, relative_path)} is not found!')
 
 
-class RepeatedTimer:
-    def __init__(self, interval: int, function: Callable[[], None], stop_variable: ThreadingEvent):
-        self.interval = interval
-        self.function = function
-        self.stop_variable = stop_variable
-        self.start = time.time()
-        self.event = ThreadingEvent()
-        self.thread = Thread(target=self._target)
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = metric_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts values above all buckets
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Fixed-bucket histograms and counters of the hot paths, rendered in the Prometheus text format."""
+
+    def __init__(self, help: Dict[str, str] = metric_help):
+        self.help = help
+        self.lock = Lock()
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @staticmethod
+    def labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            described = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in described:
+                    described.add(name)
+                    lines += [f'# HELP {name} {self.help.get(name, name)}', f'# TYPE {name} histogram']
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.labels(labels + (('le', '+Inf' if bucket == float('inf') else repr(bucket)),))} {cumulative}")
+                lines += [f'{name}_sum{self.labels(labels)} {histogram.sum}', f'{name}_count{self.labels(labels)} {histogram.count}']
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in described:
+                    described.add(name)
+                    lines += [f'# HELP {name} {self.help.get(name, name)}', f'# TYPE {name} counter']
+                lines.append(f'{name}{self.labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(metrics: Metrics, port: int):
+    """Serves `metrics` at http://127.0.0.1:<port>/metrics, for Prometheus or a quick look in the browser."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # only needed with --metrics-port
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f'Serving metrics at http://127.0.0.1:{port}/metrics')
+    return server
+
+
+class EventLoopThread:
+    """Runs the asyncio event loop shared by the update tick, Discord IPC and song info lookups on its own thread.
+    Tk and the tray icon hand it work without waiting for it, results come back to them through root.after."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='EventLoop', daemon=True)
         self.thread.start()
 
-    def _target(self):
-        while not self.stop_variable.is_set() and not self.event.wait(self._time):
-            self.function()
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self.thread
 
-    @property
-    def _time(self):
-        return self.interval - ((time.time() - self.start) % self.interval)
+    def run(self, coro, timeout: float | None = None):
+        """Runs `coro` on the loop and waits for its result. Must not be called from the loop itself."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
 
-    def stop(self):
-        self.event.set()
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
         self.thread.join()
 
 
-class SongInfo(TypedDict):
-    cover: str
+class AdaptiveTimer:
+    """Calls `function` repeatedly as a task on `loop` until stopped, waiting `next_interval()` seconds after each call or until woken.
+    `function` is passed the timer's `wake`, for callbacks of work it started to wake the timer that is running it."""
+
+    def __init__(self, function: Callable[[Callable[[], None]], None], next_interval: Callable[[], float], stop_variable: ThreadingEvent, loop: EventLoopThread):
+        self.function = function
+        self.next_interval = next_interval
+        self.stop_variable = stop_variable
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.stopped = False
+        self.finished = ThreadingEvent()
+        self.task: Future = asyncio.run_coroutine_threadsafe(self._target(), loop.loop)  # awaited by stop_tracking() on the loop
+
+    async def _target(self):
+        try:
+            while not (self.stopped or self.stop_variable.is_set()):
+                self.event.clear()
+                self.function(self.wake)
+                try:
+                    await asyncio.wait_for(self.event.wait(), self.next_interval())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.finished.set()
+
+    def wake(self):
+        """Calls `function` right away instead of at the end of the current interval, safe to call from any thread."""
+        self.loop.loop.call_soon_threadsafe(self.event.set)
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+        if not self.loop.in_loop():
+            self.finished.wait()
+
+
+class AobPattern(NamedTuple):
+    anchor: bytes  # longest run of fixed bytes, located with bytes.find
+    anchor_offset: int
+    regex: re.Pattern  # whole pattern, matched at each anchor hit
+    length: int
+
+
+@lru_cache(maxsize=None)
+def compile_aob_pattern(pattern: str) -> AobPattern:
+    """Compile an IDA-style byte pattern ("48 8D 0D ?? ...") into its longest run of fixed bytes and a regex for the whole pattern."""
+    tokens = pattern.split()
+    anchor, anchor_offset = b'', 0
+    run_start = 0
+    for i, token in enumerate(tokens + ['??']):
+        if token == '??':
+            if i - run_start > len(anchor):
+                anchor, anchor_offset = bytes.fromhex(''.join(tokens[run_start:i])), run_start
+            run_start = i + 1
+    if not anchor:
+        raise ValueError(f'Pattern has no fixed bytes: {pattern}')
+    regex = re.compile(b''.join(b'.' if token == '??' else re.escape(bytes.fromhex(token)) for token in tokens), re.DOTALL)
+    return AobPattern(anchor, anchor_offset, regex, len(tokens))
+
+
+def aob_scan(buffer: bytes, patterns: List[str]) -> Dict[str, int | None]:
+    """Offset of the first match of each pattern in buffer, None if not found."""
+    found: Dict[str, int | None] = {}
+    for pattern in patterns:
+        compiled = compile_aob_pattern(pattern)
+        found[pattern] = None
+        position = buffer.find(compiled.anchor, compiled.anchor_offset)
+        while position != -1:
+            if compiled.regex.match(buffer, position - compiled.anchor_offset):
+                found[pattern] = position - compiled.anchor_offset
+                break
+            position = buffer.find(compiled.anchor, position + 1)
+    return found
+
+
+IMAGE_SCN_MEM_EXECUTE = 0x20000000
+IMAGE_SCN_MEM_WRITE = 0x80000000
+
+
+def module_sections(reader: 'MemoryReader', base: int, size: int, characteristic: int) -> List[Tuple[int, int]]:
+    """(address, size) of the sections of a loaded PE module with the given characteristic flag, the whole module if its headers can't be parsed."""
+    try:
+        header = reader.r_bytes(base, 0x1000)
+        pe_offset, = struct.unpack_from('<I', header, 0x3C)
+        if header[pe_offset:pe_offset + 4] != b'PE\0\0':
+            raise ValueError('Invalid PE signature')
+        section_count, optional_header_size = struct.unpack_from('<H12xH', header, pe_offset + 6)
+        sections = []
+        for i in range(section_count):
+            virtual_size, virtual_address = struct.unpack_from('<II', header, pe_offset + 24 + optional_header_size + 40 * i + 8)
+            characteristics, = struct.unpack_from('<I', header, pe_offset + 24 + optional_header_size + 40 * i + 36)
+            if characteristics & characteristic and virtual_address + virtual_size <= size:
+                sections.append((base + virtual_address, virtual_size))
+        if sections:
+            return sections
+    except (struct.error, ValueError, RuntimeError, OSError) as e:
+        logger.debug(f'Could not parse PE headers at {hex(base)}, scanning the whole module: {e}')
+    return [(base, size)]
+
+
+class ReadPlan:
+    """The fixed-address fields read on every tick, with nearby fields coalesced into as few contiguous reads as possible.
+    Built once per process, since the addresses only change when offsets are resolved again."""
+
+    def __init__(self, fields: Dict[str, Tuple[int, str]], max_gap: int = read_plan_max_gap):
+        """`fields` maps names to (address, struct format)."""
+        self.spans: List[Tuple[int, int, List[Tuple[str, int, struct.Struct]]]] = []  # (address, size, [(name, offset in span, format)])
+        for name, (address, fmt) in sorted(fields.items(), key=lambda field: field[1][0]):
+            unpacker = struct.Struct('<' + fmt)
+            if self.spans and address - (self.spans[-1][0] + self.spans[-1][1]) <= max_gap:
+                start, size, span_fields = self.spans[-1]
+                span_fields.append((name, address - start, unpacker))
+                self.spans[-1] = (start, max(size, address - start + unpacker.size), span_fields)
+            else:
+                self.spans.append((address, unpacker.size, [(name, 0, unpacker)]))
+
+    def read(self, reader: 'MemoryReader') -> Dict[str, int | float]:
+        values = {}
+        for address, size, span_fields in self.spans:
+            buffer = reader.r_bytes(address, size)
+            for name, offset, unpacker in span_fields:
+                values[name] = unpacker.unpack_from(buffer, offset)[0]
+        return values
+
+
+class MemoryReader:
+    """Access to the memory of the NCM process. update() and the offset scanners only read memory through this interface,
+    typed reads are decoded from r_bytes unless a backend has faster native ones."""
+    pid = 0  # PID of the opened process, 0 if none is open
+
+    def pid_exists(self, pid: int) -> bool:
+        raise NotImplementedError
+
+    def process_name(self, pid: int) -> str:
+        raise NotImplementedError
+
+    def open(self, pid: int):
+        raise NotImplementedError
+
+    def close(self):
+        self.pid = 0
+
+    def module(self, name: str) -> dict:
+        """{'base': address, 'size': size} of a module loaded in the opened process."""
+        raise NotImplementedError
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        raise NotImplementedError
+
+    def r_int(self, address: int) -> int:
+        return struct.unpack('<i', self.r_bytes(address, 4))[0]
+
+    def r_uint(self, address: int) -> int:
+        return struct.unpack('<I', self.r_bytes(address, 4))[0]
+
+    def r_int64(self, address: int) -> int:
+        return struct.unpack('<q', self.r_bytes(address, 8))[0]
+
+    def r_float64(self, address: int) -> float:
+        return struct.unpack('<d', self.r_bytes(address, 8))[0]
+
+    def read_region(self, address: int, size: int, chunk_size: int = 0x10000) -> bytes:
+        """Read a large region in one go, falling back to chunks with unreadable ones zero-filled."""
+        try:
+            return self.r_bytes(address, size)
+        except Exception:
+            chunks = []
+            for chunk_address in range(address, address + size, chunk_size):
+                chunk_length = min(chunk_size, address + size - chunk_address)
+                try:
+                    chunks.append(self.r_bytes(chunk_address, chunk_length))
+                except Exception:
+                    chunks.append(bytes(chunk_length))
+            return b''.join(chunks)
+
+    def scan_module(self, module_name: str, patterns: List[str]) -> Dict[str, int | None]:
+        """Address of the first match of each IDA-style byte pattern ("48 8D 0D ?? ...") in the module's executable sections, None if not found.
+        Every section is read once and searched for all patterns."""
+        module = self.module(module_name)
+        found: Dict[str, int | None] = dict.fromkeys(patterns)
+        for address, size in module_sections(self, module['base'], module['size'], IMAGE_SCN_MEM_EXECUTE):
+            remaining = [pattern for pattern in patterns if found[pattern] is None]
+            if not remaining:
+                break
+            for pattern, offset in aob_scan(self.read_region(address, size), remaining).items():
+                if offset is not None:
+                    found[pattern] = address + offset
+        return found
+
+
+class PyMeowReader(MemoryReader):
+    """Reads the live process through pyMeow (Windows only)."""
+
+    def __init__(self):
+        import pyMeow  # imported here so the module stays importable where pyMeow is not available, e.g. with a SnapshotReader
+        self.meow = pyMeow
+        self.process = None
+
+    def pid_exists(self, pid: int) -> bool:
+        return self.meow.pid_exists(pid)
+
+    def process_name(self, pid: int) -> str:
+        return self.meow.get_process_name(pid)
+
+    def open(self, pid: int):
+        self.process = self.meow.open_process(pid)
+        self.pid = pid
+
+    def close(self):
+        if self.process is not None:
+            self.meow.close_process(self.process)
+            self.process = None
+        self.pid = 0
+
+    def module(self, name: str) -> dict:
+        return self.meow.get_module(self.process, name)
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        return self.meow.r_bytes(self.process, address, size)
+
+    def r_int(self, address: int) -> int:
+        return self.meow.r_int(self.process, address)
+
+    def r_uint(self, address: int) -> int:
+        return self.meow.r_uint(self.process, address)
+
+    def r_int64(self, address: int) -> int:
+        return self.meow.r_int64(self.process, address)
+
+    def r_float64(self, address: int) -> float:
+        return self.meow.r_float64(self.process, address)
+
+
+SNAPSHOT_MAGIC = b'NCMSNAP1'
+
+
+class SnapshotReader(MemoryReader):
+    """Serves reads from a memory-mapped snapshot of the NCM process, for replaying captured cloudmusic.dll layouts off Windows.
+    File layout: SNAPSHOT_MAGIC, little-endian uint32 header length, JSON header, then the raw region contents.
+    The header holds pid, name, version, modules ({name: {'base', 'size'}}) and regions ([address, size, offset into the contents], sorted by address)."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a memory snapshot')
+        header_size, = struct.unpack_from('<I', self.data, len(SNAPSHOT_MAGIC))
+        header = orjson.loads(self.data[len(SNAPSHOT_MAGIC) + 4:len(SNAPSHOT_MAGIC) + 4 + header_size])
+        self.data_offset = len(SNAPSHOT_MAGIC) + 4 + header_size
+        self.snapshot_pid = header['pid']
+        self.name = header['name']
+        self.version = header['version']
+        self.modules = header['modules']
+        self.regions = header['regions']
+        self.region_starts = [address for address, _, _ in self.regions]
+
+    def pid_exists(self, pid: int) -> bool:
+        return pid == self.snapshot_pid
+
+    def process_name(self, pid: int) -> str:
+        return self.name if pid == self.snapshot_pid else ''
+
+    def open(self, pid: int):
+        if pid != self.snapshot_pid:
+            raise RuntimeError(f'Process {pid} is not in the snapshot')
+        self.pid = pid
+
+    def module(self, name: str) -> dict:
+        return self.modules[name]
+
+    def r_bytes(self, address: int, size: int) -> bytes:
+        i = bisect_right(self.region_starts, address) - 1
+        if i >= 0:
+            start, region_size, offset = self.regions[i]
+            if address + size <= start + region_size:
+                offset += self.data_offset + address - start
+                return self.data[offset:offset + size]
+        raise RuntimeError(f'Could not read {size} bytes at {hex(address)}')  # same failure mode as a failed ReadProcessMemory
+
+    def close_snapshot(self):
+        self.data.close()
+
+
+def write_snapshot(path: str, regions: List[Tuple[int, bytes]], modules: Dict[str, dict], version: str, pid: int = 1, name: str = 'cloudmusic.exe'):
+    """Write regions ([(address, contents)]) into a file readable by SnapshotReader. Adjacent regions are merged."""
+    merged: List[List] = []
+    for address, contents in sorted(regions):
+        if merged and merged[-1][0] + len(merged[-1][1]) >= address:
+            last_address, last_contents = merged[-1]
+            merged[-1][1] = last_contents[:address - last_address] + contents + last_contents[address - last_address + len(contents):]
+        else:
+            merged.append([address, bytes(contents)])
+    table = []
+    offset = 0
+    for address, contents in merged:
+        table.append([address, len(contents), offset])
+        offset += len(contents)
+    header = orjson.dumps({'pid': pid, 'name': name, 'version': version, 'modules': modules, 'regions': table})
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for _, contents in merged:
+            f.write(contents)
+
+
+class SongInfo(NamedTuple):
+    """A tuple instead of a dict with five keys per song. Build it with create(), which interns the album, artist and cover URL,
+    so thousands of cached tracks keep one copy of the strings they share."""
+    cover: str | None
     album: str
     duration: float
     artist: str
     title: str
 
+    @classmethod
+    def create(cls, cover: str | None, album: str, duration: float, artist: str, title: str) -> 'SongInfo':
+        intern = lambda value: sys.intern(value) if value else value  # the cover can be None
+        return cls(intern(cover), intern(album), duration, intern(artist), title)
+
+    @classmethod
+    def from_json(cls, data: bytes) -> 'SongInfo':
+        return cls.create(*orjson.loads(data))
+
+    def to_json(self) -> bytes:
+        return orjson.dumps(tuple(self))
+
+
+def open_cache_db(path: str, schema: List[str]) -> sqlite3.Connection:
+    """Open (and create) a SQLite cache database shared across threads, falling back to memory if the file can't be used."""
+    try:
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False)
+        with db:
+            for statement in schema:
+                db.execute(statement)
+    except (OSError, sqlite3.Error) as e:  # e.g. read-only profile, corrupted file. Keep working without persistence
+        logger.warning(f'Could not open cache at {path}, falling back to memory: {e}')
+        db = sqlite3.connect(':memory:', check_same_thread=False)
+        with db:
+            for statement in schema:
+                db.execute(statement)
+    return db
+
+
+class OffsetCache:
+    """Module-relative offsets resolved for an NCM build, keyed by version and a hash of the module headers,
+    so that offset discovery only runs once per build instead of on every launch."""
+
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.db = open_cache_db(path, ['CREATE TABLE IF NOT EXISTS offsets (kind TEXT NOT NULL, version TEXT NOT NULL, module_hash TEXT NOT NULL, offsets BLOB NOT NULL, '
+                                       'PRIMARY KEY (kind, version, module_hash))'])
+
+    def get(self, kind: str, version: str, module_hash: str) -> Dict[str, int] | None:
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT offsets FROM offsets WHERE kind = ? AND version = ? AND module_hash = ?', (kind, version, module_hash)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f'Error while reading offset cache: {e}')
+                return None
+        return orjson.loads(row[0]) if row else None
+
+    def put(self, kind: str, version: str, module_hash: str, module_offsets: Dict[str, int]):
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute('INSERT OR REPLACE INTO offsets (kind, version, module_hash, offsets) VALUES (?, ?, ?, ?)', (kind, version, module_hash, orjson.dumps(module_offsets)))
+            except sqlite3.Error as e:
+                logger.warning(f'Error while writing offset cache: {e}')
+
+    def discard(self, kind: str, version: str, module_hash: str):
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute('DELETE FROM offsets WHERE kind = ? AND version = ? AND module_hash = ?', (kind, version, module_hash))
+            except sqlite3.Error as e:
+                logger.warning(f'Error while writing offset cache: {e}')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SongInfoCache:
+    """Persistent LRU cache of song info keyed by song ID, backed by SQLite.
+    Entries resolved from NetEase expire after `netease_ttl` seconds, entries from local files never expire.
+    Lookups and put() only touch memory and read the database, new entries and access times are written behind by flush(),
+    which FileWatcher calls from its thread, so the update tick never commits. A lookup that finds the database busy counts as a miss."""
+
+    def __init__(self, path: str, max_entries: int = song_cache_max_entries, memory_entries: int = song_cache_memory_entries, netease_ttl: float = song_cache_netease_ttl):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.netease_ttl = netease_ttl
+        self.lock = Lock()  # memory and what flush() has yet to write
+        self.db_lock = Lock()
+        self.memory: OrderedDict[str, Tuple[SongInfo, str, float]] = OrderedDict()  # song_id -> (song_info, source, fetched_at)
+        self.unwritten: Dict[str, Tuple[SongInfo, str, float]] = {}  # entries put() since the last flush()
+        self.accessed: Dict[str, float] = {}  # song_id -> access time of lookups since the last flush()
+        self.db = open_cache_db(path, ['CREATE TABLE IF NOT EXISTS song_info (id TEXT PRIMARY KEY, info BLOB NOT NULL, source TEXT NOT NULL, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+                                       'CREATE INDEX IF NOT EXISTS song_info_accessed_at ON song_info (accessed_at)'])
+
+    def _expired(self, source: str, fetched_at: float) -> bool:
+        return source == 'netease' and time.time() - fetched_at > self.netease_ttl
+
+    def _remember(self, song_id: str, entry: Tuple[SongInfo, str, float]):
+        self.memory[song_id] = entry
+        self.memory.move_to_end(song_id)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, song_id: str) -> SongInfo | None:
+        with self.lock:
+            entry = self.memory.get(song_id) or self.unwritten.get(song_id)
+            if entry is not None:
+                if self._expired(entry[1], entry[2]):
+                    return None  # replaced when the song is resolved again
+                self._remember(song_id, entry)
+                self.accessed[song_id] = time.time()
+                return entry[0]
+        if not self.db_lock.acquire(blocking=False):  # busy with a bulk write, the song is resolved from its sources instead of waiting
+            return None
+        try:
+            row = self.db.execute('SELECT info, source, fetched_at FROM song_info WHERE id = ?', (song_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f'Error while reading song info cache: {e}')
+            return None
+        finally:
+            self.db_lock.release()
+        if row is None:
+            return None
+        info, source, fetched_at = row
+        if self._expired(source, fetched_at):
+            return None
+        song_info = SongInfo.from_json(info)
+        with self.lock:
+            self._remember(song_id, (song_info, source, fetched_at))
+            self.accessed[song_id] = time.time()
+        return song_info
+
+    def put(self, song_id: str, song_info: SongInfo, source: str):
+        entry = (song_info, source, time.time())
+        with self.lock:
+            self._remember(song_id, entry)
+            self.unwritten[song_id] = entry
+
+    def put_many(self, songs: Iterable[Tuple[str, SongInfo]], source: str):
+        """Stores songs read ahead of need in one transaction. Cached songs are refreshed in place and keep their access time,
+        new ones only fill free space as the least recently used entries, so the whole history read on startup never evicts songs that were played."""
+        now = time.time()
+        songs = [(song_id, song_info, song_info.to_json()) for song_id, song_info in songs]
+        with self.lock:
+            for song_id, song_info, _ in songs:
+                if song_id in self.memory:
+                    self.memory[song_id] = (song_info, source, now)
+            # NCM writes a track to its files shortly before playing it, so pushed tracks are kept in memory for their first lookup.
+            # Of a push the size of the whole history on startup only the head is, the latest played songs and the start of the queue
+            for song_id, song_info, _ in reversed(songs[:self.memory_entries // 2]):
+                self._remember(song_id, (song_info, source, now))
+        self.flush()
+        with self.db_lock:
+            try:
+                with self.db:
+                    cached = {song_id for song_id, in self.db.execute('SELECT id FROM song_info')}
+                    self.db.executemany('UPDATE song_info SET info = ?, source = ?, fetched_at = ? WHERE id = ? AND info != ?',
+                                        [(info, source, now, song_id, info) for song_id, _, info in songs if song_id in cached])
+                    new = [(song_id, info, source, now) for song_id, _, info in songs if song_id not in cached]
+                    self.db.executemany('INSERT INTO song_info (id, info, source, fetched_at, accessed_at) VALUES (?, ?, ?, ?, 0)', new[:max(self.max_entries - len(cached), 0)])
+            except sqlite3.Error as e:
+                logger.warning(f'Error while writing song info cache: {e}')
+
+    def flush(self):
+        """Writes the entries put() and the access times of lookups since the last flush in one transaction."""
+        with self.lock:
+            unwritten, self.unwritten = self.unwritten, {}
+            accessed, self.accessed = self.accessed, {}
+        if not unwritten and not accessed:
+            return
+        with self.db_lock:
+            try:
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO song_info (id, info, source, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                                        [(song_id, song_info.to_json(), source, fetched_at, accessed.get(song_id, fetched_at))
+                                         for song_id, (song_info, source, fetched_at) in unwritten.items()])
+                    self.db.executemany('UPDATE song_info SET accessed_at = ? WHERE id = ?', [(accessed_at, song_id) for song_id, accessed_at in accessed.items() if song_id not in unwritten])
+                    if unwritten:  # evict least recently used entries beyond the cap
+                        self.db.execute('DELETE FROM song_info WHERE id IN (SELECT id FROM song_info ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            except sqlite3.Error as e:
+                logger.warning(f'Error while writing song info cache: {e}')
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+
+def iter_json_array(f: BinaryIO, key: str | None = None, chunk_size: int = json_chunk_size) -> Iterator:
+    """Elements of the JSON array at the top level of `f`, or under `key` of the top level object, parsed one at a time while reading
+    `chunk_size` bytes at a time. Only the element being parsed is held in memory, the document as a whole is never materialized."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_tail = re.compile(r'[0-9.eE+-]*')
+    buffer, pos = '', 0
+
+    def read() -> bool:
+        nonlocal buffer, pos
+        chunk = f.read(max(chunk_size, len(buffer) - pos))  # grows with the unparsed rest so that a huge element is not reparsed per chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk, final=not chunk)
+        pos = 0
+        return bool(chunk)
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            pos = whitespace.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not read():
+                return ''
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError(f'Expected one of {chars!r} at {pos}, got {char!r}')
+        pos += 1
+        return char
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                result, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if read():  # the value continues in the next chunk
+                    continue
+                raise
+            if type(result) in (int, float) and number_tail.fullmatch(buffer, end) and read():  # the number may continue in the next chunk
+                continue
+            pos = end
+            return result
+
+    if key is not None:
+        expect('{')
+        while peek() != '}':
+            found = value() == key
+            expect(':')
+            if found:
+                break
+            value()
+            if expect(',}') == '}':
+                return
+        else:
+            return
+    expect('[')
+    if peek() == ']':
+        return
+    while True:
+        yield value()
+        if expect(',]') == ']':
+            return
+
+
+def parse_history(f: BinaryIO) -> Iterator[Tuple[str, SongInfo]]:
+    for entry in iter_json_array(f):
+        try:
+            track = entry['track']
+            yield str(track['id']), SongInfo.create(
+                cover=track['album']['picUrl'],
+                album=track['album']['name'],
+                duration=track['duration'] / 1000,
+                artist='/'.join([x['name'] for x in track['artists']]),
+                title=track['name'],
+            )
+        except (KeyError, TypeError):  # skip malformed entries instead of failing the whole file
+            continue
+
+
+def parse_playing_list(f: BinaryIO) -> Iterator[Tuple[str, SongInfo | None]]:
+    for entry in iter_json_array(f, 'list'):
+        song_id = str(entry.get('id', ''))
+        try:
+            track = entry['track']
+            yield song_id, SongInfo.create(
+                cover=track['album']['cover'],
+                album=track['album']['name'],
+                duration=track.get('duration', 0) / 1000 if track.get('duration', 0) else 0,
+                artist='/'.join([x['name'] for x in track['artists']]),
+                title=track['name'],
+            )
+        except (KeyError, TypeError):  # keep the ID so the queue order stays complete, metadata has to come from elsewhere
+            yield song_id, None
+
+
+class TrackFileIndex:
+    """id -> SongInfo index over one of NCM's webdata files.
+    The file is streamed once and only re-parsed when its content changes, so lookups are O(1) dict hits.
+    Hits don't touch the file at all, a miss while the file has changed streams it only as far as the song."""
+
+    def __init__(self, path: str, parse: Callable[[BinaryIO], Iterator[Tuple[str, SongInfo | None]]]):
+        self.path = path
+        self.parse = parse
+        self.lock = Lock()
+        self.stamp: Tuple[int, int] | None = None  # (mtime_ns, size) of the file the index was built from
+        self.digest = b''  # of the content the index was built from, NCM often rewrites the file unchanged
+        self.tracks: Dict[str, SongInfo] = {}
+        self.order: List[str] = []  # song IDs in file order, including entries without usable metadata
+
+    def file_stamp(self) -> Tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self) -> Dict[str, SongInfo]:
+        """Rebuild the index if the file changed on disk. Returns the tracks that are new or changed since the last build."""
+        with self.lock:
+            stamp = self.file_stamp()
+            if stamp is None:
+                self.stamp, self.digest, self.tracks, self.order = None, b'', {}, []
+                return {}
+            if stamp == self.stamp:
+                return {}
+            try:
+                with open(self.path, 'rb') as f:
+                    digest = hashlib.blake2b(digest_size=16)
+                    for chunk in iter(lambda: f.read(json_chunk_size), b''):
+                        digest.update(chunk)
+                    digest = digest.digest()
+                    if digest == self.digest:
+                        self.stamp = stamp
+                        return {}
+                    f.seek(0)
+                    tracks: Dict[str, SongInfo] = {}
+                    order: List[str] = []
+                    seen = set()
+                    for song_id, song_info in self.parse(f):
+                        if song_id in seen:  # first occurrence wins, same as the old linear scan
+                            continue
+                        seen.add(song_id)
+                        order.append(song_id)
+                        if song_info is not None:
+                            tracks[song_id] = song_info
+            except Exception as e:  # NCM may be halfway through rewriting the file, keep the old index and retry next time
+                logger.warning(f'Error while indexing {self.path}: {e}')
+                return {}
+            changed = {song_id: song_info for song_id, song_info in tracks.items() if self.tracks.get(song_id) != song_info}
+            self.stamp, self.digest, self.tracks, self.order = stamp, digest, tracks, order
+            return changed
+
+    def get(self, song_id: str) -> SongInfo | None:
+        song_info = self.tracks.get(song_id)
+        if song_info is None and self.file_stamp() != self.stamp:
+            song_info = self.find(song_id)
+        return song_info
+
+    def find(self, song_id: str) -> SongInfo | None:
+        """Streams the file up to the first entry of `song_id` without touching the index, which FileWatcher or refresh() rebuild."""
+        try:
+            with open(self.path, 'rb') as f:
+                for entry_id, song_info in self.parse(f):
+                    if entry_id == song_id:
+                        return song_info
+        except Exception as e:
+            logger.warning(f'Error while reading {self.path}: {e}')
+        return None
+
+    def following(self, song_id: str, count: int) -> List[str]:
+        """Up to `count` song IDs after `song_id` in file order, wrapping around like NCM's list loop."""
+        self.refresh()
+        order = self.order
+        try:
+            start = order.index(song_id) + 1
+        except ValueError:
+            return []
+        return [order[(start + i) % len(order)] for i in range(min(count, len(order) - 1))]
+
+
+class FileWatcher:
+    """Keeps TrackFileIndexes up to date from a background thread and pushes their new tracks into the song info cache,
+    so a song NCM has written to its webdata files is a cache hit by the time it plays. Also writes what the cache left for SongInfoCache.flush().
+    Files are polled with os.stat(), a change is only read once the file has stopped changing for `debounce` seconds."""
+
+    def __init__(self, indexes: List[Tuple[str, TrackFileIndex]], cache: SongInfoCache, interval: float = file_watch_interval, debounce: float = file_watch_debounce):
+        self.indexes = indexes  # (source, index)
+        self.cache = cache
+        self.interval = interval
+        self.debounce = debounce
+        self.changes: Dict[str, Tuple[Tuple[int, int] | None, float]] = {}  # path -> (stamp, time first seen) of files waiting to settle
+        self.stop_event = ThreadingEvent()
+        self.thread: Thread | None = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, name='FileWatcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.poll(time.time())
+            except Exception as e:
+                logger.warning(f'Error while watching NCM files: {e}')
+            if self.stop_event.wait(self.interval):
+                return
+
+    def poll(self, now: float) -> int:
+        """Checks every file once. Returns the number of tracks pushed into the cache."""
+        pushed = 0
+        for source, index in self.indexes:
+            stamp = index.file_stamp()
+            if stamp == index.stamp:
+                self.changes.pop(index.path, None)
+                continue
+            change = self.changes.get(index.path)
+            if change is None or change[0] != stamp:  # still being written, wait for it to settle
+                self.changes[index.path] = (stamp, now)
+                continue
+            if now - change[1] < self.debounce:
+                continue
+            del self.changes[index.path]
+            changed = index.refresh()
+            if changed:
+                self.cache.put_many(changed.items(), source)
+                logger.debug('Cached %d new tracks from %s', len(changed), index.path)
+                pushed += len(changed)
+        self.cache.flush()
+        return pushed
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout for requests that don't set one, which requests.Session has no setting for."""
+
+    def __init__(self, timeout: float | Tuple[float, float] = netease_http_timeout, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def pool_netease_session(session, timeout: float | Tuple[float, float] = netease_http_timeout, pool_size: int = netease_pool_size):
+    """Mounts a keep-alive connection pool with timeouts on pyncm's session, which all NetEase lookups share."""
+    adapter = TimeoutHTTPAdapter(timeout=timeout, pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+class NegativeCache:
+    """Song IDs NetEase lookups failed for and when to try them again, so that a cloud drive upload coming back into rotation
+    doesn't cost a request every time. IDs NetEase doesn't know back off from `not_found_backoff`, network errors and timeouts
+    from the much shorter `error_backoff`, both doubling per consecutive failure of the ID."""
+
+    def __init__(self, not_found_backoff: float = netease_not_found_backoff, not_found_max_backoff: float = netease_not_found_max_backoff,
+                 error_backoff: float = netease_error_backoff, error_max_backoff: float = netease_error_max_backoff, max_entries: int = netease_misses_max_entries):
+        self.not_found_backoff = not_found_backoff
+        self.not_found_max_backoff = not_found_max_backoff
+        self.error_backoff = error_backoff
+        self.error_max_backoff = error_max_backoff
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries: OrderedDict[str, Tuple[float, int]] = OrderedDict()  # song_id -> (retry at, consecutive failures)
+
+    def blocked(self, song_id: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(song_id)
+            return entry is not None and time.time() < entry[0]
+
+    def failed(self, song_ids: Iterable[str], not_found: bool):
+        backoff, max_backoff = (self.not_found_backoff, self.not_found_max_backoff) if not_found else (self.error_backoff, self.error_max_backoff)
+        now = time.time()
+        with self.lock:
+            for song_id in song_ids:
+                failures = self.entries.pop(song_id, (0, 0))[1] + 1
+                self.entries[song_id] = (now + min(backoff * 2 ** (failures - 1), max_backoff), failures)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def succeeded(self, song_ids: Iterable[str]):
+        with self.lock:
+            for song_id in song_ids:
+                self.entries.pop(song_id, None)
+
+
+class NeteaseError(Exception):
+    """NetEase answered a request with an error code instead of song details."""
+
+
+def fetch_song_infos_from_netease(song_ids: List[str], track_api=None) -> Dict[str, SongInfo]:
+    """Resolve several songs with a single GetTrackDetail request.
+    IDs that NetEase does not know are left out, and so are IDs whose last lookup failed until netease_misses lets them be retried."""
+    song_ids = [song_id for song_id in song_ids if not netease_misses.blocked(song_id)]
+    if not song_ids:
+        return {}
+    try:
+        response = (track_api or apis.track).GetTrackDetail(song_ids)
+        if response.get('code') != 200:  # rate limiting and anti-crawler answers like 405 and -460 come without songs, but don't mean the songs are unknown
+            raise NeteaseError(f"NetEase answered with code {response.get('code')}: {response.get('message') or response.get('msg')}")
+        song_infos = {str(song_info_raw['id']): SongInfo.create(
+            cover=song_info_raw['al']['picUrl'],
+            album=song_info_raw['al']['name'],
+            duration=song_info_raw['dt'] / 1000,
+            artist='/'.join([x['name'] for x in song_info_raw['ar']]),
+            title=song_info_raw['name'],
+        ) for song_info_raw in response.get('songs') or []}
+    except (RequestException, OSError, NeteaseError, KeyError, TypeError, AttributeError):  # transient, or song details that don't parse
+        netease_misses.failed(song_ids, not_found=False)
+        raise
+    # A 200 answer without some of the songs, the usual answer for a cloud drive upload
+    netease_misses.succeeded(song_infos)
+    netease_misses.failed([song_id for song_id in song_ids if song_id not in song_infos], not_found=True)
+    return song_infos
+
+
+def lookup_netease(song_id: str) -> SongInfo | None:
+    try:
+        return fetch_song_infos_from_netease([song_id]).get(song_id)
+    except Exception as e:  # normal to fail when playing a cloud drive uploaded file since song ID is not public
+        logger.warning(f'Error while reading {song_id} from remote: {e!r}')
+        return None
+
+
+class Prefetcher:
+    """Resolves the tracks queued after the current song in playingList on a background thread,
+    so that the presence update on song change is a cache hit instead of a blocking lookup.
+    Tracks not in the cache or the local files are fetched from NetEase in batched multi-ID requests."""
+
+    def __init__(self, queue_index: TrackFileIndex, indexes: List[Tuple[str, TrackFileIndex]], cache: SongInfoCache, track_api=None,
+                 count: int = prefetch_count, batch_size: int = netease_batch_size):
+        self.queue_index = queue_index  # playingList, the order of the queue
+        self.indexes = indexes  # (source, index) local files to take song info from before asking NetEase
+        self.cache = cache
+        self.track_api = track_api  # pyncm apis.track by default, can be swapped for a stub
+        self.count = count
+        self.batch_size = batch_size
+        self.pending = ''  # only the latest requested song matters, older requests are dropped
+        self.lock = Lock()
+        self.event = ThreadingEvent()
+        self.thread: Thread | None = None
+
+    def request(self, song_id: str):
+        with self.lock:
+            self.pending = song_id
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.event.set()
+
+    def _run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            with self.lock:
+                song_id, self.pending = self.pending, ''
+            if song_id:
+                try:
+                    self.prefetch(song_id)
+                except Exception as e:
+                    logger.warning(f'Error while prefetching upcoming songs: {e}')
+
+    def prefetch(self, song_id: str) -> int:
+        """Resolve the songs after `song_id` into the cache. Returns the number of songs fetched from NetEase."""
+        missing = []
+        for upcoming_id in self.queue_index.following(song_id, self.count):
+            if self.cache.get(upcoming_id) is not None:
+                continue
+            for source, index in self.indexes:
+                song_info = index.get(upcoming_id)
+                if song_info is not None:
+                    self.cache.put(upcoming_id, song_info, source)
+                    break
+            else:
+                missing.append(upcoming_id)
+        fetched = 0
+        for i in range(0, len(missing), self.batch_size):
+            for fetched_id, song_info in fetch_song_infos_from_netease(missing[i:i + self.batch_size], self.track_api).items():
+                self.cache.put(fetched_id, song_info, 'netease')
+                fetched += 1
+        if fetched:
+            logger.debug('Prefetched %d upcoming songs from NetEase', fetched)
+        return fetched
+
+
+class SongInfoResolver:
+    """Resolves song info off the update tick.
+    All lookup sources run concurrently in a thread pool executor of the event loop and the first one that finds the song wins.
+    Each source is given up on after its own timeout, and concurrent requests for the same song share a single lookup.
+    Songs no source could find are remembered as misses until `forget` is called for them, a file index picking them up later still wins through the cache."""
+
+    def __init__(self, sources: List[Tuple[str, Callable[[str], SongInfo | None]]], cache: SongInfoCache, loop: asyncio.AbstractEventLoop,
+                 timeouts: Dict[str, float] = resolver_timeouts, max_misses: int = resolver_misses_max_entries):
+        self.sources = sources
+        self.cache = cache
+        self.loop = loop
+        self.timeouts = timeouts
+        self.pool = ThreadPoolExecutor(max_workers=len(sources) * 2, thread_name_prefix='SongInfoResolver')
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.misses: OrderedDict[str, None] = OrderedDict()
+        self.max_misses = max_misses
+
+    def resolve(self, song_id: str) -> asyncio.Future:
+        """Future of the SongInfo for `song_id`, None if no source could find it. Already done on a cache hit or a remembered miss. Must be called on `loop`."""
+        song_info = self.cache.get(song_id)
+        if song_info is not None or song_id in self.misses:
+            metrics.inc('ncm_song_info_lookups_total', source='cache', result='hit' if song_info is not None else 'known_miss')
+            future = self.loop.create_future()
+            future.set_result(song_info)
+            return future
+        if song_id not in self.in_flight:
+            metrics.inc('ncm_song_info_lookups_total', source='cache', result='miss')
+            self.in_flight[song_id] = self.loop.create_task(self._resolve(song_id))
+        return self.in_flight[song_id]
+
+    async def _resolve(self, song_id: str) -> SongInfo | None:
+        song_info = None
+        pending = {}
+        try:
+            start = self.loop.time()
+            pending = {self.loop.run_in_executor(self.pool, lookup, song_id): name for name, lookup in self.sources}
+            while pending and song_info is None:
+                deadline = min(self.timeouts.get(name, 10) for name in pending.values())
+                done, _ = await asyncio.wait(pending, timeout=max(start + deadline - self.loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:  # the source with the shortest remaining timeout ran out of time
+                    for source_future, name in list(pending.items()):
+                        if self.loop.time() - start >= self.timeouts.get(name, 10):
+                            logger.warning(f'Timed out while looking up {song_id} from {name}')
+                            metrics.observe('ncm_song_info_lookup_seconds', self.loop.time() - start, source=name)
+                            metrics.inc('ncm_song_info_lookups_total', source=name, result='timeout')
+                            del pending[source_future]
+                    continue
+                for source_future in done:
+                    name = pending.pop(source_future)
+                    metrics.observe('ncm_song_info_lookup_seconds', self.loop.time() - start, source=name)
+                    try:
+                        result = source_future.result()
+                    except Exception as e:
+                        logger.warning(f'Error while looking up {song_id} from {name}: {e}')
+                        metrics.inc('ncm_song_info_lookups_total', source=name, result='error')
+                        continue
+                    metrics.inc('ncm_song_info_lookups_total', source=name, result='miss' if result is None else 'hit')
+                    if result is not None and song_info is None:
+                        song_info = result
+                        self.cache.put(song_id, song_info, name)
+        finally:
+            del self.in_flight[song_id]
+            if song_info is None:
+                self.misses[song_id] = None
+                while len(self.misses) > self.max_misses:
+                    self.misses.popitem(last=False)
+            for source_future in pending:  # lookups that lost or timed out still finish in the pool, their errors are of no interest
+                source_future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return song_info
+
+    def forget(self, song_id: str):
+        """Looks `song_id` up again on the next `resolve` if it was a miss, e.g. once it starts playing anew. Must be called on `loop`."""
+        self.misses.pop(song_id, None)
+
+
+class V2OffsetDiscovery:
+    """Finds the `current` and `song_array` offsets of a 2.x build missing from `offsets` while a song is playing, replacing the manual scanning.ipynb workflow.
+    Each step bulk-reads the writable sections of cloudmusic.dll. `current` candidates are doubles that advance by the elapsed time between steps,
+    `song_array` candidates are 32-bit pointers to a UTF-16 song ID. Candidates have to hold up for several consecutive steps,
+    and offsets are only returned once a single `current` candidate is left. Other clocks are told apart by the real position starting over on a song change.
+    Time only counts towards the timeout once a song change has shown that songs are being played, an NCM left paused can't be told apart before."""
+    re_song_id_utf16 = re.compile(r'\d{5,10}(?:_|$)')
+
+    def __init__(self, reader: MemoryReader, module: dict, confirmations: int = v2_discovery_confirmations):
+        self.reader = reader
+        self.base = module['base']
+        self.size = module['size']
+        self.sections = module_sections(reader, self.base, self.size, IMAGE_SCN_MEM_WRITE)
+        self.confirmations = confirmations
+        self.played = 0.0  # seconds of steps with candidates since the first song change, counted towards v2_discovery_timeout
+        self.next_song_array_scan = 0.0
+        self.previous: Tuple[float, Dict[int, bytes]] | None = None
+        self.current_candidates: List[int] | None = None  # module offsets
+        self.song_array_candidates: List[int] | None = None
+        self.confirmed = 0
+        self.song_id = ''  # song the song_array candidates showed on the last step
+        self.song_changes = 0
+        self.reset_steps = 0  # steps left after a song change for the current candidates to start over
+        self.reset_candidates: set = set()  # current candidates that have started over since the last song change
+        self.ambiguous = False  # the user was asked to skip a song
+
+    def read_sections(self) -> Dict[int, bytes]:
+        return {address: self.reader.read_region(address, size - size % 8, chunk_size=0x100000) for address, size in self.sections}
+
+    def decode_song_id(self, pointer: int, pages: Dict[int, bytes | None] | None = None) -> str:
+        """Song ID behind a song_array pointer, '' if there is none. `pages` caches 4 KB pages for bulk decoding of many pointers."""
+        try:
+            if pages is None:
+                raw = self.reader.r_bytes(pointer, 0x14)
+            else:
+                raw = b''
+                for page in (pointer - pointer % 0x1000, pointer - pointer % 0x1000 + 0x1000):
+                    if page not in pages:
+                        try:
+                            pages[page] = self.reader.r_bytes(page, 0x1000)
+                        except Exception:
+                            pages[page] = None
+                    if pages[page] is None:
+                        return ''
+                    raw += pages[page]
+                raw = raw[pointer % 0x1000:pointer % 0x1000 + 0x14]
+            song_str = raw.decode('utf-16-le')
+        except Exception:
+            return ''
+        return song_str.split('_')[0] if self.re_song_id_utf16.match(song_str) else ''
+
+    def find_current_candidates(self, before: Dict[int, bytes], after: Dict[int, bytes], elapsed: float) -> List[int]:
+        candidates = []
+        for address, data in after.items():
+            previous = before[address]
+            for block in range(0, len(data), 0x1000):  # only unpack blocks that changed
+                if data[block:block + 0x1000] == previous[block:block + 0x1000]:
+                    continue
+                old_values = memoryview(previous)[block:block + 0x1000].cast('d')
+                new_values = memoryview(data)[block:block + 0x1000].cast('d')
+                for i, (old, new) in enumerate(zip(old_values, new_values)):
+                    if new != old and 0 <= old < 24 * 60 * 60 and abs(new - old - elapsed) < 0.3:
+                        candidates.append(address - self.base + block + i * 8)
+        return candidates
+
+    def find_song_array_candidates(self, sections: Dict[int, bytes]) -> List[int]:
+        pointers: Dict[int, List[int]] = {}  # pointer -> module offsets holding it
+        for address, data in sections.items():
+            for i, value in enumerate(memoryview(data).cast('I')):
+                if 0x10000 <= value < 0x7FFF0000 and not value & 1 and not self.base <= value < self.base + self.size:
+                    pointers.setdefault(value, []).append(address - self.base + i * 4)
+        pages: Dict[int, bytes | None] = {}
+        return sorted(offset for pointer, holders in pointers.items() if self.decode_song_id(pointer, pages) for offset in holders)
+
+    def step(self) -> Dict[str, int] | None:
+        """Advance discovery by one tick. Returns the offsets once confirmed."""
+        now = time.time()
+        sections = self.read_sections()
+        if self.previous is None:
+            self.previous = now, sections
+            return None
+        previous_time, previous_sections = self.previous
+        self.previous = now, sections
+        elapsed = now - previous_time
+
+        pages: Dict[int, bytes | None] = {}
+        if self.song_array_candidates is None:
+            if now < self.next_song_array_scan:
+                return None
+            self.song_array_candidates = self.find_song_array_candidates(sections)
+        pointers = {offset: self.read_uint(sections, offset) for offset in self.song_array_candidates}
+        song_ids = {offset: self.decode_song_id(pointer, pages) for offset, pointer in pointers.items()}
+        # All real song_array pointers show the same song, prefer songs in the play queue over other strings that look like IDs
+        queued = set(playing_list_index.order)
+        votes = Counter(song_id for song_id in song_ids.values() if song_id and (not queued or song_id in queued))
+        song_id = votes.most_common(1)[0][0] if votes else ''
+        self.song_array_candidates = [offset for offset in self.song_array_candidates if song_ids[offset] == song_id]
+        if self.song_id and song_id and song_id != self.song_id:  # the real position starts over with the next song, other clocks keep running
+            self.song_changes += 1
+            self.reset_steps = v2_discovery_reset_steps
+            self.reset_candidates = set()
+        self.song_id = song_id
+
+        if self.current_candidates is None:
+            self.current_candidates = self.find_current_candidates(previous_sections, sections, elapsed)
+        else:
+            current_candidates = []
+            for offset in self.current_candidates:
+                old, new = self.read_double(previous_sections, offset), self.read_double(sections, offset)
+                if new != old and abs(new - old - elapsed) < 0.3:
+                    current_candidates.append(offset)
+                elif self.reset_steps and 0 <= new < min(old, elapsed + 0.3):
+                    current_candidates.append(offset)
+                    self.reset_candidates.add(offset)
+            if self.reset_steps:
+                self.reset_steps -= 1
+                if not self.reset_steps:
+                    current_candidates = [offset for offset in current_candidates if offset in self.reset_candidates]
+            self.current_candidates = current_candidates
+
+        if not self.current_candidates or not self.song_array_candidates:
+            # Paused, seeking or switching songs. Start over from this tick, the song_array candidates still showing the song are kept
+            logger.debug('V2 offset discovery found no stable candidates, restarting. Make sure a song is playing.')
+            self.current_candidates = None
+            if not self.song_array_candidates:
+                self.song_array_candidates = None
+                self.next_song_array_scan = now + v2_discovery_rescan_interval
+            self.song_id = ''
+            self.reset_steps = 0
+            self.confirmed = 0
+            return None
+        self.confirmed += 1
+        if self.song_changes:
+            self.played += elapsed
+        logger.debug('V2 offset discovery: %d current and %d song_array candidates', len(self.current_candidates), len(self.song_array_candidates))
+        if self.confirmed < self.confirmations or self.reset_steps:
+            return None
+        # Other doubles can advance with the clock too and pointers elsewhere can show the same song, only a song change tells them apart
+        if len(self.current_candidates) > 1 or (len({pointers[offset] for offset in self.song_array_candidates}) > 1 and not self.song_changes):
+            if not self.ambiguous:
+                logger.info('Several candidates for the V2 offsets remain, skip to the next song to finish discovering them.')
+                self.ambiguous = True
+            return None
+        return {'current': self.current_candidates[0], 'song_array': self.song_array_candidates[0]}
+
+    def read_double(self, sections: Dict[int, bytes], offset: int) -> float:
+        address = self.base + offset
+        section = max(a for a in sections if a <= address)
+        return struct.unpack_from('<d', sections[section], address - section)[0]
+
+    def read_uint(self, sections: Dict[int, bytes], offset: int) -> int:
+        address = self.base + offset
+        section = max(a for a in sections if a <= address)
+        return struct.unpack_from('<I', sections[section], address - section)[0]
+
+
+def read_file_version(exe_path: str) -> str:
+    from win32api import GetFileVersionInfo, HIWORD, LOWORD  # Windows only
+    ver_info = GetFileVersionInfo(exe_path, '\\')
+    return (f"{HIWORD(ver_info['FileVersionMS'])}.{LOWORD(ver_info['FileVersionMS'])}."
+            f"{HIWORD(ver_info['FileVersionLS'])}.{LOWORD(ver_info['FileVersionLS'])}")
+
+
+class ProcessWatcher:
+    """Finds the main cloudmusic.exe process without redoing the expensive parts of the search every time.
+    Renderer child processes (--type=...) are remembered so their command lines are only fetched once, file versions are cached
+    by exe path and mtime, and while NCM is not running the process list is rescanned with exponential backoff."""
+
+    def __init__(self, process_iter: Callable = None, version_reader: Callable[[str], str] = read_file_version,
+                 min_backoff: float = idle_interval, max_backoff: float = process_scan_max_backoff):
+        self.process_iter = process_iter or psutil.process_iter  # can be swapped for a fake process table
+        self.version_reader = version_reader
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.next_scan = 0.0
+        self.renderers: Dict[int, float] = {}  # PID -> create time of known renderer processes, the create time tells reused PIDs apart
+        self.versions: Dict[str, Tuple[float, str]] = {}  # exe path -> (mtime, version)
+
+    def find(self) -> List[Tuple[int, str]]:
+        """scan(), unless NCM was missing on the last scans and the backoff hasn't passed yet."""
+        now = time.time()
+        if now < self.next_scan:
+            return []
+        found = self.scan()
+        if found:
+            self.backoff = 0.0
+            self.next_scan = 0.0
+        else:
+            self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+            self.next_scan = now + self.backoff
+        return found
+
+    def scan(self) -> List[Tuple[int, str]]:
+        """(PID, version) of every main cloudmusic.exe process, e.g. one per logged in Windows user, empty if NCM is not running."""
+        candidates = []
+        renderers = {}
+        for proc in self.process_iter(attrs=['name', 'pid', 'create_time']):
+            if proc.info['name'] != 'cloudmusic.exe':
+                continue
+            proc_pid, create_time = proc.info['pid'], proc.info['create_time']
+            if self.renderers.get(proc_pid) == create_time:
+                renderers[proc_pid] = create_time
+                continue
+            try:
+                cmdline = proc.cmdline()
+                if any('--type=' in arg for arg in cmdline):
+                    renderers[proc_pid] = create_time
+                    continue
+                candidates.append(proc)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        self.renderers = renderers  # forget renderers that exited
+        found = []
+        for proc in candidates:
+            try:
+                found.append((proc.info['pid'], self.version(proc.exe())))
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return found
+
+    def version(self, exe_path: str) -> str:
+        mtime = os.path.getmtime(exe_path)
+        cached = self.versions.get(exe_path)
+        if cached is None or cached[0] != mtime:
+            cached = self.versions[exe_path] = (mtime, self.version_reader(exe_path))
+        return cached[1]
+
 
 class Status(IntFlag):
-    playing = auto()  # Song id unchanged and time += interval
+    playing = auto()  # Song id unchanged and time += time since last sample
     paused = auto()  # Song id unchanged and time unchanged
     changed = auto()  # Song id changed or time changed manually
+    idle = auto()  # Paused for longer than pause_timeout, presence is cleared
 
 
 class UnsupportedVersionError(Exception):
@@ -125,19 +1575,119 @@ def sec_to_str(sec: float) -> str:
     return f'{m:02.00f}:{s:05.02f}'
 
 
-def connect_discord(presence: Presence) -> bool:
+class TraceSample(NamedTuple):
+    time: float
+    song_id: str | None  # None while NCM is not running
+    current: float
+
+
+def write_trace_sample(file, sample: TraceSample):
+    file.write(orjson.dumps(tuple(sample)).decode() + '\n')
+
+
+def read_trace(path: str) -> Iterator[TraceSample]:
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield TraceSample(*orjson.loads(line))
+
+
+class PlaybackState:
+    """Tells playing, paused and changed apart from the (time, song ID, progress) samples read on each tick.
+    Kept apart from the memory reading and its globals so that recorded or synthetic traces can be replayed through it with their own clock."""
+
+    def __init__(self, pause_timeout: float = pause_timeout, tolerance: float = progress_tolerance, min_gap: float = interval * 0.9):
+        self.pause_timeout = pause_timeout
+        self.tolerance = tolerance
+        self.min_gap = min_gap  # shortest gap between two samples that are compared
+        self.last_status = Status.changed
+        self.last_id = ''
+        self.last_float = 0.0
+        self.last_sample_time = 0.0  # when last_float was read
+        self.last_change_time = 0.0  # last Status.changed, fast polling continues for fast_period after it
+        self.last_pause_time = 0.0
+
+    def observe(self, now: float, song_id: str, current_float: float, refresh: bool = False) -> Status | None:
+        """Status to show presence for after this sample, Status.idle to clear presence or None to leave it as it is.
+        `refresh` asks for presence even if nothing changed, e.g. because song info for a placeholder arrived. Unless None is
+        returned, the sample has to be passed on to record() once presence has been taken care of."""
+        elapsed = now - self.last_sample_time
+        same_song = song_id == self.last_id
+        if same_song and elapsed < self.min_gap and not refresh:
+            # Too soon after the last sample to tell playing, paused and seeking apart reliably, fast ticks only act on song changes
+            return None
+        # Progress since the last sample should match the elapsed time (+- tolerance)
+        status = (Status.playing if same_song and abs(current_float - self.last_float - elapsed) < self.tolerance
+                  else Status.paused if same_song and current_float == self.last_float
+        else Status.changed)
+        if status == Status.playing:
+            if self.last_status != Status.paused and not refresh:  # Nothing changed
+                self.last_float = current_float
+                self.last_sample_time = now
+                self.last_status = Status.playing
+                return None
+            elif self.last_status == Status.paused:  # we resumed from pause, the publisher reconnects if needed
+                tick_debug('Resumed')
+
+        elif status == Status.paused:
+            if self.last_status == Status.paused and not refresh:  # Nothing changed but check if it is idle/paused for more than 30min, clear presence but keep connection alive to avoid reconnection throttling.
+                return Status.idle if now - self.last_pause_time > self.pause_timeout else None
+            elif self.last_status == Status.playing:
+                tick_debug('Paused')
+                self.last_pause_time = now
+
+        elif status == Status.changed:
+            self.last_pause_time = now  # reset timeout as changed indicates something happened
+            self.last_change_time = now
+        return status
+
+    def next_interval(self, now: float) -> float:
+        if now - self.last_change_time < fast_period:
+            return fast_interval
+        if self.last_status == Status.paused:
+            return paused_interval
+        return interval
+
+    def record(self, now: float, song_id: str, current_float: float, status: Status | None):
+        """Takes the sample as the one the next is compared to, `status` is what presence was shown for, None if it could not be."""
+        self.last_id = song_id
+        self.last_float = current_float
+        self.last_sample_time = now
+        if status in (Status.playing, Status.paused):  # only store play/pause status for ease of detection above
+            self.last_status = status
+
+
+def presence_payload(pid: int, song_id: str, song_info: SongInfo, status: Status, current_float: float, now: float) -> dict:
+    """Keyword arguments of Presence.update for `song_info` at `current_float` seconds into the song at `now`."""
+    return dict(pid=pid,
+                state=f"{song_info.artist} | {song_info.album}" if song_info.artist else None,
+                details=song_info.title.center(2),
+                large_image=song_info.cover,
+                large_text=song_info.album.center(2) if song_info.album else None,
+                small_image='play' if status != Status.paused else 'pause',
+                small_text='Playing' if status != Status.paused else 'Paused',
+                start=int(now - current_float)
+                if status != Status.paused else None,
+                # Known issue: buttons do not appear on PC due to discord API changes: https://github.com/qwertyquerty/pypresence/issues/237
+                buttons=[{'label': 'Listen on NetEase',
+                          'url': f'https://music.163.com/#/song?id={song_id}'}]
+                )
+
+
+async def connect_discord(presence: AioPresence, raise_not_found: bool = False) -> bool:
+    """Connects `presence`, False if it failed. DiscordNotFound is raised with `raise_not_found`, for callers that tell the user."""
     global connected
     try:
-        presence.connect()
+        await presence.connect()
     except DiscordNotFound:
         connected = False
         logger.warning('Discord not found.')
-        if not start_minimized:
-            root.after(0, lambda: messagebox.showerror('Discord not found', 'Could not detect a running Discord instance. Please make sure Discord is running and try again. Do not use BetterDiscord or other 3rd party clients.'))
+        if raise_not_found:
+            raise
         return False
     except Exception as e:
         connected = False
-        logger.warning('Error while connecting to Discord:', e)
+        logger.warning(f'Error while connecting to Discord: {e}')
         return False
     else:
         connected = True
@@ -145,13 +1695,19 @@ def connect_discord(presence: Presence) -> bool:
         return True
 
 
-def disconnect_discord(presence: Presence):
+def close_presence(presence: AioPresence):
+    """AioPresence.close() also closes the event loop it runs on, which is shared with everything else, so only the pipe is closed here."""
+    presence.send_data(2, {'v': 1, 'client_id': presence.client_id})
+    presence.sock_writer.close()
+
+
+async def disconnect_discord(presence: AioPresence):
     global connected
     try:
-        presence.clear()
-        presence.close()
+        await presence.clear()
+        close_presence(presence)
     except Exception as e:
-        logger.warning(f'Error while disconnecting Discord:', e)
+        logger.warning('Error while disconnecting Discord: %s', e)
         connected = False  # set to false anyways because the only reason why it could fail is due to already disconnected/already closed async loop, which means it is disconnected already
         return False
     else:
@@ -160,39 +1716,496 @@ def disconnect_discord(presence: Presence):
         return True
 
 
+class PresencePublisher:
+    """Sends presence to Discord from its own task on the event loop so the update tick never waits on the IPC pipe.
+    Only the latest desired presence is kept and it is skipped if it matches what was last sent. Sends are limited by a token bucket
+    matching Discord's rate limit, the latest presence is sent once a token frees up. Lost connections are re-established with backoff."""
+    unsent = object()  # `sent` when Discord's state is unknown, e.g. after (re)connecting
+
+    def __init__(self, presence: AioPresence, loop: EventLoopThread, rate: int = presence_rate_limit, period: float = presence_rate_period):
+        self.presence = presence
+        self.loop = loop
+        self.rate = rate
+        self.period = period
+        self.lock = Lock()
+        self.event = asyncio.Event()
+        self.finished = ThreadingEvent()
+        self.finished.set()
+        self.task: Future | None = None  # of _run(), awaited by stop_tracking() on the loop
+        self.stopped = False
+        self.desired: dict | None = None  # keyword arguments of Presence.update, None to clear the presence
+        self.disconnect_requested = False
+        self.sent = self.unsent
+        self.tokens = float(rate)
+        self.refilled = time.monotonic()
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.first_published: float | None = None  # when update() first had a presence to show, for --profile-startup
+
+    def start(self):
+        self.stopped = False
+        self.sent = self.unsent
+        self.finished.clear()
+        self.task = asyncio.run_coroutine_threadsafe(self._run(), self.loop.loop)
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+        if not self.loop.in_loop():
+            self.finished.wait()
+
+    def wake(self):
+        self.loop.loop.call_soon_threadsafe(self.event.set)
+
+    def publish(self, payload: dict | None):
+        metrics.inc('ncm_presence_publishes_total', outcome='published')
+        if payload is not None and self.first_published is None:
+            self.first_published = time.perf_counter()
+        with self.lock:
+            self.desired = payload
+            self.disconnect_requested = False
+        self.wake()
+
+    def disconnect(self):
+        with self.lock:
+            self.desired = None
+            self.disconnect_requested = True
+        self.wake()
+
+    @staticmethod
+    def same(a, b) -> bool:
+        """Presences are the same if they only differ by rounding of the start timestamp."""
+        if a is None or b is None or a is PresencePublisher.unsent or b is PresencePublisher.unsent:
+            return a is b
+        return ({k: v for k, v in a.items() if k != 'start'} == {k: v for k, v in b.items() if k != 'start'}
+                and (a.get('start') is None) == (b.get('start') is None) and abs((a.get('start') or 0) - (b.get('start') or 0)) <= 2)
+
+    def take_token(self) -> float:
+        """Take a token if one is available and return 0, otherwise return the seconds until one is."""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate / self.period)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.period / self.rate
+
+    async def _run(self):
+        try:
+            while not self.stopped:
+                self.event.clear()
+                with self.lock:
+                    desired, disconnect_requested = self.desired, self.disconnect_requested
+                wait = None
+                if disconnect_requested:
+                    if connected:
+                        await disconnect_discord(self.presence)
+                    self.sent = self.unsent
+                elif self.same(desired, self.sent):
+                    metrics.inc('ncm_presence_publishes_total', outcome='unchanged')
+                elif not connected and time.monotonic() < self.next_connect:
+                    wait = self.next_connect - time.monotonic()
+                elif not connected and not await connect_discord(self.presence):
+                    self.backoff = min(max(self.backoff * 2, discord_reconnect_min_backoff), discord_reconnect_max_backoff)
+                    self.next_connect = time.monotonic() + self.backoff
+                    wait = self.backoff
+                else:
+                    self.backoff = 0.0
+                    wait = self.take_token()
+                    if not wait:
+                        await self.send(desired)
+                        continue
+                    metrics.inc('ncm_presence_publishes_total', outcome='rate_limited')
+                try:
+                    await asyncio.wait_for(self.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.finished.set()
+
+    async def send(self, payload: dict | None):
+        global connected
+        start = time.perf_counter()
+        try:
+            if payload is None:
+                await self.presence.clear()
+            else:
+                await self.presence.update(**payload)
+        except PipeClosed:
+            logger.info('Reconnecting to Discord...')
+            metrics.inc('ncm_discord_sends_total', result='pipe_closed')
+            connected = False
+            self.sent = self.unsent
+            return
+        except Exception as e:
+            logger.error('Error while updating to Discord:')
+            logger.exception(e)
+            metrics.inc('ncm_discord_sends_total', result='error')
+        else:
+            metrics.observe('ncm_discord_send_seconds', time.perf_counter() - start)
+            metrics.inc('ncm_discord_sends_total', result='clear' if payload is None else 'update')
+            if payload is not None and startup_profile is not None and 'first_presence' not in startup_profile.phases:
+                profile_phase('first_presence', self.first_published)
+                stop_variable.set()  # the profile is complete, quit_app() writes the report
+                post_to_ui(quit_app)
+        self.sent = payload  # also after other errors, retrying the same payload would most likely fail the same way
+
+
+def replay_trace(samples: Iterable[TraceSample], song_info_for: Callable[[str], SongInfo], state: PlaybackState | None = None) -> List[Tuple[float, dict | None]]:
+    """Feeds samples through the status detection like update() does, with their timestamps as the clock and song info from `song_info_for`.
+    Returns the (time, presence) pairs that would have been sent, None for cleared presence, after the publisher's deduplication."""
+    state = state or PlaybackState()
+    sent = []
+    last = PresencePublisher.unsent
+    for now, song_id, current_float in samples:
+        if song_id is None:  # NCM not running
+            payload = None
+        else:
+            status = state.observe(now, song_id, current_float)
+            if status is None:
+                continue
+            payload = None if status == Status.idle else presence_payload(0, song_id, song_info_for(song_id), status, current_float, now)
+            if status != Status.idle:
+                state.record(now, song_id, current_float, status)
+        if not PresencePublisher.same(payload, last):
+            sent.append((now, payload))
+            last = payload
+    return sent
+
+
+class UiState(NamedTuple):
+    """What the window and the tray icon's tooltip show. The update tick publishes a new one whenever it changes, they are never modified."""
+    title: str
+    artist: str
+
+    def tooltip(self) -> str:
+        if not self.artist:
+            return 'Netease Cloud Music Discord RPC'
+        return f'{self.title} - {self.artist}'[:127]  # Windows limits tray tooltips to 128 characters
+
+
+no_song = UiState('N/A', '')
+
+
+class UiBridge:
+    """Hands the latest UiState from the update tick to the Tk thread through a single slot.
+    publish() only replaces the slot, and posts a drain to Tk if the state differs and no drain is pending yet, so an unchanged
+    state costs nothing and superseded ones are never applied. Drains run at most once per `interval` and only set what changed."""
+
+    def __init__(self, interval: float = ui_refresh_interval):
+        self.interval = interval
+        self.lock = Lock()
+        self.slot = no_song  # latest published state
+        self.applied = no_song  # state the window and tooltip show, only used on the Tk thread
+        self.pending = False
+        self.drained_at = 0.0
+
+    def publish(self, state: UiState):
+        """Safe to call from any thread, dropped in --headless mode."""
+        with self.lock:
+            if state == self.slot:
+                return
+            self.slot = state
+            if self.pending or root is None:
+                return
+            self.pending = True
+            delay = max(self.drained_at + self.interval - time.monotonic(), 0)
+        root.after(int(delay * 1000), self.drain)
+
+    def drain(self):
+        with self.lock:
+            state, self.pending = self.slot, False
+            self.drained_at = time.monotonic()
+        applied, self.applied = self.applied, state
+        if state.title != applied.title:
+            song_title_text.set(state.title)
+        if state.artist != applied.artist:
+            song_artist_text.set(state.artist)
+        if state.tooltip() != applied.tooltip():
+            icon.title = state.tooltip()  # pystray updates the tooltip if the icon is visible
+
+
+class Tracker:
+    """One NCM process: its reader with the open handle, the offsets resolved for it and its playback state.
+    `presence` is the payload it would show and `changed_at` when its playback last changed, the supervisor shows the most recent one."""
+    __slots__ = ('pid', 'version', 'is_v3', 'reader', 'module_base', 'v2_offsets', 'v2_discovery', 'tick_plan', 'playback', 'pending_song',
+                 'presence', 'song', 'changed_at', 'unsupported')
+
+    def __init__(self, pid: int, version: str, reader: MemoryReader):
+        self.pid = pid
+        self.version = version
+        self.is_v3 = version.startswith('3.')
+        self.reader = reader
+        self.module_base = 0  # V2 cloudmusic.dll base address, stable per process
+        self.v2_offsets: Dict[str, int] | None = None  # offsets of a 2.x build, from `offsets` or discovered
+        self.v2_discovery: V2OffsetDiscovery | None = None  # set while offsets of an unknown 2.x build are being discovered
+        self.tick_plan: ReadPlan | None = None  # V3 fields read on every tick, built when offsets are resolved
+        self.playback = PlaybackState()
+        self.pending_song: asyncio.Future | None = None  # lookup of the song currently shown with placeholder presence
+        self.presence: dict | None = None
+        self.song: UiState | None = None  # for the window and tray tooltip
+        self.changed_at = 0.0
+        self.unsupported = False  # parked after its NCM version turned out to be unsupported, until its process exits
+
+    def alive(self) -> bool:
+        # While our handle is open the PID can't be reused by another process, so only its liveness is checked.
+        # The name is checked again after the handle is closed, e.g. because a read failed.
+        reader = self.reader
+        return reader.pid_exists(self.pid) and (reader.pid == self.pid or reader.process_name(self.pid) == 'cloudmusic.exe')
+
+    def close(self):
+        if self.reader.pid:
+            self.reader.close()
+
+    def resolve_offsets(self):
+        logger.info(f'Found process: {self.pid}')
+        start = time.perf_counter()
+        if self.is_v3:
+            schedule_ptr, audio_player_ptr = resolve_v3_offsets(self.reader, self.version, 'cloudmusic.dll')
+            logger.info(f'V3 offsets resolved: schedule={hex(schedule_ptr)}, player={hex(audio_player_ptr)}')
+            self.tick_plan = v3_read_plan(schedule_ptr, audio_player_ptr)
+        else:
+            module = self.reader.module('cloudmusic.dll')
+            self.module_base = module['base']
+            self.v2_offsets = offsets.get(self.version) or resolve_cached_v2_offsets(self.reader, self.version, self.module_base)
+            if self.v2_offsets is None:
+                logger.info(f'No offsets known for NCM {self.version}, discovering them. Play a song to finish.')
+                self.v2_discovery = V2OffsetDiscovery(self.reader, module)
+        profile_phase('first_offsets', start)
+        metrics.observe('ncm_offset_resolve_seconds', time.perf_counter() - start)
+
+    def discover_offsets(self) -> bool:
+        """Advances the V2 offset discovery, True once it is done."""
+        discovery = self.v2_discovery
+        self.v2_offsets = discovery.step()
+        if self.v2_offsets is None:
+            if discovery.played > v2_discovery_timeout:
+                raise UnsupportedVersionError(f"This version is not supported yet: {self.version}.\nSupported version: {', '.join(offsets.keys())}" if not is_CN else f"目前不支持此网易云音乐版本: {self.version}。\n支持的版本: {', '.join(offsets.keys())}")
+            return False
+        logger.info(f"Discovered offsets for NCM {self.version}: current={hex(self.v2_offsets['current'])}, song_array={hex(self.v2_offsets['song_array'])}")
+        offset_cache.put('v2', self.version, module_hash(self.reader, self.module_base), self.v2_offsets)
+        self.v2_discovery = None
+        return True
+
+    def tick(self, wake: Callable[[], None]):
+        """Takes one sample of the process and updates `presence` from it. `wake` runs the next tick early, once pending song info arrives."""
+        reader = self.reader
+        if not reader.pid:  # reuse the process handle, open it only when needed
+            reader.open(self.pid)
+        if self.tick_plan is None and self.v2_offsets is None and self.v2_discovery is None:
+            self.resolve_offsets()
+        if self.v2_discovery is not None and not self.discover_offsets():
+            return
+
+        start = time.perf_counter()
+        try:
+            if self.is_v3:
+                current_float, song_id = read_v3_song_state(reader, self.tick_plan)
+            else:
+                current_float, song_id = read_v2_song_state(reader, self.module_base, self.v2_offsets)
+        except Exception:
+            reader.close()  # the process may have exited, make the next tick check the PID again
+            raise
+        metrics.observe('ncm_memory_read_seconds', time.perf_counter() - start)
+
+        if not re_song_id.match(song_id):
+            # Song ID is not ready yet.
+            return
+
+        now = time.time()
+        playback = self.playback
+        if trace_file is not None:
+            write_trace_sample(trace_file, TraceSample(now, song_id, current_float))
+        # Song info for the placeholder presence has arrived since the last tick, patch it in even if nothing else changed
+        pending_song = self.pending_song
+        song_info_arrived = pending_song is not None and song_id == playback.last_id and pending_song.done()
+        status = playback.observe(now, song_id, current_float, refresh=song_info_arrived)
+        if status is None:
+            return
+        if status == Status.idle:
+            tick_debug('%d idle for more than 30min, clearing its presence.', self.pid)
+            self.presence = self.song = None
+            return
+        if status == Status.changed and song_id != playback.last_id:
+            resolver.forget(song_id)  # a song played anew gets another chance, e.g. NetEase was unreachable the last time
+            prefetcher.request(song_id)
+
+        song_future = resolver.resolve(song_id)  # never blocks, a placeholder is shown until the lookup finishes
+        if not song_future.done() and song_future is not pending_song:
+            song_future.add_done_callback(lambda _: wake())  # patch the placeholder as soon as the song info arrives
+        self.pending_song = pending_song = None if song_future.done() else song_future
+        song_info = song_future.result() if song_future.done() else None
+
+        if song_info is None and pending_song is None:
+            logger.warning(f'Could not find song info for ID: {song_id}')
+            self.presence = self.song = None  # drop the placeholder, it would otherwise stay on loading
+            # Still advance tracking state to avoid infinite Status.changed loop
+            playback.record(now, song_id, current_float, None)
+            return
+
+        if song_info is None:  # placeholder until the lookup finishes
+            song_info = SongInfo(None, '', 0, '', 'Loading song info...' if not is_CN else '正在加载歌曲信息...')
+        self.presence = presence_payload(self.pid, song_id, song_info, status, current_float, now)
+        self.song = UiState(song_info.title, song_info.artist)
+        if not song_info_arrived:
+            self.changed_at = now
+
+        playback.record(now, song_id, current_float, status)
+
+        if status != Status.paused:
+            tick_debug('%d: %s - %s, %02.0f:%05.2f', self.pid, song_info.title, song_info.artist, *divmod(current_float, 60))  # formatted like sec_to_str()
+
+
+class TrackerSupervisor:
+    """Runs a Tracker for every NCM process on the update tick and publishes the presence of the one whose playback changed last.
+    While some are tracked, the process list is rescanned every process_rescan_interval seconds to pick up new ones."""
+
+    def __init__(self, watcher: ProcessWatcher, reader_factory: Callable[[], MemoryReader] = None):
+        self.watcher = watcher
+        self.reader_factory = reader_factory or PyMeowReader  # swapped for a SnapshotReader off Windows
+        self.trackers: Dict[int, Tracker] = {}
+        self.next_rescan = 0.0
+        self.shown: Tracker | None = None
+        self.presence: dict | None = None  # last payload handed to the publisher
+        self.found = False  # NCM was running on the last tick, its presence is disconnected once when it is gone
+
+    def close(self):
+        for tracker in self.trackers.values():
+            tracker.close()
+        self.trackers.clear()
+        self.shown = self.presence = None
+
+    def scan(self, now: float):
+        trackers = self.trackers
+        for tracker_pid in [tracker_pid for tracker_pid, tracker in trackers.items() if not tracker.alive()]:
+            logger.info(f'Process {tracker_pid} exited.')
+            trackers.pop(tracker_pid).close()
+        if trackers and now < self.next_rescan:
+            return
+        start = time.perf_counter()
+        for found_pid, found_version in self.watcher.find():
+            if found_pid not in trackers:
+                trackers[found_pid] = Tracker(found_pid, found_version, self.reader_factory())
+                profile_phase('first_process_find', start, version=found_version)
+        self.next_rescan = now + process_rescan_interval
+
+    def tick(self, wake: Callable[[], None]):
+        start = time.perf_counter()
+        self.scan(time.time())
+        metrics.observe('ncm_process_check_seconds', time.perf_counter() - start)
+        if not self.trackers:  # If netease client isn't running, clear presence
+            logger.warning('Netease Cloud Music not found.')
+            if trace_file is not None:
+                write_trace_sample(trace_file, TraceSample(time.time(), None, 0.0))
+            if self.found:
+                publisher.disconnect()
+                self.found = False
+            self.shown = self.presence = None
+            ui_bridge.publish(no_song)
+            return
+        self.found = True
+        for tracker in self.trackers.values():
+            if tracker.unsupported:
+                continue
+            try:
+                tracker.tick(wake)
+            except UnsupportedVersionError as e:  # only this process can't be tracked, keep tracking the others
+                logger.error(e)
+                tracker.unsupported = True
+                tracker.presence = tracker.song = None
+                if not start_minimized:
+                    post_to_ui(lambda message=str(e): messagebox.showerror('不支持的网易云音乐版本', message))
+            except Exception as e:
+                logger.error(f'Error while updating song info of {tracker.pid}:')
+                logger.exception(e)
+        self.show(max((tracker for tracker in self.trackers.values() if tracker.presence is not None), key=lambda tracker: tracker.changed_at, default=None))
+
+    def show(self, tracker: Tracker | None):
+        if tracker is not self.shown and tracker is not None and self.shown is not None:
+            logger.info(f'Showing process {tracker.pid}, its playback changed last.')
+        self.shown = tracker
+        presence = tracker.presence if tracker is not None else None
+        if presence is not self.presence:  # trackers make a new payload whenever theirs changes
+            self.presence = presence
+            publisher.publish(presence)
+        if tracker is not None:
+            ui_bridge.publish(tracker.song)
+
+    def next_interval(self, now: float) -> float:
+        if not self.trackers:
+            return max(idle_interval, self.watcher.next_scan - now)
+        return min(tracker.playback.next_interval(now) for tracker in self.trackers.values())
+
+
 client_id = '1045242932128645180'
-RPC = Presence(client_id)
-
-first_run = True
-pid = 0
-version = ''
-last_status = Status.changed
-last_id = ''
-last_float = 0.0
-last_pause_time = time.time()
-pause_timeout = 30 * 60
+metrics = Metrics()
+core = EventLoopThread()
+RPC = AioPresence(client_id, loop=core.loop)
+publisher = PresencePublisher(RPC, core)
+
+trace_file = open(trace_path, 'a', encoding='utf-8', buffering=1) if trace_path else None  # line buffered, a trace survives a crash
 stop_variable = ThreadingEvent()
 
-song_info_cache: Dict[str, SongInfo] = {}
-cached_process = None  # pyMeow process handle, reused across ticks
-cached_module_base = 0  # V2 cloudmusic.dll base address, stable per process
+song_info_cache = SongInfoCache(cache_db_path)
+netease_misses = NegativeCache()
+pool_netease_session(pyncm.GetCurrentSession())
+offset_cache = OffsetCache(cache_db_path)
+history_index = TrackFileIndex(history_file_path, parse_history)
+playing_list_index = TrackFileIndex(playing_list_file_path, parse_playing_list)
+file_watcher = FileWatcher([('history', history_index), ('playing_list', playing_list_index)], song_info_cache)
+prefetcher = Prefetcher(playing_list_index, [('history', history_index), ('playing_list', playing_list_index)], song_info_cache)
+process_watcher = ProcessWatcher()
+resolver = SongInfoResolver([('history', history_index.get), ('playing_list', playing_list_index.get), ('netease', lookup_netease)], song_info_cache, core.loop)
+supervisor = TrackerSupervisor(process_watcher)
+ui_bridge = UiBridge()
 connected = False  # Discord RPC connection state (plain bool, not BooleanVar — thread-safe under GIL)
+root = None  # Tk root, built by build_ui() and left None in --headless mode
 
 
-def toggle():
+def post_to_ui(callback: Callable[[], object]):
+    """Runs `callback` on the Tk thread, dropped in --headless mode."""
+    if root is not None:
+        root.after(0, callback)
+
+
+def connect_from_ui(on_connected: Callable[[], None], on_failed: Callable[[], None]):
+    """Connects to Discord on the event loop, then runs `on_connected` or `on_failed` on the Tk thread.
+    The Tk thread must never wait on the loop, which posts to it as well. Tells the user if Discord is not running, unless started minimized."""
+    def done(future):
+        try:
+            succeeded = future.result()
+        except DiscordNotFound:
+            succeeded = False
+            if not start_minimized:
+                messagebox.showerror('Discord not found', 'Could not detect a running Discord instance. Please make sure Discord is running and try again. Do not use BetterDiscord or other 3rd party clients.')
+        (on_connected if succeeded else on_failed)()
+
+    future = asyncio.run_coroutine_threadsafe(connect_discord(RPC, raise_not_found=True), core.loop)
+    future.add_done_callback(lambda future: post_to_ui(lambda: done(future)))
+
+
+def start_update():
     global timer
-    menu = icon.menu
+    if toggle_var.get():  # connected twice, e.g. enable was clicked again while connecting
+        return
+    stop_variable.clear()
+    publisher.start()
+    file_watcher.start()
+    timer = AdaptiveTimer(update, next_interval, stop_variable=stop_variable, loop=core)
+    toggle_var.set(True)
+    icon.menu = TrayMenu(*[disable_item] + org_menu)
+
+
+def toggle():
     if not toggle_var.get():
-        if connect_discord(RPC):
-            stop_variable.clear()
-            timer = RepeatedTimer(interval, update, stop_variable=stop_variable)
-            toggle_var.set(True)
-            menu = TrayMenu(*[disable_item] + org_menu)
+        connect_from_ui(start_update, lambda: None)
     else:
-        stop_update()
-        toggle_var.set(False)
-        menu = TrayMenu(*[enable_item] + org_menu)
-    icon.menu = menu
+        stop_update(stopped)
+
+
+def stopped():
+    toggle_var.set(False)
+    icon.menu = TrayMenu(*[enable_item] + org_menu)
 
 
 def toggle_startup():
@@ -212,15 +2225,33 @@ def toggle_startup():
 
 
 def about():
-    supported_ver_str = '\n'.join(offsets.keys()) + '\n3.x (dynamic scan)'
+    supported_ver_str = '\n'.join(offsets.keys()) + ('\nother 2.x (automatic offset discovery)\n3.x (dynamic scan)' if not is_CN else '\n其他2.x (自动搜索偏移量)\n3.x (dynamic scan)')
     messagebox.showinfo('About', f"Netease Cloud Music Discord RPC v{__version__}\nPython {sys.version}\nSupporting NCM version:\n{supported_ver_str}\nMaintainer: Billy Cao" if not is_CN else
     f"网易云音乐 Discord RPC v{__version__}\nPython版本 {sys.version}\n支持的网易云音乐版本:\n{supported_ver_str}\n开发者: Billy Cao")
 
 
 def quit_app(icon=None, item=None):
-    stop_update()
+    """Stops tracking, then closes everything. From the UI the rest runs on the Tk thread once the loop has stopped tracking."""
+    if root is None:
+        stop_update()
+        close_app(icon)
+    else:
+        stop_update(lambda: close_app(icon))
+
+
+def close_app(icon=None):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Metrics at exit:\n{metrics.render()}')
+    if startup_profile is not None:
+        startup_profile.write(version=__version__)
+    song_info_cache.close()
+    offset_cache.close()
+    if trace_file is not None:
+        trace_file.close()
+    core.close()
     if icon: icon.stop()
-    root.destroy()
+    if root is not None:
+        root.destroy()
 
 
 def show_window(icon, item):
@@ -235,405 +2266,367 @@ def hide_window():
         menu = TrayMenu(*[disable_item] + org_menu)
     else:
         menu = TrayMenu(*[enable_item] + org_menu)
-    icon = TrayIcon("Netease Cloud Music Discord RPC", icon_image, "Netease Cloud Music Discord RPC", menu)
+    icon = TrayIcon("Netease Cloud Music Discord RPC", icon_image, ui_bridge.applied.tooltip(), menu)
     Thread(target=icon.run, daemon=True).start()  # must run this in thread, else it block the update RepeatTimer thread
 
 
-def get_song_info_from_netease(song_id: str) -> bool:
-    try:
-        song_info_raw_list = apis.track.GetTrackDetail([song_id])['songs']
-        if not song_info_raw_list:
-            return False
-        song_info_raw = song_info_raw_list[0]
-        song_info: SongInfo = {
-            'cover': song_info_raw['al']['picUrl'],
-            'album': song_info_raw['al']['name'],
-            'duration': song_info_raw['dt'] / 1000,
-            'artist': '/'.join([x['name'] for x in song_info_raw['ar']]),
-            'title': song_info_raw['name'],
-        }
-        song_info_cache[song_id] = song_info
-        return True
-    except Exception as e:  # normal to fail when playing a cloud drive uploaded file since song ID is not public
-        logger.warning('Error while reading from remote:', e)
-        return False
-
-
-def get_song_info_from_local(song_id: str) -> bool:
-    filepath = os.path.join(os.path.expandvars('%LOCALAPPDATA%'), 'Netease/CloudMusic/webdata/file/history')
-    if not os.path.exists(filepath):
-        return False
-    try:
-        with (open(filepath, 'r', encoding='utf-8')) as f:
-            history = orjson.loads(f.read())
-            song_info_raw_list = [x for x in history if str(x['track']['id']) == song_id]
-            if not song_info_raw_list:
-                return False
-            song_info_raw = song_info_raw_list[0]['track']
-            song_info: SongInfo = {
-                'cover': song_info_raw['album']['picUrl'],
-                'album': song_info_raw['album']['name'],
-                'duration': song_info_raw['duration'] / 1000,
-                'artist': '/'.join([x['name'] for x in song_info_raw['artists']]),
-                'title': song_info_raw['name'],
-            }
-            song_info_cache[song_id] = song_info
-        return True
-    except Exception as e:
-        logger.warning('Error while reading from local history file:', e)
-        return False
-
+def find_process() -> List[Tuple[int, str]]:
+    return process_watcher.scan()
 
-def get_song_info_from_playing_list(song_id: str) -> bool:
-    filepath = os.path.join(os.path.expandvars('%LOCALAPPDATA%'), 'Netease/CloudMusic/WebData/file/playingList')
-    if not os.path.exists(filepath):
-        return False
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = orjson.loads(f.read())
-            song_list = data.get('list', [])
-            song_info_raw_list = [x for x in song_list if str(x.get('id', '')) == song_id]
-            if not song_info_raw_list:
-                return False
-            track = song_info_raw_list[0]['track']
-            song_info: SongInfo = {
-                'cover': track['album']['cover'],
-                'album': track['album']['name'],
-                'duration': track.get('duration', 0) / 1000 if track.get('duration', 0) else 0,
-                'artist': '/'.join([x['name'] for x in track['artists']]),
-                'title': track['name'],
-            }
-            song_info_cache[song_id] = song_info
-        return True
-    except Exception as e:
-        logger.warning('Error while reading from playingList file:', e)
-        return False
 
+def find_v3_matches(reader: MemoryReader, module_name: str = 'cloudmusic.dll') -> Tuple[int, int]:
+    """Addresses of the AudioSchedulePattern and AudioPlayerPattern matches in cloudmusic.dll."""
+    matches = reader.scan_module(module_name, [V3_AUDIO_SCHEDULE_PATTERN, V3_AUDIO_PLAYER_PATTERN])
+    if matches[V3_AUDIO_SCHEDULE_PATTERN] is None:
+        raise RuntimeError('V3 AOB scan failed: AudioSchedulePattern not found')
+    if matches[V3_AUDIO_PLAYER_PATTERN] is None:
+        raise RuntimeError('V3 AOB scan failed: AudioPlayerPattern not found')
+    return matches[V3_AUDIO_SCHEDULE_PATTERN], matches[V3_AUDIO_PLAYER_PATTERN]
 
-def get_song_info(song_id: str) -> SongInfo | None:
-    if song_id not in song_info_cache:
-        if not get_song_info_from_local(song_id):
-            if not get_song_info_from_playing_list(song_id):
-                get_song_info_from_netease(song_id)
-    return song_info_cache.get(song_id)
 
+def v3_pointers_from_matches(reader: MemoryReader, schedule_match: int, audio_player_match: int) -> Tuple[int, int]:
+    """Resolve the RIP-relative operands of the pattern matches into (schedule_ptr, audio_player_ptr)."""
+    text_addr = schedule_match + 4
+    displacement = reader.r_int(text_addr)
+    schedule_ptr = text_addr + displacement + 4
+    logger.debug(f'V3 schedule pointer: {hex(schedule_ptr)}')
 
-def find_process() -> Tuple[int, str]:
-    candidates = []
-    for proc in psutil.process_iter(attrs=['name', 'pid']):
-        if proc.info['name'] == 'cloudmusic.exe':
-            try:
-                cmdline = proc.cmdline()
-                if any('--type=' in arg for arg in cmdline):
-                    continue
-                candidates.append(proc)
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
-    if not candidates:
-        return 0, ''
-    if len(candidates) > 1:
-        raise RuntimeError('Multiple candidate processes found!')
-    proc = candidates[0]
-    try:
-        exe_path = proc.exe()
-    except (psutil.NoSuchProcess, psutil.AccessDenied):
-        return 0, ''
+    text_addr = audio_player_match + 3
+    displacement = reader.r_int(text_addr)
+    audio_player_ptr = text_addr + displacement + 4
+    logger.debug(f'V3 audio player pointer: {hex(audio_player_ptr)}')
 
-    ver_info = GetFileVersionInfo(exe_path, '\\')
-    ver = (f"{HIWORD(ver_info['FileVersionMS'])}.{LOWORD(ver_info['FileVersionMS'])}."
-           f"{HIWORD(ver_info['FileVersionLS'])}.{LOWORD(ver_info['FileVersionLS'])}")
-    return proc.info['pid'], ver
+    return schedule_ptr, audio_player_ptr
 
 
-def scan_for_v3_offsets(process: dict, module_name: str = 'cloudmusic.dll') -> Tuple[int, int]:
+def scan_for_v3_offsets(reader: MemoryReader, module_name: str = 'cloudmusic.dll') -> Tuple[int, int]:
     """Scan cloudmusic.dll for V3 audio pointers using AOB patterns.
     Returns (schedule_ptr, audio_player_ptr) as absolute virtual addresses."""
-    results = aob_scan_module(process, module_name, V3_AUDIO_SCHEDULE_PATTERN)
-    if not results:
-        raise RuntimeError('V3 AOB scan failed: AudioSchedulePattern not found')
-    match = results[0]
-    text_addr = match + 4
-    displacement = r_int(process, text_addr)
-    schedule_ptr = text_addr + displacement + 4
-    logger.debug(f'V3 schedule pointer: {hex(schedule_ptr)}')
+    return v3_pointers_from_matches(reader, *find_v3_matches(reader, module_name))
 
-    results = aob_scan_module(process, module_name, V3_AUDIO_PLAYER_PATTERN)
-    if not results:
-        raise RuntimeError('V3 AOB scan failed: AudioPlayerPattern not found')
-    match = results[0]
-    text_addr = match + 3
-    displacement = r_int(process, text_addr)
-    audio_player_ptr = text_addr + displacement + 4
-    logger.debug(f'V3 audio player pointer: {hex(audio_player_ptr)}')
 
-    return schedule_ptr, audio_player_ptr
+def module_hash(reader: MemoryReader, base: int) -> str:
+    """Identifies a module build by the PE header fields the loader leaves alone: the file header with the link timestamp,
+    SizeOfImage, CheckSum and the section table. Not the whole header page, the loader rewrites ImageBase when ASLR relocates the module."""
+    header = reader.r_bytes(base, 0x1000)
+    try:
+        pe_offset, = struct.unpack_from('<I', header, 0x3C)
+        if header[pe_offset:pe_offset + 4] != b'PE\0\0':
+            raise ValueError('Invalid PE signature')
+        section_count, optional_header_size = struct.unpack_from('<H12xH', header, pe_offset + 6)
+    except (struct.error, ValueError) as e:
+        logger.debug(f'Could not parse PE headers at {hex(base)}, hashing the whole header page: {e}')
+        return hashlib.sha1(header).hexdigest()
+    optional_header = pe_offset + 24  # SizeOfImage and CheckSum are at the same offsets in PE32 and PE32+
+    section_table = optional_header + optional_header_size
+    return hashlib.sha1(header[pe_offset + 4:optional_header] + header[optional_header + 56:optional_header + 60] + header[optional_header + 64:optional_header + 68]
+                        + header[section_table:section_table + 40 * section_count]).hexdigest()
+
+
+def v3_pointers_valid(reader: MemoryReader, schedule_ptr: int, audio_player_ptr: int) -> bool:
+    """Cheap sanity read of resolved V3 pointers: a plausible playback position and a readable player slot."""
+    try:
+        current = reader.r_float64(schedule_ptr)
+        reader.r_int64(audio_player_ptr + 0x50)
+    except Exception:
+        return False
+    return math.isfinite(current) and 0 <= current < 24 * 60 * 60
 
 
-def read_v3_song_id(process: dict, audio_player_ptr: int) -> str:
-    """Read current song ID from V3 memory layout (UTF-8, SSO string)."""
-    audio_play_info = r_int64(process, audio_player_ptr + 0x50)
+def v2_offsets_valid(reader: MemoryReader, module_base: int, v2_offsets: Dict[str, int]) -> bool:
+    """Sanity read of discovered V2 offsets: a plausible playback position and a song ID behind the song_array pointer."""
+    try:
+        current, song_id = read_v2_song_state(reader, module_base, v2_offsets)
+    except Exception:
+        return False
+    return math.isfinite(current) and 0 <= current < 24 * 60 * 60 and re_song_id.fullmatch(song_id) is not None
+
+
+def resolve_cached_v2_offsets(reader: MemoryReader, version: str, module_base: int) -> Dict[str, int] | None:
+    """V2 offsets discovered earlier for this NCM build, None if there are none or they no longer check out."""
+    build_hash = module_hash(reader, module_base)
+    cached = offset_cache.get('v2', version, build_hash)
+    if cached is None or v2_offsets_valid(reader, module_base, cached):
+        return cached
+    logger.info('Cached V2 offsets are stale, discovering them again.')
+    offset_cache.discard('v2', version, build_hash)
+    return None
+
+
+def resolve_v3_offsets(reader: MemoryReader, version: str, module_name: str = 'cloudmusic.dll') -> Tuple[int, int]:
+    """scan_for_v3_offsets, but using the module-relative offsets cached for this NCM build when they still check out."""
+    base = reader.module(module_name)['base']
+    build_hash = module_hash(reader, base)
+    cached = offset_cache.get('v3', version, build_hash)
+    if cached is not None:
+        try:
+            schedule_match, audio_player_match = base + cached['schedule_match'], base + cached['audio_player_match']
+            # The pattern bytes must still be where they were, and the pointers they resolve to must read sanely
+            if all(compile_aob_pattern(pattern).regex.match(reader.r_bytes(address, compile_aob_pattern(pattern).length))
+                   for pattern, address in ((V3_AUDIO_SCHEDULE_PATTERN, schedule_match), (V3_AUDIO_PLAYER_PATTERN, audio_player_match))):
+                pointers = v3_pointers_from_matches(reader, schedule_match, audio_player_match)
+                if v3_pointers_valid(reader, *pointers):
+                    logger.info('Using cached V3 offsets')
+                    return pointers
+        except Exception as e:
+            logger.debug(f'Cached V3 offsets could not be used: {e}')
+        logger.info('Cached V3 offsets are stale, rescanning.')
+        offset_cache.discard('v3', version, build_hash)
+    start = time.perf_counter()
+    schedule_match, audio_player_match = find_v3_matches(reader, module_name)
+    profile_phase('first_aob_scan', start)
+    pointers = v3_pointers_from_matches(reader, schedule_match, audio_player_match)
+    offset_cache.put('v3', version, build_hash, {'schedule_match': schedule_match - base, 'audio_player_match': audio_player_match - base,
+                                                 'schedule': pointers[0] - base, 'audio_player': pointers[1] - base})
+    return pointers
+
+
+def read_v2_song_id(reader: MemoryReader, song_array_ptr: int) -> str:
+    """Read current song ID from V2 memory layout (UTF-16 string behind a 32-bit pointer)."""
+    songid_array = reader.r_uint(song_array_ptr)
+    return reader.r_bytes(songid_array, 0x14).decode('utf-16').split('_')[0]  # Song ID can be shorter than 10 digits.
+
+
+def v3_song_id_address(reader: MemoryReader, audio_player_ptr: int) -> Tuple[int, int]:
+    """Address and length of the current song ID string in V3 memory layout (UTF-8, SSO string). (0, 0) if there is none."""
+    audio_play_info = reader.r_int64(audio_player_ptr + 0x50)
     if audio_play_info == 0:
-        return ''
+        return 0, 0
 
     str_ptr = audio_play_info + 0x10
-    str_length = r_int64(process, str_ptr + 0x10)
+    str_length = reader.r_int64(str_ptr + 0x10)
 
     if str_length <= 0:
-        return ''
+        return 0, 0
 
     # Cap read size to avoid reading excessive memory; song ID strings are short (e.g. "1234567890_0")
     read_length = min(int(str_length), 128)
 
     # Small string optimization: if length <= 15, data is inline at str_ptr; otherwise dereference
     if str_length <= 15:
-        raw = r_bytes(process, str_ptr, read_length)
-    else:
-        str_address = r_int64(process, str_ptr)
-        if str_address == 0:
-            return ''
-        raw = r_bytes(process, str_address, read_length)
+        return str_ptr, read_length
+    str_address = reader.r_int64(str_ptr)
+    return str_address, read_length if str_address else 0
 
-    song_str = raw.decode('utf-8')
+
+def read_v3_song_id(reader: MemoryReader, audio_player_ptr: int) -> str:
+    """Read current song ID from V3 memory layout (UTF-8, SSO string)."""
+    str_address, read_length = v3_song_id_address(reader, audio_player_ptr)
+    if not read_length:
+        return ''
+    song_str = reader.r_bytes(str_address, read_length).decode('utf-8')
     if not song_str or '_' not in song_str:
         return ''
     return song_str[:song_str.index('_')]
 
 
-def update():
-    global first_run
-    global pid
-    global version
-    global last_status
-    global last_id
-    global last_float
-    global last_pause_time
-    global v3_schedule_ptr
-    global v3_audio_player_ptr
-    global cached_process
-    global cached_module_base
-    global connected
+def read_v2_song_state(reader: MemoryReader, module_base: int, v2_offsets: Dict[str, int]) -> Tuple[float, str]:
+    """(current, song_id) of a 2.x process. Not read through a ReadPlan: the two fields are too far apart to coalesce,
+    so the plan would make the same 3 reads and only add its own overhead."""
+    return reader.r_float64(module_base + v2_offsets['current']), read_v2_song_id(reader, module_base + v2_offsets['song_array'])
 
-    try:
-        if not pid_exists(pid) or get_process_name(pid) != 'cloudmusic.exe':
-            # Process died or changed — close cached handle and reset
-            if cached_process is not None:
-                close_process(cached_process)
-                cached_process = None
-                cached_module_base = 0
-            pid, version = find_process()
-            if not pid:  # If netease client isn't running, clear presence
-                logger.warning('Netease Cloud Music not found.')
-                root.after(0, lambda: song_title_text.set('N/A'))
-                root.after(0, lambda: song_artist_text.set(''))
-                if not first_run:
-                    disconnect_discord(RPC)
-                    first_run = True
-                return
-            first_run = True  # New PID found — trigger re-scan of offsets
-
-        is_v3 = version.startswith('3.')
-        if not is_v3 and version not in offsets:
-            stop_variable.set()
-            raise UnsupportedVersionError(f"This version is not supported yet: {version}.\nSupported version: {', '.join(offsets.keys())}" if not is_CN else f"目前不支持此网易云音乐版本: {version}。\n支持的版本: {', '.join(offsets.keys())}")
-
-        # Reuse cached process handle; open only when needed
-        if cached_process is None:
-            cached_process = open_process(pid)
-
-        if first_run:
-            logger.info(f'Found process: {pid}')
-            if is_v3:
-                v3_schedule_ptr, v3_audio_player_ptr = scan_for_v3_offsets(cached_process, 'cloudmusic.dll')
-                logger.info(f'V3 AOB scan complete: schedule={hex(v3_schedule_ptr)}, player={hex(v3_audio_player_ptr)}')
-            else:
-                cached_module_base = get_module(cached_process, 'cloudmusic.dll')['base']
-            first_run = False
 
-        if is_v3:
-            current_float = r_float64(cached_process, v3_schedule_ptr)
-            song_id = read_v3_song_id(cached_process, v3_audio_player_ptr)
-        else:
-            current_float = r_float64(cached_process, cached_module_base + offsets[version]['current'])
-            songid_array = r_uint(cached_process, cached_module_base + offsets[version]['song_array'])
-            song_id = r_bytes(cached_process, songid_array, 0x14).decode('utf-16').split('_')[0]  # Song ID can be shorter than 10 digits.
+def v3_read_plan(schedule_ptr: int, audio_player_ptr: int) -> ReadPlan:
+    return ReadPlan({'current': (schedule_ptr, 'd'), 'audio_play_info': (audio_player_ptr + 0x50, 'q')})
 
-        current_pystr = sec_to_str(current_float)
 
-        if not re_song_id.match(song_id):
-            # Song ID is not ready yet.
-            return
-
-        # Measured interval should fall in (interval +- 0.2)
-        status = (Status.playing if song_id == last_id and abs(current_float - last_float - interval) < 0.2
-                  else Status.paused if song_id == last_id and current_float == last_float
-        else Status.changed)
-        if status == Status.playing:
-            if last_status != Status.paused:  # Nothing changed
-                last_float = current_float
-                last_status = Status.playing
-                return
-            elif last_status == Status.paused:  # we resumed from pause and may need to reconnect if passed time out
-                logger.debug('Resumed')
-                if not connected:
-                    if not connect_discord(RPC):
-                        return
-
-        elif status == Status.paused:
-            if last_status == Status.paused:  # Nothing changed but check if it is idle/paused for more than 30min, clear presence but keep connection alive to avoid reconnection throttling.
-                if connected and time.time() - last_pause_time > pause_timeout:
-                    logger.debug('Idle for more than 30min, clearing RPC presence.')
-                    try:
-                        RPC.clear()
-                    except Exception:
-                        pass
-                return
-            elif last_status == Status.playing:
-                logger.debug('Paused')
-                last_pause_time = time.time()
-
-        elif status == Status.changed:
-            last_pause_time = time.time()  # reset timeout as changed indicates something happened
-            if not connected:
-                if not connect_discord(RPC):
-                    return
-
-        song_info = get_song_info(song_id)
-
-        if song_info is None:
-            logger.warning(f'Could not find song info for ID: {song_id}')
-            # Still advance tracking state to avoid infinite Status.changed loop
-            last_id = song_id
-            last_float = current_float
-            return
-
-        if not (connected or not time.time() - last_pause_time > pause_timeout):
-            if not connect_discord(RPC):
-                return
-
-        try:
-            RPC.update(pid=pid,
-                       state=f"{song_info['artist']} | {song_info['album']}",
-                       details=song_info['title'].center(2),
-                       large_image=song_info['cover'],
-                       large_text=song_info['album'].center(2),
-                       small_image='play' if status != Status.paused else 'pause',
-                       small_text='Playing' if status != Status.paused else 'Paused',
-                       start=int(time.time() - current_float)
-                       if status != Status.paused else None,
-                       # Known issue: buttons do not appear on PC due to discord API changes: https://github.com/qwertyquerty/pypresence/issues/237
-                       buttons=[{'label': 'Listen on NetEase',
-                                 'url': f'https://music.163.com/#/song?id={song_id}'}]
-                       )
-            title = song_info['title']
-            artist = song_info['artist']
-            root.after(0, lambda t=title, a=artist: (song_title_text.set(t), song_artist_text.set(a)))
-        except PipeClosed:
-            logger.info('Reconnecting to Discord...')
-            connect_discord(RPC)
-        except Exception as e:
-            logger.error('Error while updating to Discord:')
-            logger.exception(e)
+def read_v3_song_state(reader: MemoryReader, plan: ReadPlan) -> Tuple[float, str]:
+    """(current, song_id) of a 3.x process with the fewest reads: the plan's fixed fields, then the song ID string behind them.
+    Does the same as reading current and calling read_v3_song_id, in 2-3 reads instead of 3-5."""
+    values = plan.read(reader)
+    audio_play_info = values['audio_play_info']
+    if audio_play_info == 0:
+        return values['current'], ''
+    # Inline SSO buffer (or heap pointer) and length of the song ID string in one read
+    string = reader.r_bytes(audio_play_info + 0x10, 0x18)
+    str_length, = struct.unpack_from('<q', string, 0x10)
+    if str_length <= 0:
+        return values['current'], ''
+    if str_length <= 15:
+        raw = string[:str_length]
+    else:
+        str_address, = struct.unpack_from('<q', string, 0)
+        if str_address == 0:
+            return values['current'], ''
+        raw = reader.r_bytes(str_address, min(int(str_length), 128))
+    song_str = raw.decode('utf-8')
+    if not song_str or '_' not in song_str:
+        return values['current'], ''
+    return values['current'], song_str[:song_str.index('_')]
+
+
+def capture_snapshot(path: str, page_size: int = 0x1000):
+    """Capture the running NCM's cloudmusic.dll and the heap pages the song ID is read from into a snapshot for SnapshotReader."""
+    processes = find_process()
+    if not processes:
+        raise RuntimeError('Netease Cloud Music not found.')
+    snapshot_pid, snapshot_version = processes[0]
+    if len(processes) > 1:
+        logger.warning(f'{len(processes)} NCM processes found, capturing {snapshot_pid}')
+    capture_reader = PyMeowReader()
+    capture_reader.open(snapshot_pid)
+    try:
+        module = capture_reader.module('cloudmusic.dll')
+        addresses = []
+        if snapshot_version.startswith('3.'):
+            _, audio_player_ptr = scan_for_v3_offsets(capture_reader)
+            audio_play_info = capture_reader.r_int64(audio_player_ptr + 0x50)
+            addresses += [audio_play_info, audio_play_info + 0x20, v3_song_id_address(capture_reader, audio_player_ptr)[0]]
+        elif snapshot_version in offsets:
+            addresses.append(capture_reader.r_uint(module['base'] + offsets[snapshot_version]['song_array']))
+        regions = []
+        for page in list(range(module['base'], module['base'] + module['size'], page_size)) + sorted({a - a % page_size for a in addresses if a}):
+            try:
+                regions.append((page, capture_reader.r_bytes(page, page_size)))
+            except Exception:  # unreadable pages (guard pages, discarded sections) are left out of the snapshot
+                continue
+        write_snapshot(path, regions, {'cloudmusic.dll': {'base': module['base'], 'size': module['size']}}, snapshot_version, snapshot_pid)
+        logger.info(f'Captured {len(regions)} pages of NCM {snapshot_version} into {path}')
+    finally:
+        capture_reader.close()
 
-        last_id = song_id
-        last_float = current_float
-        if status != Status.changed:  # only store play/pause status for ease of detection above
-            last_status = status
 
-        if status != Status.paused:
-            logger.debug(f"{song_info['title']} - {song_info['artist']}, {current_pystr}")
-    except UnsupportedVersionError as e:
-        if not start_minimized:
-            msg = str(e)
-            root.after(0, lambda m=msg: messagebox.showerror('不支持的网易云音乐版本', m))
-        root.after(0, lambda: toggle_var.set(False))
-        stop_variable.set()
-        raise e
+def update(wake: Callable[[], None]):
+    tick_start = time.perf_counter()
+    try:
+        supervisor.tick(wake)
     except Exception as e:
         logger.error('Error while updating song info:')
         logger.exception(e)
+    finally:
+        metrics.observe('ncm_tick_seconds', time.perf_counter() - tick_start)
+
+
+def next_interval() -> float:
+    """Seconds until the next tick: fast right after a change, slower when paused and slowest without NCM."""
+    return supervisor.next_interval(time.time())
 
 
 def startup():
-    global timer
     if start_minimized:
         hide_window()
-    if connect_discord(RPC):
-        try:
-            timer = RepeatedTimer(interval, update, stop_variable=stop_variable)
-        except UnsupportedVersionError:
-            return  # handled in update() already
-        except Exception as e:
-            messagebox.showerror('Error' if not is_CN else '错误', f'{e}')
-            toggle_var.set(False)
-            stop_variable.set()
-            return
-        else:
-            toggle_var.set(True)
-    else:
-        toggle_var.set(False)
+    connect_from_ui(start_update, lambda: toggle_var.set(False))
 
 
-def stop_update():
-    global cached_process, cached_module_base
+async def stop_tracking():
+    """Stops the update tick and the publisher, closes the trackers and disconnects from Discord, on the event loop."""
     stop_variable.set()
-    if 'timer' in globals():
-        timer.stop()
-    if cached_process is not None:
-        close_process(cached_process)
-        cached_process = None
-        cached_module_base = 0
+    workers = [worker for worker in (publisher, globals().get('timer')) if worker is not None and worker.task is not None]
+    for worker in workers:
+        worker.stop()  # doesn't wait on the loop, the tasks are awaited below
+    await asyncio.gather(*(asyncio.wrap_future(worker.task) for worker in workers))
+    supervisor.close()
+    if connected:
+        await disconnect_discord(RPC)
+
+
+def stop_update(on_stopped: Callable[[], None] | None = None):
+    """Stops tracking on the event loop, then runs `on_stopped` on the Tk thread like connect_from_ui() does, the Tk thread must never wait
+    on the loop, which posts to it as well. Without `on_stopped` the caller waits, which only threads the loop doesn't post to may do."""
+    file_watcher.stop()
+    future = asyncio.run_coroutine_threadsafe(stop_tracking(), core.loop)
+    if on_stopped is None:
+        future.result()
+    else:
+        future.add_done_callback(lambda future: post_to_ui(on_stopped))
+
+
+def build_ui():
+    """Imports the UI toolkits and builds the window and tray icon, --headless skips both."""
+    start = time.perf_counter()
+    global TrayIcon, TrayItem, TrayMenu, messagebox
+    global org_menu, enable_item, disable_item, icon_image, icon, root, song_title_text, song_artist_text, toggle_var, startup_var
+    from tkinter import BooleanVar, PhotoImage, StringVar, Tk, messagebox
+    from tkinter.ttk import Button, Checkbutton, Label, LabelFrame
+
+    from PIL import Image
+    from pystray import Icon as TrayIcon, Menu as TrayMenu, MenuItem as TrayItem
+
+    org_menu = [TrayItem('Show' if not is_CN else '显示主窗口', show_window, default=True),
+                TrayItem('Quit' if not is_CN else '退出', quit_app)]
+    enable_item = TrayItem('Enable' if not is_CN else '启用', toggle)
+    disable_item = TrayItem('Disable' if not is_CN else '禁用', toggle)
+    icon_image = Image.open(get_res_path("app_logo.png"))
+    icon = TrayIcon("Netease Cloud Music Discord RPC", icon_image, "Netease Cloud Music Discord RPC", org_menu)
+
+    root = Tk()
+    root.title('Netease Cloud Music Discord RPC')
+    root.resizable(False, False)
+    root.iconphoto(True, PhotoImage(file=get_res_path('app_logo.png')))
+
+    song_info_label_frame = LabelFrame(root, text='Song Info' if not is_CN else '歌曲信息')
+    song_info_label_frame.pack(padx=10, pady=10, fill='both', expand=True)
+    song_title_text = StringVar(value='N/A')
+    song_artist_text = StringVar(value='')
+    title_label = Label(song_info_label_frame, textvariable=song_title_text)
+    title_label.pack(padx=10, pady=5)
+    artist_label = Label(song_info_label_frame, textvariable=song_artist_text)
+    artist_label.pack(padx=10, pady=5)
+
+    toggle_var = BooleanVar()
+    toggle_var.set(False)
+    toggle_button_text = StringVar(value='Enabled - Click to disable' if not is_CN else '已启用 - 点击以禁用')
+    toggle_var.trace_add('write', lambda *args: toggle_button_text.set(('Enabled - Click to disable' if not is_CN else '已启用 - 点击以禁用') if toggle_var.get() else ('Disabled - Click to enable' if not is_CN else '已禁用 - 点击以启用')))  # noqa
+    toggle_button = Button(root, textvariable=toggle_button_text, command=toggle, width=50)
+    toggle_button.pack(padx=10, pady=(10, 5))
+
+    startup_var = BooleanVar()
+    startup_var.set(os.path.isfile(startup_file_path))
+    startup_checkbox = Checkbutton(root, text='Start with Windows' if not is_CN else '开机自启', variable=startup_var, command=toggle_startup)
+    startup_checkbox.pack(padx=10, pady=5)
+
+    about_button = Button(root, text='About' if not is_CN else '关于', command=about, width=50)
+    about_button.pack(padx=10, pady=5)
+
+    github_button = Button(root, text='GitHub', command=lambda: webbrowser.open('https://github.com/aliencaocao/netease_cloudmusic_discord_rpc'), width=50)
+    github_button.pack(padx=10, pady=5)
+
+    minimize_button = Button(root, text='Minimize' if not is_CN else '最小化到托盘', command=hide_window, width=50)
+    minimize_button.pack(padx=10, pady=5)
+
+    quit_button = Button(root, text='Quit' if not is_CN else '退出', command=quit_app, width=50)
+    quit_button.pack(padx=10, pady=(5, 10))
+
+    root.protocol('WM_DELETE_WINDOW', hide_window)  # override close button to minimize to tray
+    profile_phase('ui', start)
+
+
+def run_headless():
+    """Tracks NCM and publishes presence without any UI until interrupted or stopped with --stop."""
+    global timer
+    if os.path.exists(headless_stop_path):  # left behind by a --stop while nothing was running
+        os.remove(headless_stop_path)
+    publisher.start()  # connects on the first presence and keeps retrying with backoff while Discord is not running
+    file_watcher.start()
+    timer = AdaptiveTimer(update, next_interval, stop_variable=stop_variable, loop=core)
     try:
-        RPC.clear()
-        RPC.close()
-    except:  # if not connected then it will error, just ignore it
+        while not stop_variable.wait(1):  # a timeout keeps Ctrl+C working on Windows
+            if os.path.exists(headless_stop_path):  # the packaged exe has no console to press Ctrl+C in
+                os.remove(headless_stop_path)
+                logger.info('Stopped with --stop.')
+                break
+    except KeyboardInterrupt:
         pass
-
-
-org_menu = [TrayItem('Show' if not is_CN else '显示主窗口', show_window, default=True),
-            TrayItem('Quit' if not is_CN else '退出', quit_app)]
-enable_item = TrayItem('Enable' if not is_CN else '启用', toggle)
-disable_item = TrayItem('Disable' if not is_CN else '禁用', toggle)
-icon_image = Image.open(get_res_path("app_logo.png"))
-icon = TrayIcon("Netease Cloud Music Discord RPC", icon_image, "Netease Cloud Music Discord RPC", org_menu)
-
-root = Tk()
-root.title('Netease Cloud Music Discord RPC')
-root.resizable(False, False)
-root.iconphoto(True, PhotoImage(file=get_res_path('app_logo.png')))
-
-song_info_label_frame = LabelFrame(root, text='Song Info' if not is_CN else '歌曲信息')
-song_info_label_frame.pack(padx=10, pady=10, fill='both', expand=True)
-song_title_text = StringVar(value='N/A')
-song_artist_text = StringVar(value='')
-title_label = Label(song_info_label_frame, textvariable=song_title_text)
-title_label.pack(padx=10, pady=5)
-artist_label = Label(song_info_label_frame, textvariable=song_artist_text)
-artist_label.pack(padx=10, pady=5)
-
-toggle_var = BooleanVar()
-toggle_var.set(False)
-toggle_button_text = StringVar(value='Enabled - Click to disable' if not is_CN else '已启用 - 点击以禁用')
-toggle_var.trace_add('write', lambda *args: toggle_button_text.set(('Enabled - Click to disable' if not is_CN else '已启用 - 点击以禁用') if toggle_var.get() else ('Disabled - Click to enable' if not is_CN else '已禁用 - 点击以启用')))  # noqa
-toggle_button = Button(root, textvariable=toggle_button_text, command=toggle, width=50)
-toggle_button.pack(padx=10, pady=(10, 5))
-
-startup_var = BooleanVar()
-startup_var.set(os.path.isfile(startup_file_path))
-startup_checkbox = Checkbutton(root, text='Start with Windows' if not is_CN else '开机自启', variable=startup_var, command=toggle_startup)
-startup_checkbox.pack(padx=10, pady=5)
-
-about_button = Button(root, text='About' if not is_CN else '关于', command=about, width=50)
-about_button.pack(padx=10, pady=5)
-
-github_button = Button(root, text='GitHub', command=lambda: webbrowser.open('https://github.com/aliencaocao/netease_cloudmusic_discord_rpc'), width=50)
-github_button.pack(padx=10, pady=5)
-
-minimize_button = Button(root, text='Minimize' if not is_CN else '最小化到托盘', command=hide_window, width=50)
-minimize_button.pack(padx=10, pady=5)
-
-quit_button = Button(root, text='Quit' if not is_CN else '退出', command=quit_app, width=50)
-quit_button.pack(padx=10, pady=(5, 10))
-
-root.protocol('WM_DELETE_WINDOW', hide_window)  # override close button to minimize to tray
-root.after_idle(startup)
-root.mainloop()
+    quit_app()
+
+
+if startup_profile is not None:
+    startup_profile.phase('module_init', startup_profile.phases['imports']['end'])
+
+if __name__ == '__main__':
+    if '--capture-snapshot' in sys.argv:
+        capture_snapshot(sys.argv[sys.argv.index('--capture-snapshot') + 1])
+        sys.exit()
+    if '--stop' in sys.argv:
+        os.makedirs(data_dir, exist_ok=True)
+        open(headless_stop_path, 'w').close()
+        sys.exit()
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port)
+    if headless:
+        run_headless()
+        sys.exit()
+
+    build_ui()
+    root.after_idle(startup)
+    root.mainloop()
@@ -0,0 +1,103 @@
+"""Startup profiling for main.py --profile-startup <report.json>.
+
+Imported by main.py before any other module so that the import timer sees all of its imports. Records the execution time of
+every module import (like -X importtime, minus the finder lookups) and the phases main.py marks on its way to the first presence.
+"""
+import json
+import platform
+import sys
+import threading
+import time
+
+
+class TimedLoader:
+    """Wraps a module's loader while it executes to time it, the original loader is put back afterwards."""
+
+    def __init__(self, loader, timer: 'ImportTimer', name: str):
+        self.loader = loader
+        self.timer = timer
+        self.name = name
+
+    def __getattr__(self, name: str):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack = self.timer.stack()
+        stack.append(0.0)  # time spent in nested imports
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            self.timer.imports.append({'module': self.name, 'start': start, 'self': cumulative - nested, 'cumulative': cumulative, 'depth': len(stack),
+                                       'thread': threading.current_thread().name})
+            module.__loader__ = self.loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self.loader
+
+
+class ImportTimer:
+    """Meta path finder that defers to the other finders and times the loading of everything they find."""
+
+    def __init__(self):
+        self.imports = []
+        self.local = threading.local()
+
+    def stack(self) -> list:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def find_spec(self, fullname: str, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self, fullname)
+                return spec
+        return None
+
+
+class StartupProfile:
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.perf_counter()
+        self.phases = {}  # name -> {'start', 'end', details}, perf_counter seconds
+        self.import_timer = ImportTimer()
+        self.written = False
+        sys.meta_path.insert(0, self.import_timer)
+
+    def phase(self, name: str, start: float, **details):
+        """Records phase `name` as having run from `start` until now, only its first occurrence counts."""
+        if name not in self.phases:
+            self.phases[name] = {'start': start, 'end': time.perf_counter(), **details}
+
+    def report(self, **details) -> dict:
+        ms = lambda seconds: round(seconds * 1e3, 3)
+        return {
+            **details,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'phases': {name: {**phase, 'start': ms(phase['start'] - self.start), 'end': ms(phase['end'] - self.start), 'duration': ms(phase['end'] - phase['start'])}
+                       for name, phase in sorted(self.phases.items(), key=lambda item: item[1]['end'])},
+            'imports': [{**entry, 'start': ms(entry['start'] - self.start), 'self': ms(entry['self']), 'cumulative': ms(entry['cumulative'])}
+                        for entry in self.import_timer.imports],
+        }
+
+    def write(self, **details):
+        """Writes the report (times in milliseconds since main.py started) with `details` added and stops timing imports."""
+        if self.written:
+            return
+        self.written = True
+        if self.import_timer in sys.meta_path:
+            sys.meta_path.remove(self.import_timer)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(**details), f, indent=2)